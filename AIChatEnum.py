@@ -48,4 +48,29 @@ class AIGui(BaseEnum):
 
 class DataType(BaseEnum):
     Config = 0
-    ChatBot = 1
\ No newline at end of file
+    ChatBot = 1
+
+class DataChangeType(BaseEnum):
+    AppendMessage = 0
+    DeleteMessage = 1
+    UpdateChatBot = 2
+    DeleteChatBot = 3
+
+class StorageType(BaseEnum):
+    Json = 0
+    SQLite = 1
+
+class SnapshotCodec(BaseEnum):
+    Json = 0
+    CompactJson = 1
+    Binary = 2
+
+class WorkerStage(BaseEnum):
+    LLM = 0
+    Translate = 1
+    TTS = 2
+    Emotion = 3
+
+class CallPriority(BaseEnum):
+    Interactive = 0
+    Background = 1
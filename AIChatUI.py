@@ -346,6 +346,7 @@ class QChatBotButton(QPushButton):
     """A button for the chatbot list"""
     editClicked = Signal(str)
     deleteClicked = Signal(str)
+    exportClicked = Signal(str)
     checked = Signal(str)
 
     def __init__(self, name, id_, avatar_path='./resources/images/test_avatar_me.jpg', description='This is a ChatBot.',
@@ -435,6 +436,7 @@ class QChatBotButton(QPushButton):
         menu = QMenu(self)
         # todo: add a edit function
         menu.addAction('Edit', lambda: self.editClicked.emit(self._id))
+        menu.addAction('Export', lambda: self.exportClicked.emit(self._id))
         menu.addAction('Delete', lambda: self.deleteClicked.emit(self._id))
         menu.exec_(e.globalPos())
 
@@ -733,11 +735,20 @@ class QTitlebarCloseButton(QCustomPushButton):
 
 
 class QLeftBarAddButton(QCustomPushButton):
+    importClicked = Signal()
+
     def __init__(self):
         super().__init__(QSize(200, 80))
         self.normalColor, self.hoverColor, self.pressedColor = QColor('#e2e2e2'), QColor('#BDC0BA'), QColor('#d2d2d2')
         self.setObjectName('left_bar_add_button')
 
+    def mouseReleaseEvent(self, e: QMouseEvent):
+        if e.button() == Qt.RightButton:
+            menu = QMenu(self)
+            menu.addAction('Import', lambda: self.importClicked.emit())
+            menu.exec_(e.globalPos())
+        super().mouseReleaseEvent(e)
+
     def paintEvent(self, e: QPaintEvent) -> None:
         super().paintEvent(e)
         painter = QPainter(self)
@@ -805,6 +816,16 @@ class QMessageLabel(QLabel):
         self.resize(self.sizeHint())
         self.setMaximumWidth(width)
 
+    def append_text(self, text):
+        """
+        Add text to the end of the message, e.g. a chunk of a streamed reply. The size is not updated here, call
+        set_max_width to lay it out again.
+        :param text: str
+        :return:
+        """
+        self._message += text
+        self.setText(self._message)
+
 
 class QMessagePlainTextEdit(QPlainTextEdit):
     SendMessage = Signal(str)
@@ -1257,7 +1278,9 @@ class SmoothScrollBar(QScrollBar):
 
     def __init__(self, parent=None):
         QScrollBar.__init__(self, parent)
-        self.rangeChanged.connect(lambda : self.scrollTo(self.maximum(), False))
+        self._held_distance_to_maximum = None
+        self._held_widget = None
+        self.rangeChanged.connect(self._on_range_changed)
         self.ani = QPropertyAnimation()
         self.ani.setTargetObject(self)
         self.ani.setPropertyName(b"value")
@@ -1304,8 +1327,37 @@ class SmoothScrollBar(QScrollBar):
     def resetValue(self, value):
         self.__value = value
 
+    def holdPosition(self):
+        """ keep the distance to the maximum on the next range change, e.g. when content is inserted on the top """
+        self._held_distance_to_maximum = self.maximum() - self.value()
+
+    def holdWidget(self, widget):
+        """ keep the widget on the top on the range changes, until releaseWidget is called """
+        self.releaseWidget()
+        self._held_widget = widget
+        widget.destroyed.connect(self._on_held_widget_destroyed)
+        self.scrollTo(widget.y(), False)
+
+    def releaseWidget(self):
+        if self._held_widget is not None:
+            self._held_widget.destroyed.disconnect(self._on_held_widget_destroyed)
+        self._held_widget = None
+
+    def _on_held_widget_destroyed(self):
+        self._held_widget = None
+
+    def _on_range_changed(self):
+        if self._held_widget is not None:
+            self.scrollTo(self._held_widget.y(), False)
+        elif self._held_distance_to_maximum is None:
+            self.scrollTo(self.maximum(), False)
+        else:
+            self.scrollTo(self.maximum() - self._held_distance_to_maximum, False)
+            self._held_distance_to_maximum = None
+
     def mousePressEvent(self, e):
         self.ani.stop()
+        self.releaseWidget()
         super().mousePressEvent(e)
         self.__value = self.value()
 
@@ -1321,6 +1373,9 @@ class SmoothScrollBar(QScrollBar):
 
 
 class QNoBarScrollArea(QScrollArea):
+    scrolledToTop = Signal()  # signal emitted when scrolling up at the top
+    scrolledToBottom = Signal()  # signal emitted when scrolling down at the bottom
+
     def __init__(self, widget, parent=None):
         super().__init__(parent)
         self.hScrollBar = SmoothScrollBar(self)
@@ -1351,8 +1406,21 @@ class QNoBarScrollArea(QScrollArea):
         bar.ani.setDuration(duration)
         bar.ani.setEasingCurve(easing)
 
+    def scrollToWidget(self, widget):
+        """
+        scroll to the widget in the scroll area, and keep it there while the content is still laid out.
+        :param widget: a child widget of the scroll area's widget.
+        :return:
+        """
+        self.vScrollBar.holdWidget(widget)
+
     def wheelEvent(self, e):
         if e.modifiers() == Qt.NoModifier:
+            self.vScrollBar.releaseWidget()
+            if e.angleDelta().y() > 0 and self.vScrollBar.value() == self.vScrollBar.minimum():
+                self.scrolledToTop.emit()
+            elif e.angleDelta().y() < 0 and self.vScrollBar.value() == self.vScrollBar.maximum():
+                self.scrolledToBottom.emit()
             self.vScrollBar.scrollValue(-e.angleDelta().y())
 
 
@@ -1566,6 +1634,8 @@ class OpenAISettingGroup(QWidget, DataGUIInterface):
     def __init__(self, data, parent=None, has_api_key=True):
         super().__init__(parent)
         self._has_api_key = has_api_key
+        # the keys besides the main one are set in the config file, they are kept as they are
+        self._api_keys = []
 
         self.setObjectName('openai_setting_group')
         self._layout = QSettableVLayout(content_margin=(0, 0, 0, 0), spacing=15)
@@ -1603,6 +1673,7 @@ class OpenAISettingGroup(QWidget, DataGUIInterface):
             return
         if self._has_api_key:
             self._chatgpt_api_key_input_box.input_content = data.openai_api_key
+            self._api_keys = data.api_keys
         self._chatgpt_model_combo_box.setCurrentText(data.model)
         self._temperature_input_box.value = data.temperature
         self._top_p_input_box.value = data.top_p
@@ -1613,6 +1684,7 @@ class OpenAISettingGroup(QWidget, DataGUIInterface):
     def _data(self) -> OpenAIConfigData | GPTParamsData:
         if self._has_api_key:
             data = OpenAIConfigData(openai_api_key=self._chatgpt_api_key_input_box.input_content,
+                                    api_keys=self._api_keys,
                                     gpt_params={'model': self._chatgpt_model_combo_box.currentText,
                                                 'temperature': self._temperature_input_box.value,
                                                 'top_p': self._top_p_input_box.value,
@@ -1,22 +1,32 @@
 import base64
 import datetime
+import time
 import weakref
 from functools import total_ordering
 
-from PySide6.QtCore import QObject, QThread, Signal, Slot
+from PySide6.QtCore import QObject, Signal, Slot
 from PySide6.QtWidgets import QApplication
 
 
+import context_builder
+import key_pool
+import rate_limiter
+import resilience
 import utils
 from data import ChatBotData, ConfigData, ChatBotDataList, MessageData
-from event import SendMessageEvent, SpeakMessageEvent, ChatBotThreadStatusChangedEvent
+from AIChatEnum import CallPriority, DataType, WorkerStage
+from event import SendMessageEvent, SpeakMessageEvent, ChatBotThreadStatusChangedEvent, StreamMessageEvent, \
+    SaveDataEvent, SpeakSegmentEvent
 from event_type import SendMessageEventType
-from exceptions import ChatBotException, ChatGPTException
+from exceptions import ChatBotException, CircuitOpenError
 
 import openai
 
+from http_pool import HTTPPool
 from speaker import Speaker
+from speech_pipeline import EmotionTask, SpeechPipeline
 from translater import TranslaterFactory, Translater
+from worker_pool import Task, TaskGraph, WorkerPool
 
 
 class ChatBotFactory(QObject):
@@ -24,24 +34,48 @@ class ChatBotFactory(QObject):
     configSaved = Signal()
     stopChatbot = Signal(str)
 
-    def __init__(self, config: ConfigData, chatbot_data: ChatBotDataList):
+    def __init__(self, config: ConfigData, chatbot_data: ChatBotDataList, worker_counts=None, warm_up=True,
+                 pipelined_speech=True):
+        """
+        Creates the chatbots.
+        :param config: ConfigData, the config.
+        :param chatbot_data: ChatBotDataList, the chatbots.
+        :param worker_counts: dict, [optional] the thread count of every WorkerStage, shared by all the chatbots, see
+        WorkerPool.
+        :param warm_up: bool, connect to the translater and the speaker in the background whenever the config is set
+        up, so the first reply does not wait for the handshakes.
+        :param pipelined_speech: bool, speak the replies sentence by sentence while they are generated, see
+        SpeechPipeline.
+        """
         super().__init__()
         self.stopChat.connect(self.stop_chat)
         self.configSaved.connect(self.setup_config)
         self.stopChatbot.connect(lambda chatbot_id: self.get_chatbot(chatbot_id).stop_generate())
-        self._chatbots = []
+        # the chatbots by chatbot id
+        self._chatbots: dict[str, ChatBot] = {}
         self._chatbot_data = chatbot_data
-        self._speaker = Speaker(config.vits_config)
-        self._translater_factory = TranslaterFactory(config.translater_config)
+        self._http_pool = HTTPPool()
+        self._speaker = Speaker(config.vits_config, self._http_pool)
+        self._translater_factory = TranslaterFactory(config.translater_config, self._http_pool)
+        self._worker_pool = WorkerPool(worker_counts)
+        self._warm_up = warm_up
+        self._pipelined_speech = pipelined_speech
         for chatbot in self._chatbot_data:
             self.create_chatbot(chatbot)
         self._config = config
         self.setup_config()
 
     def setup_config(self):
-        openai.api_key = self._config.openai_config.openai_api_key
+        key_pool.pool.setup(self._config.openai_config)
+        # the quotas of the keys may have changed
+        rate_limiter.limiter.reset()
         self._speaker.setup_config()
         self._translater_factory.setup_config()
+        if self._warm_up:
+            if self._translater_factory.active_translater:
+                self._worker_pool.submit(WorkerStage.Translate,
+                                         WarmUpTask(self._translater_factory.active_translater.warm_up))
+            self._worker_pool.submit(WorkerStage.TTS, WarmUpTask(self._speaker.warm_up))
 
     def create_chatbot(self, chatbot_data: ChatBotData, limit_token=3400):
         """Creates a chatbot.
@@ -49,11 +83,15 @@ class ChatBotFactory(QObject):
         :param limit_token: int, the limit token, default 3400.
         """
         # generate id
-        chatbot = ChatBot(chatbot_data, self._speaker, self._translater_factory, limit_token)
+        chatbot = ChatBot(chatbot_data, self._speaker, self._translater_factory, self._worker_pool, limit_token,
+                          self._pipelined_speech)
         chatbot.sendMessage.connect(self.send_message)
+        chatbot.streamMessage.connect(self.stream_message)
         chatbot.speak.connect(self.speak_message)
+        chatbot.speakSegment.connect(self.speak_segment)
         chatbot.threadStatusChanged.connect(self.on_chatbot_thread_status_changed)
-        self._chatbots.append(chatbot)
+        chatbot.memoryUpdated.connect(lambda: QApplication.sendEvent(self, SaveDataEvent(DataType.ChatBot)))
+        self._chatbots[chatbot.chatbot_id] = chatbot
 
     def delete_chatbot(self, chatbot_id):
         """
@@ -61,18 +99,14 @@ class ChatBotFactory(QObject):
         :param chatbot_id: the chatbot id of the chatbot to delete.
         :return:
         """
-        for chatbot in self._chatbots:
-            if chatbot.chatbot_id == chatbot_id:
-                self._chatbots.remove(chatbot)
-                return
-        raise ChatBotException('Chatbot not found.')
+        if self._chatbots.pop(chatbot_id, None) is None:
+            raise ChatBotException('Chatbot not found.')
 
     def get_chatbot(self, chatbot_id):
         """Returns a chatbot
         :param chatbot_id: int, the chatbot id"""
-        for chatbot in self._chatbots:
-            if chatbot.chatbot_id == chatbot_id:
-                return chatbot
+        if chatbot_id in self._chatbots:
+            return self._chatbots[chatbot_id]
         raise ChatBotException('Chatbot not found.')
 
     def receive_message(self, history_id, message: MessageData, is_speak=True):
@@ -82,9 +116,31 @@ class ChatBotFactory(QObject):
     def send_message(self, history_id, message: MessageData):
         QApplication.sendEvent(self, SendMessageEvent(history_id, message))
 
+    def stream_message(self, history_id, chatbot_id, text, finished):
+        QApplication.sendEvent(self, StreamMessageEvent(history_id, chatbot_id, text, finished))
+
     def speak_message(self, history_id, message: MessageData):
         QApplication.sendEvent(self, SpeakMessageEvent(history_id, message))
 
+    def speak_segment(self, history_id, chatbot_id, path, index):
+        QApplication.sendEvent(self, SpeakSegmentEvent(history_id, chatbot_id, path, index))
+
+    def get_http_metrics(self) -> dict[str, dict]:
+        """
+        The request and handshake times of the translaters and the speaker, see HTTPPool.get_metrics.
+        :return: dict
+        """
+        return self._http_pool.get_metrics()
+
+    def set_worker_count(self, stage: WorkerStage, count):
+        """
+        Change the thread count of a stage for all the chatbots.
+        :param stage: WorkerStage
+        :param count: int
+        :return:
+        """
+        self._worker_pool.set_worker_count(stage, count)
+
     def speak_it(self, history_id, message: MessageData):
         receiver = self.get_chatbot(message.chatbot_id)
         receiver.speak_it(history_id, message)
@@ -102,43 +158,31 @@ class ChatBotFactory(QObject):
         self.get_chatbot(chatbot_id).stopGenerate.emit()
 
 
-class ChatThread(QThread):
+class ChatTask(Task):
     sendMessage = Signal(str, MessageData)  # history id, message data
-    stopThread = Signal()
+    streamMessage = Signal(str, str, str, bool)  # history id, chatbot id, chunk, finished
 
-    def __init__(self, history_id, chatbot_data):
+    def __init__(self, history_id, chatbot_data, limit_token=None):
         super().__init__()
         self._history_id = history_id
         self._chatbot_data = chatbot_data
-        self._is_running = True
-        self.stopThread.connect(self.stop)
+        self._limit_token = limit_token
+
+    history_id = property(lambda self: self._history_id)
 
     def run(self) -> None:
         # send request
         try:
-            messages = [
-                {
-                    'role': 'system',
-                    'content': self._chatbot_data.character.prompt
-                }
-            ]
-            for message in self._chatbot_data.get_history(self._history_id).latest_n(10):
-                messages.append({
-                    'role': 'user' if message.is_user else 'assistant',
-                    'content': message.message
-                })
-
-            response = openai.ChatCompletion.create(
-                messages=messages,
-                **self._chatbot_data.gpt_params.data
-            )
-            translate_result = response['choices'][0]['message']['content']
+            messages = context_builder.build_context(self._chatbot_data.character.prompt,
+                                                     self._chatbot_data.get_history(self._history_id),
+                                                     self._chatbot_data.gpt_params, self._limit_token)
+            translate_result = self._stream_reply(messages)
         except Exception as e:
             translate_result = None
             if self._is_running:
                 utils.warn(e)
-        # handle response
-        # total_tokens = response['usage']['total_tokens']
+        # the reply is shown as a message from here on
+        self.streamMessage.emit(self._history_id, self._chatbot_data.chatbot_id, '', True)
         if translate_result and self._is_running:
             # add message
             response = MessageData(
@@ -151,30 +195,60 @@ class ChatThread(QThread):
             self._chatbot_data.append_message(response, self._history_id)
             self.sendMessage.emit(self._history_id, response)
 
-    def stop(self):
-        self._is_running = False
-
-
-class SpeakThread(QThread):
+    def _stream_reply(self, messages):
+        """
+        Request the reply in stream mode, and pass every chunk on as it comes.
+        :param messages: the prompt messages.
+        :return: str, the whole reply, or None if the thread is stopped.
+        """
+        begin = time.perf_counter()
+        first_chunk_time = None
+        chunks = []
+        # only the request is retried, not a reply broken in the middle
+        response = resilience.call(
+            resilience.OPENAI_ENDPOINT,
+            rate_limiter.call_openai,
+            openai.ChatCompletion.create,
+            chatbot_id=self._chatbot_data.chatbot_id,
+            messages=messages,
+            stream=True,
+            **self._chatbot_data.gpt_params.data
+        )
+        for chunk in response:
+            if not self._is_running:
+                response.close()
+                return None
+            text = chunk['choices'][0]['delta'].get('content')
+            if not text:
+                continue
+            if first_chunk_time is None:
+                first_chunk_time = time.perf_counter()
+                utils.debug(f'Chat {self._chatbot_data.chatbot_id}: time to first token '
+                            f'{(first_chunk_time - begin) * 1000:.0f}ms.')
+            chunks.append(text)
+            self.streamMessage.emit(self._history_id, self._chatbot_data.chatbot_id, text, False)
+        if first_chunk_time is not None:
+            utils.debug(f'Chat {self._chatbot_data.chatbot_id}: {len(chunks)} chunks in '
+                        f'{time.perf_counter() - begin:.2f}s.')
+        return ''.join(chunks)
+
+
+class SpeakTask(Task):
     speak = Signal(MessageData)
-    stopThread = Signal()
 
-    def __init__(self, message_data: MessageData, speaker: Speaker, text, context, raw_text):
+    def __init__(self, message_data: MessageData, speaker: Speaker, text, emotion_candidates):
         super().__init__()
         self._message_data = message_data
         self._speaker = speaker
         self._text = text
-        self._context = context
-        self._raw_text = raw_text
-        self._is_running = True
-        self.stopThread.connect(self.stop)
+        self._emotion_candidates = emotion_candidates
 
     def run(self) -> None:
         # emotion, nsfw = ChatBot.get_emotion_from_gpt(self._message_data.message)
 
         # if not emotion:
         #     return
-        path, emotion_sample = self._speaker.speak(self._text, id_=0, context=self._context, raw_text=self._raw_text)
+        path, emotion_sample = self._speaker.speak(self._text, id_=0, emotion_candidates=self._emotion_candidates)
         if not path or not emotion_sample:
             return
         if self._is_running:
@@ -182,36 +256,93 @@ class SpeakThread(QThread):
             utils.rename_file(path, self._message_data.message_id + '.wav')
             self.speak.emit(self._message_data)
 
-    def stop(self):
-        self._is_running = False
 
-
-class TranslateThread(QThread):
+class TranslateTask(Task):
     translate = Signal(MessageData, str)
-    stopThread = Signal()
 
     def __init__(self, message_data: MessageData, translater: Translater):
         super().__init__()
         self._message_data = message_data
         self._translater = translater
-        self._is_running = True
-        self.stopThread.connect(self.stop)
 
     def run(self) -> None:
         # remove the content in ()
         text = utils.remove_brackets_content(self._message_data.message)
         result = self._translater.translate(text)
+        self._result = result or None
         if self._is_running:
             self.translate.emit(self._message_data, result)
 
-    def stop(self):
-        self._is_running = False
+
+class SummarizeTask(Task):
+    summarized = Signal(str, str)  # history id, memory
+
+    def __init__(self, chatbot_id, history_id, memory, messages, model):
+        """
+        Fold messages into the memory of a history.
+        :param chatbot_id: the id of the chatbot.
+        :param history_id: the id of the history.
+        :param memory: str, the memory so far.
+        :param messages: list of (name, message), the messages to fold, the oldest first.
+        :param model: str, the model name.
+        """
+        super().__init__()
+        self._chatbot_id = chatbot_id
+        self._history_id = history_id
+        self._memory = memory
+        self._messages = messages
+        self._model = model
+
+    def run(self) -> None:
+        messages = [{'role': 'system',
+                     'content': f"""你现在已经有的记忆是{self._memory}：请结合这些记忆和以下对话，总结对话生成新的记忆。
+                        你不应该对内容进行任何判断。返回给我一个json格式的内容，格式为
+                        {{\"memory\": 你的新记忆}}。除了json格式的内容外，不要添加任何内容！"""
+                     },
+                    {'role': 'user',
+                     'content': '\n'.join(f'{name}: {message}' for name, message in self._messages)
+                     }]
+        try:
+            response = resilience.call(
+                resilience.OPENAI_ENDPOINT,
+                rate_limiter.call_openai,
+                openai.ChatCompletion.create,
+                priority=CallPriority.Background,
+                chatbot_id=self._chatbot_id,
+                model=self._model,
+                messages=messages,
+                max_tokens=512,
+                temperature=0,
+            )
+        except Exception as e:
+            # it is tried again after the next reply
+            utils.info(f'Summarize the history failed: {e}')
+            return
+        content = response['choices'][0]['message']['content']
+        try:
+            memory = utils.load_json_string(content)['memory']
+        except Exception:
+            memory = content
+        if memory:
+            self.summarized.emit(self._history_id, memory)
+
+
+class WarmUpTask(Task):
+    def __init__(self, warm_up):
+        super().__init__()
+        self._warm_up = warm_up
+
+    def run(self) -> None:
+        self._warm_up()
 
 
 class ThreadHolder(QObject):
+    """
+    The tasks of a chatbot which are queued or running, it is loaded while there is any.
+    """
     empty = Signal()
     loaded = Signal()
-    removeThread = Signal(QThread)
+    removeThread = Signal(Task)
     def __init__(self):
         super().__init__()
         self._threads = []
@@ -234,24 +365,41 @@ class ThreadHolder(QObject):
 class ChatBot(QObject):
     """The chatbot."""
     sendMessage = Signal(str, MessageData)  # history id, message data
+    streamMessage = Signal(str, str, str, bool)  # history id, chatbot id, chunk, finished
     speak = Signal(str, MessageData)  # history id, message data
+    speakSegment = Signal(str, str, str, int)  # history id, chatbot id, wave path, segment index
+    memoryUpdated = Signal(str)  # chatbot id
     stopGenerate = Signal()
     threadStatusChanged = Signal(str, bool)  # chatbot id, is running
 
-    def __init__(self, chatbot_data: ChatBotData, speaker, translater_factory, limit_token=3400):
+    def __init__(self, chatbot_data: ChatBotData, speaker, translater_factory, worker_pool: WorkerPool,
+                 limit_token=3400, pipelined_speech=False):
         """
         Sets the chatbot.
 
         :param chatbot_data: ChatBotData, the chatbot data.
         :param speaker: Speaker, the speaker.
         :param translater_factory: TranslaterFactory, the translater factory.
-        :param limit_token: int, the limit token, default 3400.
+        :param worker_pool: WorkerPool, runs the tasks of the chatbot.
+        :param limit_token: int, the limit token, default 3400. The prompt takes at most this many tokens, or less if
+        the model window and the max tokens of the reply leave less, see context_builder.get_budget.
+        :param pipelined_speech: bool, speak the replies sentence by sentence while they are generated, instead of as a
+        whole when they are done.
         """
         super().__init__()
         self.stopGenerate.connect(self.stop_generate)
         self._chatbot_data: ChatBotData = chatbot_data
+        self._limit_token = limit_token
+        # the chat task of the reply being generated, the stream of a stopped one is not passed on
+        self._chat_task: ChatTask | None = None
+        # the summarizing runs besides the chat, and is not stopped with it
+        self._summarize_task: SummarizeTask | None = None
         self._speaker = speaker
         self._translater_factory = translater_factory
+        self._worker_pool = worker_pool
+        self._pipelined_speech = pipelined_speech
+        self._speech_pipeline: SpeechPipeline | None = None
+        self._speak_graph: TaskGraph | None = None
         self._thread_holder = ThreadHolder()
         self._thread_holder.empty.connect(lambda : self.threadStatusChanged.emit(self.chatbot_id, False))
         self._thread_holder.loaded.connect(lambda : self.threadStatusChanged.emit(self.chatbot_id, True))
@@ -263,87 +411,138 @@ class ChatBot(QObject):
     # use openai module to chat
     def receive_message(self, history_id, is_speak:bool=True):
         """Uses openai module to chat"""
-        # if the chat thread is running, stop it
+        # if the chat task is running, stop it
         self.stop_generate()
-        # use a thread to chat
-        chat_thread = ChatThread(history_id, self._chatbot_data)
-        chat_thread.finished.connect(lambda:self._thread_holder.removeThread.emit(chat_thread))
-        if is_speak:
-            chat_thread.sendMessage.connect(self.speak_it)
-        chat_thread.sendMessage.connect(self.sendMessage)
-        self._thread_holder.append(chat_thread)
-        chat_thread.start()
+        # chat in a worker
+        chat_task = ChatTask(history_id, self._chatbot_data, self._limit_token)
+        if is_speak and self._pipelined_speech:
+            self._speech_pipeline = self._create_speech_pipeline(history_id)
+            chat_task.streamMessage.connect(self._speech_pipeline.feed)
+            chat_task.sendMessage.connect(self._speech_pipeline.set_message)
+            chat_task.finished.connect(self._speech_pipeline.end_chat)
+        elif is_speak:
+            chat_task.sendMessage.connect(self.speak_it)
+        chat_task.sendMessage.connect(self.sendMessage)
+        chat_task.streamMessage.connect(self._on_stream_message)
+        chat_task.sendMessage.connect(self.summarize)
+        self._chat_task = chat_task
+        self._run_task(WorkerStage.LLM, chat_task)
+
+    @Slot(str, str, str, bool)
+    def _on_stream_message(self, history_id, chatbot_id, text, finished):
+        """
+        Pass the stream of the current chat task on. A stopped task may still send chunks and its finish, which would
+        end the stream of the next reply, stop_generate has finished its stream already.
+        """
+        if self.sender() is not self._chat_task:
+            return
+        if finished:
+            self._chat_task = None
+        self.streamMessage.emit(history_id, chatbot_id, text, finished)
+
+    def _run_task(self, stage: WorkerStage, task: Task):
+        """
+        Run a task in the worker pool, the chatbot is running until it is done.
+        :param stage: WorkerStage
+        :param task: Task
+        :return:
+        """
+        task.finished.connect(lambda: self._thread_holder.removeThread.emit(task))
+        self._thread_holder.append(task)
+        self._worker_pool.submit(stage, task)
+
+    def _create_speech_pipeline(self, history_id) -> SpeechPipeline:
+        context = self._chatbot_data.get_history(history_id).latest_n(5)
+        context = '\n'.join(utils.remove_brackets_content(message.message) for message in context)
+        pipeline = SpeechPipeline(history_id, self.chatbot_id, self._speaker,
+                                  self._translater_factory.active_translater, context, self._run_task)
+        pipeline.segmentReady.connect(self.speakSegment)
+        return pipeline
 
     @Slot(str, MessageData)
     def speak_it(self, history_id, message_data: MessageData):
-        """Speaks the message"""
-
-        def speak_it_now(_message_data: MessageData, result: str, context=None, raw_text=None):
-            """
-            Speaks the message after translating.
-            :param _message_data: message data.
-            :param result: the result of translation.
-            :param context: the context.
-            :param raw_text: the raw text which is not translated.
-            :return:
-            """
-            if not result:
-                return
-            self.stop_generate()
-            speak_thread = SpeakThread(_message_data, self._speaker, result, context, raw_text)
-            speak_thread.finished.connect(lambda: self._thread_holder.removeThread.emit(speak_thread))
-            speak_thread.speak.connect(lambda: self.speak.emit(history_id, _message_data))
-            self._thread_holder.append(speak_thread)
-            speak_thread.start()
-
-        lang = utils.detect_language(message_data.message)
+        """
+        Speaks the message. The emotion only needs the raw text, so it is looked up while the message is translated,
+        and the speech starts when both are done, see TaskGraph.
+        """
+        self.stop_generate()
         context_ = self._chatbot_data.get_history(history_id).latest_n(5)
         context_ = [utils.remove_brackets_content(message.message) for message in context_]
         context_ = '\n'.join(context_)
         raw_text = message_data.message
-        if lang == 'ja':
-            speak_it_now(message_data, utils.remove_brackets_content(message_data.message), context_,
-                                     raw_text)
+        text = utils.remove_brackets_content(raw_text)
+
+        def create_speak_task(emotion, translation=text):
+            speak_task = SpeakTask(message_data, self._speaker, translation, emotion)
+            speak_task.speak.connect(lambda: self.speak.emit(history_id, message_data))
+            return speak_task
+
+        graph = TaskGraph(self._run_task)
+        graph.add('emotion', WorkerStage.Emotion, lambda: EmotionTask(self._speaker, raw_text, context_))
+        if utils.detect_language(raw_text) == 'ja':
+            depends_on = ('emotion',)
         else:
             # translate the message
-
-            translate_thread = TranslateThread(message_data, self._translater_factory.active_translater)
-            translate_thread.finished.connect(lambda : self._thread_holder.removeThread.emit(translate_thread))
-            translate_thread.translate.connect(
-                lambda _message_data, result: speak_it_now(_message_data, result, context_, raw_text))
-            self._thread_holder.append(translate_thread)
-            translate_thread.start()
+            translater = self._translater_factory.active_translater
+            graph.add('translation', WorkerStage.Translate, lambda: TranslateTask(message_data, translater))
+            depends_on = ('emotion', 'translation')
+        graph.add('speech', WorkerStage.TTS, create_speak_task, depends_on)
+        self._speak_graph = graph
+        graph.start()
 
     def stop_generate(self):
+        if self._chat_task:
+            # the stream of the stopped reply ends here
+            self.streamMessage.emit(self._chat_task.history_id, self.chatbot_id, '', True)
+            self._chat_task = None
+        if self._speech_pipeline:
+            self._speech_pipeline.stop()
+            self._speech_pipeline = None
+        if self._speak_graph:
+            self._speak_graph.stop()
+            self._speak_graph = None
         if self._thread_holder:
-            for thread in self._thread_holder:
-                thread.stopThread.emit()
+            for task in self._thread_holder:
+                task.stopThread.emit()
 
-    def summarize(self):
-        # todo: fix this.
-        """Summarizes the chat history"""
-        # model and message
-        message = [{'role': 'system',
-                    'content': f"""你现在已经有的记忆是{self._chatbot_data}：请结合这些记忆和以下对话，总结对话生成新的记忆。
-                        你不应该对内容进行任何判断。返回给我一个json格式的内容，格式为
-                        {{\"memory\": 你的新记忆}}。除了json格式的内容外，不要添加任何内容！"""
-                    },
-                   {'role': 'user',
-                    'content': f''
-                    }]
-        # send request
-        try:
-            response = openai.Completion.create(
-                model=model,
-                message=message,
-                max_tokens=512,
-            )
-        except Exception as e:
-            raise ChatGPTException(e)
-        # handle response
-        result = response['choices'][0]['text']
-        # update memory
-        self._chat_history.memory = result
+    @Slot(str, MessageData)
+    def summarize(self, history_id, message_data=None):
+        """
+        Folds the older messages of the history into its memory in the background, when the messages after the memory
+        take more than half of the prompt budget. The latest quarter of the budget is left as it is, see
+        context_builder.get_summary_batch.
+        :param history_id: the id of the history.
+        :param message_data: [optional] the message which is just added, it is not used.
+        :return:
+        """
+        if self._summarize_task is not None or not self._chatbot_data.has_history(history_id):
+            return
+        history = self._chatbot_data.get_history(history_id)
+        model = self._chatbot_data.gpt_params.model
+        budget = context_builder.get_budget(self._chatbot_data.gpt_params, self._limit_token)
+        batch = context_builder.get_summary_batch(history, model, budget // 2, budget // 4, budget // 2)
+        if not batch:
+            return
+        summarized_until = history.summarized_until
+        summarize_task = SummarizeTask(self.chatbot_id, history_id, history.memory,
+                                       [(message.name, message.message) for message in batch], model)
+        summarize_task.summarized.connect(
+            lambda _history_id, memory: self._update_memory(_history_id, memory, summarized_until, batch[-1]))
+        summarize_task.finished.connect(self._on_summarize_finished)
+        self._summarize_task = summarize_task
+        self._worker_pool.submit(WorkerStage.LLM, summarize_task, low_priority=True)
+
+    def _update_memory(self, history_id, memory, summarized_until, latest_message: MessageData):
+        # the history may be deleted, or summarized by someone else meanwhile
+        if not self._chatbot_data.has_history(history_id):
+            return
+        if self._chatbot_data.histories[history_id].summarized_until != summarized_until:
+            return
+        self._chatbot_data.update_memory(history_id, memory, (latest_message.send_time, latest_message.message_id))
+        self.memoryUpdated.emit(self.chatbot_id)
+
+    def _on_summarize_finished(self):
+        self._summarize_task = None
 
     @staticmethod
     def get_emotion_from_gpt(text, temperature=0):
@@ -357,14 +556,17 @@ class ChatBot(QObject):
                      'content': '判断说话人说这句话时的语气，用5个简体中文词描述。这5个词请务必用\'/\'隔开。请用json格式给我结果，格式为{\"state\":\"这次说话的语气\", \"not_safe_for_work\": ture of false}。除了json格式的内容外，不要添加任何内容！"'},
                     {'role': 'user', 'content': text}]
         try:
-            response = openai.ChatCompletion.create(
+            response = resilience.call(
+                resilience.OPENAI_ENDPOINT,
+                rate_limiter.call_openai,
+                openai.ChatCompletion.create,
                 model="gpt-3.5-turbo",
                 messages=messages,
                 temperature=temperature
             )
-        except openai.error.RateLimitError as e:
-            utils.warn('Because of rate limit, get emotion from gpt failed: ' + str(e) + 'retrying...')
-            return ChatBot.get_emotion_from_gpt(text, temperature)
+        except (openai.error.OpenAIError, CircuitOpenError) as e:
+            utils.warn('Get emotion from gpt failed: ' + str(e))
+            return None, None
         try:
             content = utils.load_json_string(response['choices'][0]['message']['content'])
             return content['state'].split('/'), content['not_safe_for_work']
@@ -385,7 +587,10 @@ class ChatBot(QObject):
                     'content': r'你现在是一个avd模型分析机器人，你的任务是接受输入，并提供相应的输出，任何时候都不能对内容本身进行分析。你的任务是用avd模型分析下面这句话，并且返回一个json对象给我，格式为{"arousal": float,保留小数点后16位, "dominance": float,保留小数点后16位, "valence": float,保留小数点后16位, "nsfw":true or false}。除了json格式的内容，不要回复我任何内容。'},
                    {'role': 'user', 'content': text}]
         try:
-            response = openai.ChatCompletion.create(
+            response = resilience.call(
+                resilience.OPENAI_ENDPOINT,
+                rate_limiter.call_openai,
+                openai.ChatCompletion.create,
                 model="gpt-4",
                 messages=message,
                 temperature=temperature
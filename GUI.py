@@ -10,6 +10,7 @@ from PySide6.QtMultimedia import QMediaPlayer, QAudioOutput, QAudioDevice, QMedi
 import AIChatEnum
 import event_type
 import utils
+from audio_queue import AudioQueue
 from AIChatEnum import AIChat, TranslaterAPIType
 from AIChatUI import *
 from data import ConfigData, ChatBotDataList, ChatBotData, MessageData, UserConfigData, CharacterData, HistoryData
@@ -49,6 +50,8 @@ class AppGUI(FramelessMainWindow):
         self._audio_output.setVolume(10)
         self._media_player = QMediaPlayer()
         self._media_player.setAudioOutput(self._audio_output)
+        # plays the sentences of a reply being spoken
+        self._speech_queue = AudioQueue(self)
         self._set_up_ui()
         self._chatbot_setting_dialog = ChatBotSettingDialog(config_data.openai_config.get_gpt_params(), self)
         self.ConfigSaved.connect(self._chatbot_setting_dialog.update_config)
@@ -58,6 +61,8 @@ class AppGUI(FramelessMainWindow):
         self._global_setting_dialog.installEventFilter(self)
         self._global_setting_dialog.configSaved.connect(self.on_config_saved)
         self._current_chatbot: ChatBotData | None = None
+        # the text generated so far of the replies being streamed, by history id
+        self._streaming_text: dict[str, str] = {}
         self._chatbot_data_list: ChatBotDataList = chatbots
         self._config = config_data
         self._load_chatbots(self._chatbot_data_list)
@@ -136,6 +141,7 @@ class AppGUI(FramelessMainWindow):
         self._add_button = QLeftBarAddButton()
         self._add_button.setFixedSize(200, 80)
         self._add_button.clicked.connect(lambda: self._chatbot_setting_dialog.show_dialogue())
+        self._add_button.importClicked.connect(self._import_chatbot)
         self._left_bar_button_group.addButton(self._add_button, 0)
         self._left_bar_layout.insertWidget(0, self._add_button)
         # create a QVBoxLayout for the right bar
@@ -162,6 +168,8 @@ class AppGUI(FramelessMainWindow):
         self._right_bar_layout.addWidget(self._message_area)
         # create a QScrollArea for the message area
         self._message_area_scroll_area = QNoBarScrollArea(self._message_area)
+        self._message_area_scroll_area.scrolledToTop.connect(self._load_earlier_messages)
+        self._message_area_scroll_area.scrolledToBottom.connect(self._load_later_messages)
         self.ConfigSaved.connect(self._message_area.on_config_updated)
         self.ChatBotUpdated.connect(self._message_area.on_chatbot_updated)
         self._right_bar_layout.addWidget(self._message_area_scroll_area)
@@ -185,6 +193,13 @@ class AppGUI(FramelessMainWindow):
         self._retrieve_button.setFixedSize(90, 30)
         self._retrieve_button.clicked.connect(self._retrieve_button_clicked)
         self._button_area_layout.addWidget(self._retrieve_button)
+        # the search box
+        self._button_area_layout.addStretch()
+        self._search_box = QLineEdit()
+        self._search_box.setPlaceholderText('Search messages')
+        self._search_box.setFixedSize(200, 30)
+        self._search_box.returnPressed.connect(self._search_message)
+        self._button_area_layout.addWidget(self._search_box)
         # create an input area for the right bar
         self._input_area = QWidget()
         self._input_area.setObjectName('input_area')
@@ -249,7 +264,13 @@ class AppGUI(FramelessMainWindow):
         )
         history_id = self._message_area.current_history_id
         self._current_chatbot.append_message(message, history_id)
-        self._message_area.show_message(self._config.user_config, message)
+        self._message_area_scroll_area.vScrollBar.releaseWidget()
+        if self._message_area.is_window_open():
+            # the message goes after the loaded messages, not after the message window
+            self._load_history(history_id)
+        else:
+            self._message_area.show_message(self._config.user_config, message)
+        self._reposition_chatbot(self._current_chatbot.chatbot_id)
         QApplication.sendEvent(self, SaveDataEvent(AIChatEnum.DataType.ChatBot))
         QApplication.sendEvent(self, SendMessageEvent(history_id, message))
         self._input_box.clear()
@@ -272,10 +293,43 @@ class AppGUI(FramelessMainWindow):
         """
         chatbot = self._chatbot_data_list[message.chatbot_id]
         message = chatbot.histories[history_id][-1]
-        if history_id == self._message_area.current_history_id:
+        if history_id == self._message_area.current_history_id and not self._message_area.is_window_open():
             self._message_area.show_message(chatbot.character, message)
+        self._reposition_chatbot(chatbot.chatbot_id)
         QApplication.sendEvent(self, SaveDataEvent(AIChatEnum.DataType.ChatBot))
 
+    def stream_message(self, history_id, chatbot_id, text, finished):
+        """
+        show a chunk of a reply being generated.
+        :param history_id: the history id
+        :param chatbot_id: the chatbot id
+        :param text: the chunk of the reply
+        :param finished: if the reply is done or stopped, the done reply is received as a message after it.
+        :return:
+        """
+        if finished:
+            self._streaming_text.pop(history_id, None)
+            if history_id == self._message_area.current_history_id:
+                self._message_area.end_streaming_message()
+            return
+        self._streaming_text[history_id] = self._streaming_text.get(history_id, '') + text
+        if history_id == self._message_area.current_history_id and chatbot_id in self._chatbot_data_list and \
+                not self._message_area.is_window_open():
+            self._message_area.show_streaming_message(self._chatbot_data_list[chatbot_id].character, chatbot_id, text)
+
+    def _load_history(self, history_id):
+        """
+        show a history of the current chatbot, with its reply being generated if there is one.
+        :param history_id: the history id
+        :return:
+        """
+        self._message_area_scroll_area.vScrollBar.releaseWidget()
+        self._message_area.load_messages(self._config.user_config, self._current_chatbot, history_id)
+        if history_id in self._streaming_text:
+            self._message_area.show_streaming_message(self._current_chatbot.character,
+                                                      self._current_chatbot.chatbot_id,
+                                                      self._streaming_text[history_id])
+
     def speak_message(self, history_id, message: MessageData):
         """
         speak a message.
@@ -288,6 +342,20 @@ class AppGUI(FramelessMainWindow):
             self._media_player.setSource(QUrl.fromLocalFile(f'./download/sounds/{message.message_id}.wav'))
             self._media_player.play()
 
+    def queue_speech(self, history_id, path, index):
+        """
+        play a sentence of a reply being spoken, right after the sentences before it.
+        :param history_id: the history id
+        :param path: the wave file of the sentence
+        :param index: the index of the segment among the ones of the reply, the first one stops the speech before
+        :return:
+        """
+        if index == 0:
+            self._speech_queue.clear()
+            self._media_player.stop()
+        if history_id == self._message_area.current_history_id:
+            self._speech_queue.enqueue(path)
+
     def _retrieve_button_clicked(self):
         """
         the slot for the reception button
@@ -323,8 +391,8 @@ class AppGUI(FramelessMainWindow):
         :return:
         """
         if event.type() == event_type.AddChatBotEventType:
-            self._add_chatbot_button(event.data)
-            self._chatbot_data_list.append(event.data)
+            index = self._chatbot_data_list.append(event.data)
+            self._add_chatbot_button(event.data, index)
             self.set_current_chatbot(event.data)
             QApplication.sendEvent(self, SaveDataEvent(AIChatEnum.DataType.ChatBot))
             QApplication.sendEvent(self, AddChatBotEvent(event.data))
@@ -340,6 +408,7 @@ class AppGUI(FramelessMainWindow):
             if self._chatbot_data_list[event.data.chatbot_id].delete_message(event.history_id, event.data):
                 self._media_player.stop()
                 self.stopChat.emit(chatbot_id)
+            self._reposition_chatbot(chatbot_id)
             QApplication.sendEvent(self, SaveDataEvent(AIChatEnum.DataType.ChatBot))
         return super().eventFilter(obj, event)
 
@@ -349,10 +418,11 @@ class AppGUI(FramelessMainWindow):
             return True
         return super().event(e)
 
-    def _add_chatbot_button(self, data: ChatBotData):
+    def _add_chatbot_button(self, data: ChatBotData, index=None):
         """
         add a new chatbot button to the left bar
         :param data: the data of the chatbot
+        :param index: the index of the chatbot in the chatbot list, default the last one.
         :return:
         """
         name = data.character.name
@@ -362,13 +432,32 @@ class AppGUI(FramelessMainWindow):
         chatbot_button = QChatBotButton(name, id_=chatbot_id, avatar_path=avatar_path, description=description)
         chatbot_button.editClicked.connect(self._edit_chatbot_start)
         chatbot_button.deleteClicked.connect(self._delete_chatbot)
+        chatbot_button.exportClicked.connect(self._export_chatbot)
         chatbot_button.checked.connect(self._switch_current_chatbot)
         self.ChatBotUpdated.connect(chatbot_button.on_chatbot_update)
         chatbot_button.setFixedSize(200, 80)
-        self._chatbot_button_list.append(chatbot_button)
+        if index is None:
+            index = len(self._chatbot_button_list)
+        # the buttons are in the order of the chatbot list
+        self._chatbot_button_list.insert(index, chatbot_button)
         # chatbot_button.clicked.connect(lambda : self._chatbot_button_clicked(chatbot_button))
         self._left_bar_button_group.addButton(chatbot_button, self._left_bar_button_group.buttons().__len__())
-        self._left_bar_layout.insertWidget(self._left_bar_button_group.buttons().__len__() - 1, chatbot_button)
+        # the add button is the first one
+        self._left_bar_layout.insertWidget(index + 1, chatbot_button)
+
+    def _reposition_chatbot(self, chatbot_id):
+        """
+        move the button of a changed chatbot to its place, the other buttons stay.
+        :param chatbot_id: the id of the changed chatbot
+        :return:
+        """
+        old_index, new_index = self._chatbot_data_list.reposition(chatbot_id)
+        if old_index == new_index:
+            return
+        chatbot_button = self._chatbot_button_list.pop(old_index)
+        self._chatbot_button_list.insert(new_index, chatbot_button)
+        self._left_bar_layout.removeWidget(chatbot_button)
+        self._left_bar_layout.insertWidget(new_index + 1, chatbot_button)
 
     def on_chatbot_update(self, data: ChatBotData):
         """
@@ -377,6 +466,7 @@ class AppGUI(FramelessMainWindow):
         :return:
         """
         self.ChatBotUpdated.emit(data)
+        self._reposition_chatbot(data.chatbot_id)
         QApplication.sendEvent(self, SaveDataEvent(AIChatEnum.DataType.ChatBot))
 
     def on_chatbot_thread_status_changed(self, chatbot_id, status):
@@ -426,6 +516,8 @@ class AppGUI(FramelessMainWindow):
         :param id_: the id of the chatbot to be deleted
         :return:
         """
+        # the button deletes itself
+        self._chatbot_button_list.pop(self._chatbot_data_list.index(id_))
         self._chatbot_data_list.remove(id_)
         if self._current_chatbot.chatbot_id == id_:
             self._current_chatbot = None
@@ -433,13 +525,45 @@ class AppGUI(FramelessMainWindow):
         QApplication.sendEvent(self, SaveDataEvent(AIChatEnum.DataType.ChatBot))
         QApplication.sendEvent(self, DeleteChatBotEvent(id_))
 
+    def _export_chatbot(self, id_):
+        """
+        export a chatbot with its histories and sounds into an archive
+        :param id_: the id of the chatbot to be exported
+        :return:
+        """
+        name = self._chatbot_data_list[id_].character.name
+        path = QFileDialog.getSaveFileName(self, 'Export ChatBot', f'./{name}.zip', 'Chat Archive (*.zip)')[0]
+        if path:
+            QApplication.sendEvent(self, ExportChatBotEvent(id_, path))
+
+    def _import_chatbot(self):
+        """
+        import a chatbot from an exported archive
+        :return:
+        """
+        path = QFileDialog.getOpenFileName(self, 'Import ChatBot', './', 'Chat Archive (*.zip)')[0]
+        if path:
+            QApplication.sendEvent(self, ImportChatBotEvent(path))
+
+    def add_imported_chatbot(self, data: ChatBotData):
+        """
+        add a chatbot which is imported and saved already
+        :param data: the data of the chatbot
+        :return:
+        """
+        index = self._chatbot_data_list.append(data)
+        self._add_chatbot_button(data, index)
+        if self._current_chatbot is None:
+            self.set_current_chatbot(data)
+        QApplication.sendEvent(self, SaveDataEvent(AIChatEnum.DataType.ChatBot))
+
     def _load_chatbots(self, chatbots_data):
         """
         load chatbots from data
         :param chatbots_data: the data of chatbots
         :return:
         """
-        if not chatbots_data.data:
+        if not chatbots_data:
             return
         for chatbot_data in chatbots_data:
             self._add_chatbot_button(chatbot_data)
@@ -453,8 +577,85 @@ class AppGUI(FramelessMainWindow):
         :return:
         """
         self._current_chatbot = chatbot
-        self._message_area.load_messages(self._config.user_config, self._current_chatbot,
-                                         self._current_chatbot.histories.latest().id_)
+        self._load_history(self._current_chatbot.histories.latest().id_)
+
+    def _search_message(self):
+        """
+        the slot for the search box
+        :return:
+        """
+        query = self._search_box.text().strip()
+        if query:
+            QApplication.sendEvent(self, SearchMessageEvent(query))
+
+    def show_search_results(self, hits):
+        """
+        show the search hits in a menu under the search box, choosing one jumps to the message.
+        :param hits: list of (chatbot_id, history_id, message_id), the latest first.
+        :return:
+        """
+        menu = QMenu(self)
+        for chatbot_id, history_id, message_id in hits:
+            # the index is updated in the background, the chatbot may be deleted just now
+            if chatbot_id not in self._chatbot_data_list:
+                continue
+            chatbot = self._chatbot_data_list[chatbot_id]
+            if not chatbot.has_history(history_id):
+                continue
+            # the history is not rehydrated, an archived message is read from the archive
+            message = chatbot.histories[history_id].get_message(message_id)
+            if message is None:
+                continue
+            text = ' '.join(message.message.split())
+            text = text if len(text) <= 40 else text[:40] + '...'
+            menu.addAction(f'{message.name}: {text}',
+                           lambda c=chatbot_id, h=history_id, m=message_id: self._jump_to_message(c, h, m))
+        if menu.isEmpty():
+            self.hint(AIChatEnum.HintType.Info, 'No message found.', self._right_bar, 2000)
+            return
+        menu.exec_(self._search_box.mapToGlobal(self._search_box.rect().bottomLeft()))
+
+    def _jump_to_message(self, chatbot_id, history_id, message_id):
+        """
+        show the history of a message, and scroll to the message.
+        :param chatbot_id: the id of the chatbot
+        :param history_id: the id of the history
+        :param message_id: the id of the message
+        :return:
+        """
+        if chatbot_id not in self._chatbot_data_list:
+            return
+        self._media_player.stop()
+        self._chatbot_button_list[self._chatbot_data_list.index(chatbot_id)].setChecked(True)
+        self._current_chatbot = self._chatbot_data_list[chatbot_id]
+        if self._current_chatbot.histories[history_id].is_loaded(message_id):
+            self._load_history(history_id)
+            message_container = self._message_area.get_message_container(
+                self._current_chatbot.histories[history_id].get_message(message_id))
+        else:
+            # an older message is shown with the messages around it, the ones after it are loaded on scrolling down
+            self._message_area_scroll_area.vScrollBar.releaseWidget()
+            message_container = self._message_area.load_message_window(self._config.user_config,
+                                                                       self._current_chatbot, history_id, message_id)
+        if message_container:
+            self._message_area_scroll_area.scrollToWidget(message_container)
+
+    def _load_later_messages(self):
+        """
+        load the later messages of the message window being shown.
+        :return:
+        """
+        if self._message_area.is_window_open():
+            self._message_area.load_later_messages()
+
+    def _load_earlier_messages(self):
+        """
+        load the earlier messages of the current history, and keep the scroll position.
+        :return:
+        """
+        if self._message_area.has_earlier_messages():
+            self._message_area_scroll_area.vScrollBar.holdPosition()
+            self._message_area.load_earlier_messages()
 
     def play_audio(self, path):
         """
@@ -504,6 +705,8 @@ class MessageArea(QWidget):
     stopPlayAudio = Signal()  # stop playing audio
     playAudio = Signal(MessageData)  # message data
     speakIt = Signal(str, MessageData)  # message data
+    # the count of the messages paged into a message window at once
+    _WINDOW_PAGE_SIZE = 50
 
     def __init__(self):
         super().__init__()
@@ -519,6 +722,13 @@ class MessageArea(QWidget):
         self._current_history_id = None
         self._current_play_audio = None
         self._greeting_message_container = None
+        self._streaming_message_container = None
+        self._user_config: UserConfigData | None = None
+        self._chatbot_data: ChatBotData | None = None
+        # a message window is shown, see load_message_window
+        self._is_window = False
+        self._window_open = False
+        self._has_earlier_window_messages = False
 
     def addWidget(self, widget):
         """
@@ -548,22 +758,115 @@ class MessageArea(QWidget):
                 'send_time': utils.get_current_time(),
                 'name': chatbot_data.character.name,
             }), settable=False)
-        # load history_list
+        # load the loaded messages of the history, the earlier ones are loaded when scrolling to the top
         self._current_history_id = history_id
-        history = chatbot_data.histories[history_id]
-        for message in history:
+        self._user_config = user_config
+        self._chatbot_data = chatbot_data
+        # an archived history only has its latest message loaded, get_history pages in the rest of the first page
+        history = chatbot_data.get_history(history_id)
+        for message in history.history_list:
             if message.is_user:
                 self.show_message(user_config, message)
             else:
                 self.show_message(chatbot_data.character, message)
 
+    def has_earlier_messages(self):
+        """
+        if the current history has earlier messages which are not shown yet.
+        :return: bool
+        """
+        if not self._chatbot_data or not self._chatbot_data.has_history(self._current_history_id):
+            return False
+        if self._is_window:
+            return self._has_earlier_window_messages
+        return self._chatbot_data.get_history(self._current_history_id).unloaded_count > 0
+
+    def load_message_window(self, user_config: UserConfigData, chatbot_data: ChatBotData, history_id, message_id):
+        """
+        show an unloaded message of a history with the messages around it, instead of loading all the messages after
+        it. The messages of the window are not loaded into the history, the earlier and the later ones are paged in on
+        scrolling, and the loaded messages of the history are shown when the window reaches them.
+        :param user_config: the user config data
+        :param chatbot_data: chatbot data
+        :param history_id: the id of the history
+        :param message_id: the id of the message
+        :return: the message container of the message, or None if it is not in the history.
+        """
+        self.clear_messages()
+        self._current_history_id = history_id
+        self._user_config = user_config
+        self._chatbot_data = chatbot_data
+        history = chatbot_data.histories[history_id]
+        message = history.get_message(message_id)
+        if message is None:
+            return None
+        earlier = history.get_earlier(message, self._WINDOW_PAGE_SIZE // 2)
+        later = history.get_later(message, self._WINDOW_PAGE_SIZE // 2)
+        self._is_window = True
+        self._has_earlier_window_messages = len(earlier) == self._WINDOW_PAGE_SIZE // 2
+        self._show_messages(earlier + [message] + later)
+        self._window_open = True
+        if len(later) < self._WINDOW_PAGE_SIZE // 2:
+            self._close_window()
+        return self.get_message_container(message)
+
+    def is_window_open(self):
+        """
+        if a message window is shown, which does not reach the loaded messages of the history yet.
+        :return: bool
+        """
+        return self._window_open
 
-    def show_message(self, sender_data: UserConfigData | CharacterData, message_data: MessageData, resendable=True, settable=True):
+    def load_later_messages(self):
+        """
+        load a page of the later messages of the message window at the bottom of the message area.
+        :return:
+        """
+        if not self._window_open:
+            return
+        history = self._chatbot_data.histories[self._current_history_id]
+        messages = history.get_later(self._message_container_list[-1].message_data, self._WINDOW_PAGE_SIZE)
+        self._show_messages(messages)
+        if len(messages) < self._WINDOW_PAGE_SIZE:
+            self._close_window()
+
+    def _show_messages(self, messages, index=None):
+        # insert from the latest one on the top, so every message goes on the top
+        for message in (reversed(messages) if index == 0 else messages):
+            sender_data = self._user_config if message.is_user else self._chatbot_data.character
+            self.show_message(sender_data, message, resendable=False, index=index)
+
+    def _close_window(self):
+        # the window reaches the loaded messages of the history, they follow it like in a loaded history
+        self._window_open = False
+        for message in self._chatbot_data.histories[self._current_history_id].history_list:
+            sender_data = self._user_config if message.is_user else self._chatbot_data.character
+            self.show_message(sender_data, message)
+
+    def load_earlier_messages(self):
+        """
+        load a page of the earlier messages of the current history on the top of the message area.
+        :return:
+        """
+        if not self.has_earlier_messages():
+            return
+        if self._is_window:
+            # the messages of a window are not loaded into the history
+            messages = self._chatbot_data.histories[self._current_history_id].get_earlier(
+                self._message_container_list[0].message_data, self._WINDOW_PAGE_SIZE)
+            self._has_earlier_window_messages = len(messages) == self._WINDOW_PAGE_SIZE
+        else:
+            messages = self._chatbot_data.get_history(self._current_history_id).load_more()
+        self._show_messages(messages, index=0)
+
+    def show_message(self, sender_data: UserConfigData | CharacterData, message_data: MessageData, resendable=True,
+                     settable=True, index=None):
         """
         show a message in the message area
         :param resendable: if the message is resendable
         :param sender_data: the sender of the data. It can be a user or a character.
         :param message_data: message data
+        :param index: the index in the message list to insert the message at, append it if None
         :return:
         """
         max_width = self.parent().parent().parent().parent().parent().parent().width() - 230
@@ -575,20 +878,61 @@ class MessageArea(QWidget):
             message_container.resendClicked.connect(self.resend_message)
             message_container.copyClicked.connect(lambda: self.copyMessage.emit(message_data.message))
             message_container.deleteClicked.connect(self.delete_message)
-            self._message_container_list.append(message_container)
+            if index is None:
+                self._message_container_list.append(message_container)
+            else:
+                self._message_container_list.insert(index, message_container)
         else:
             self._greeting_message_container = message_container
         # if not resendable, disable the resend button
         if not resendable:
             message_container.set_resendable(False)
-        # if the message list is more than 2, set the resend button disabled except the latest 2 history_list
-        if len(self._message_container_list) > 2:
-            self._message_container_list[-3].set_resendable(False)
-        # add the message container to the layout to show it
-        self.addWidget(message_container)
+        if index is None:
+            # if the message list is more than 2, set the resend button disabled except the latest 2 history_list
+            if len(self._message_container_list) > 2:
+                self._message_container_list[-3].set_resendable(False)
+            # add the message container to the layout to show it
+            self.addWidget(message_container)
+        else:
+            # the greeting message is always on the top
+            self._layout.insertWidget(index + (1 if self._greeting_message_container else 0), message_container)
         # when the window is resized, the max width of the message container should be changed
         self.parent().parent().parent().parent().parent().parent().Resized.connect(message_container.mainWindowResized)
 
+    def show_streaming_message(self, sender_data: CharacterData, chatbot_id, text):
+        """
+        show the reply being generated at the bottom, or add a chunk to it.
+        :param sender_data: the character generating the reply
+        :param chatbot_id: the id of the chatbot
+        :param text: the chunk of the reply
+        :return:
+        """
+        if self._streaming_message_container is None:
+            max_width = self.parent().parent().parent().parent().parent().parent().width() - 230
+            # only shown until the reply is done, then the message is shown as usual
+            message_data = MessageData(**{
+                'message': '',
+                'is_user': False,
+                'chatbot_id': chatbot_id,
+                'message_id': 'streaming',
+                'send_time': utils.get_current_time(),
+                'name': sender_data.name,
+            })
+            self._streaming_message_container = QMessageContainer(sender_data, message_data, max_width, False)
+            self.addWidget(self._streaming_message_container)
+            self.parent().parent().parent().parent().parent().parent().Resized.connect(
+                self._streaming_message_container.mainWindowResized)
+        self._streaming_message_container.append_text(text)
+
+    def end_streaming_message(self):
+        """
+        remove the reply being generated, when it is done or stopped.
+        :return:
+        """
+        if self._streaming_message_container:
+            self._streaming_message_container.deleteLater()
+            self._streaming_message_container = None
+
     def resend_message(self, message_data: MessageData):
         """
         resend a message
@@ -628,10 +972,14 @@ class MessageArea(QWidget):
         if self._greeting_message_container:
             self._greeting_message_container.deleteLater()
             self._greeting_message_container = None
+        self.end_streaming_message()
         for message_container in self._message_container_list:
             message_container.deleteLater()
         self._current_play_audio = None
         self._message_container_list.clear()
+        self._chatbot_data = None
+        self._is_window = False
+        self._window_open = False
 
     def set_play_status(self, message_data, is_playing):
         """
@@ -977,7 +1325,7 @@ class ChatBotSettingDialog(QInWindowDialog):
             }
         }
         if self._save_mode == AIChat.AddNewChatBotMode:
-            result['histories'] = [{'memory': {}, 'history_list': []}]
+            result['histories'] = [{'memory': '', 'history_list': []}]
         return result
 
     @property
@@ -1200,6 +1548,7 @@ class QMessageContainer(QWidget):
     deleteClicked = Signal(MessageData)
     resendClicked = Signal(MessageData)
     mainWindowResized = Signal(QSize)
+    RELAYOUT_INTERVAL = 50  # ms
 
     def __init__(self, sender_data: UserConfigData | CharacterData, message_data: MessageData, max_width, settable: bool = True):
         super().__init__()
@@ -1284,6 +1633,29 @@ class QMessageContainer(QWidget):
         self._main_layout.insertSpacerItem(0 if self._is_user else 2, self._spacer_item)
         self.set_max_width(max_width)
         self.mainWindowResized.connect(lambda size: self.set_max_width(size.width() - 230))
+        # the streamed text is gathered and laid out at most once per interval, not once per chunk
+        self._pending_text = ''
+        self._relayout_timer = QTimer(self)
+        self._relayout_timer.setSingleShot(True)
+        self._relayout_timer.setInterval(self.RELAYOUT_INTERVAL)
+        self._relayout_timer.timeout.connect(self._flush_text)
+
+    def append_text(self, text):
+        """
+        grow the message with a chunk of a streamed reply.
+        :param text: the chunk
+        :return:
+        """
+        self._pending_text += text
+        if not self._relayout_timer.isActive():
+            self._relayout_timer.start()
+
+    def _flush_text(self):
+        if not self._pending_text:
+            return
+        self._message_label.append_text(self._pending_text)
+        self._pending_text = ''
+        self.set_max_width(self.width())
 
     def set_play_status(self, is_playing: bool):
         if self._settable:
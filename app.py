@@ -7,6 +7,7 @@ from GUI import AppGUI
 from PySide6.QtWidgets import QApplication
 import sys
 
+import embedding_cache
 from data import DataLoader
 from event import MainWindowHintEvent
 from event_type import *
@@ -33,6 +34,9 @@ class App(QObject):
         self.data_loader = DataLoader()
         # install event filter
         self.data_loader.installEventFilter(self)
+        # write out the queued saves before the app quits
+        self.app.aboutToQuit.connect(self.data_loader.close)
+        self.app.aboutToQuit.connect(embedding_cache.cache.close)
         self.gui:AppGUI|None = None
         self.chatbot_factory:ChatBotFactory|None = None
 
@@ -63,6 +67,19 @@ class App(QObject):
             self.gui.onChatbotThreadStatusChanged.emit(event.chatbot_id, event.status)
         elif event.type() == StopChatbotThreadEventType:
             self.chatbot_factory.stopChatbot.emit(event.chatbot_id)
+        elif event.type() == SearchMessageEventType:
+            self.gui.show_search_results(self.data_loader.search(event.query))
+        elif event.type() == StreamMessageEventType:
+            self.gui.stream_message(event.history_id, event.chatbot_id, event.text, event.finished)
+        elif event.type() == SpeakSegmentEventType:
+            self.gui.queue_speech(event.history_id, event.path, event.index)
+        elif event.type() == ExportChatBotEventType:
+            self.data_loader.export_chatbot(event.chatbot_id, event.path)
+        elif event.type() == ImportChatBotEventType:
+            self.data_loader.import_chatbot(event.path)
+        elif event.type() == ChatBotImportedEventType:
+            self.gui.add_imported_chatbot(event.data)
+            self.chatbot_factory.create_chatbot(event.data)
         return super().eventFilter(obj, event)
 
     def event(self, e):
@@ -86,6 +103,7 @@ class App(QObject):
         self.gui.ConfigSaved.connect(self.chatbot_factory.configSaved)
         self.gui.stopChat.connect(self.chatbot_factory.stopChat)
         self.chatbot_factory.installEventFilter(self)
+        self.data_loader.resume_imports()
 
     @staticmethod
     def get_instance():
@@ -0,0 +1,118 @@
+import wave
+
+from PySide6.QtCore import QObject, QTimer, Signal
+from PySide6.QtMultimedia import QAudio, QAudioFormat, QAudioSink, QMediaDevices
+
+import utils
+
+# the sample format by the sample width of a wave file
+_SAMPLE_FORMATS = {1: QAudioFormat.UInt8, 2: QAudioFormat.Int16, 4: QAudioFormat.Int32}
+
+
+class AudioQueue(QObject):
+    """
+    Play wave files one after another without gaps: their samples are written into one audio stream as they are
+    queued, instead of starting a player for every file. A file of another format than the one playing starts a new
+    stream after the queued samples.
+    :param interval: int, how often the stream is filled, in milliseconds.
+    """
+    drained = Signal()  # all the queued files are played
+
+    def __init__(self, parent=None, interval=20):
+        super().__init__(parent)
+        self._sink: QAudioSink | None = None
+        self._device = None
+        self._format = None
+        self._volume = 1.0
+        self._pending = bytearray()
+        # the files queued after a file of another format, with their format
+        self._waiting: list[tuple[tuple, bytes]] = []
+        self._timer = QTimer(self)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self._fill)
+
+    def enqueue(self, path) -> None:
+        """
+        Queue a wave file after the ones playing.
+        :param path: str
+        :return:
+        """
+        try:
+            with wave.open(path, 'rb') as f:
+                format_ = (f.getnchannels(), f.getsampwidth(), f.getframerate())
+                frames = f.readframes(f.getnframes())
+        except (OSError, wave.Error) as e:
+            utils.warn(f'Play {path} failed: {e}')
+            return
+        if format_[1] not in _SAMPLE_FORMATS:
+            utils.warn(f'Play {path} failed: {format_[1] * 8}-bit samples are not supported.')
+            return
+        if self._sink is None:
+            self._start(format_)
+        if format_ == self._format and not self._waiting:
+            self._pending += frames
+        else:
+            self._waiting.append((format_, frames))
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def clear(self) -> None:
+        """
+        Stop playing, and forget the queued files.
+        :return:
+        """
+        self._timer.stop()
+        self._pending.clear()
+        self._waiting.clear()
+        self._stop_sink()
+
+    def set_volume(self, volume) -> None:
+        """
+        :param volume: float, from 0 to 1.
+        :return:
+        """
+        self._volume = volume
+        if self._sink:
+            self._sink.setVolume(volume)
+
+    def _start(self, format_):
+        self._stop_sink()
+        audio_format = QAudioFormat()
+        audio_format.setChannelCount(format_[0])
+        audio_format.setSampleFormat(_SAMPLE_FORMATS[format_[1]])
+        audio_format.setSampleRate(format_[2])
+        self._format = format_
+        self._sink = QAudioSink(QMediaDevices.defaultAudioOutput(), audio_format, self)
+        self._sink.setVolume(self._volume)
+        # push mode, the samples are written by _fill
+        self._device = self._sink.start()
+
+    def _stop_sink(self):
+        if self._sink:
+            self._sink.stop()
+            self._sink.deleteLater()
+        self._sink = None
+        self._device = None
+        self._format = None
+
+    def _fill(self):
+        if self._pending:
+            size = min(len(self._pending), self._sink.bytesFree())
+            if size > 0:
+                written = self._device.write(bytes(self._pending[:size]))
+                if written > 0:
+                    del self._pending[:written]
+            return
+        # wait until the written samples are played
+        if self._sink and self._sink.state() == QAudio.State.ActiveState:
+            return
+        if self._waiting:
+            format_ = self._waiting[0][0]
+            if format_ != self._format:
+                self._start(format_)
+            # the files of the same format go into the stream together
+            while self._waiting and self._waiting[0][0] == format_:
+                self._pending += self._waiting.pop(0)[1]
+            return
+        self._timer.stop()
+        self.drained.emit()
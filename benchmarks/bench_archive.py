@@ -0,0 +1,131 @@
+"""
+Measure what archiving the idle histories saves on a synthetic json save: the load time, the memory held after the
+load, and the time of a compaction which rewrites every chatbot shard. 4 of the 5 histories of every chatbot are idle.
+
+    python benchmarks/bench_archive.py --messages 1000000
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+
+def make_chatbots(message_count, chatbot_count=20, history_count=5):
+    per_history = max(message_count // (chatbot_count * history_count), 1)
+    chatbots = []
+    for chatbot_index in range(chatbot_count):
+        chatbot_id = f'CB{chatbot_index:06d}'
+        histories = []
+        for history_index in range(history_count):
+            # the last history of every chatbot is the one in use
+            start = datetime.datetime(2023, 6, 1) if history_index == history_count - 1 else \
+                datetime.datetime(2020, 1, 1 + history_index)
+            history_list = []
+            for message_index in range(per_history):
+                send_time = start + datetime.timedelta(seconds=message_index * 30)
+                history_list.append({
+                    'message_id': f'MS{chatbot_index:04d}{history_index:04d}{message_index:08d}',
+                    'chatbot_id': chatbot_id,
+                    'message': f'这是第{message_index}条消息, message number {message_index} of this history.',
+                    'send_time': send_time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'is_user': message_index % 2 == 0,
+                    'name': 'user' if message_index % 2 == 0 else 'assistant',
+                })
+            histories.append({'history_id': f'HD{chatbot_index:04d}{history_index:04d}', 'memory': '',
+                              'history_list': history_list})
+        chatbots.append({'chatbot_id': chatbot_id, 'gpt_params': {'model': 'gpt-3.5-turbo'},
+                         'character': {'name': f'bot {chatbot_index}'}, 'histories': histories})
+    return chatbots
+
+
+def measure_load(directory):
+    """
+    :return: (load seconds, MB held by the storage and the loaded data)
+    """
+    json_storage = storage.JsonStorage(directory)
+    begin = time.perf_counter()
+    json_storage.load(tail_size=50)
+    load_time = time.perf_counter() - begin
+    json_storage.close()
+    del json_storage
+    tracemalloc.start()
+    json_storage = storage.JsonStorage(directory)
+    data = json_storage.load(tail_size=50)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    json_storage.close()
+    del data, json_storage
+    return load_time, memory / 1024 / 1024
+
+
+def measure_compaction(directory, chatbots):
+    """
+    Change every chatbot once, and roll the journal into the shards.
+    :return: compaction seconds
+    """
+    json_storage = storage.JsonStorage(directory, compact_threshold=1_000_000)
+    json_storage.load(tail_size=50)
+    for chatbot in chatbots:
+        json_storage.apply([{'op': 'chatbot', 'chatbot': {
+            'chatbot_id': chatbot['chatbot_id'], 'gpt_params': chatbot['gpt_params'],
+            'character': chatbot['character'],
+            'histories': [{'history_id': history['history_id'], 'memory': 'changed'}
+                          for history in chatbot['histories']]}}])
+    begin = time.perf_counter()
+    json_storage.compact()
+    json_storage.close()
+    return time.perf_counter() - begin
+
+
+def shard_size(directory):
+    shard_path = os.path.join(directory, 'chatbots')
+    return sum(os.path.getsize(os.path.join(shard_path, name)) for name in os.listdir(shard_path)) / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    args = parser.parse_args()
+    chatbots = make_chatbots(args.messages)
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        json_storage = storage.JsonStorage(directory, compact_threshold=1_000_000)
+        json_storage.load()
+        json_storage.apply([{'op': 'chatbot', 'chatbot': chatbot} for chatbot in chatbots])
+        json_storage.compact()
+        json_storage.close()
+        rows.append(('hot', *measure_load(directory), measure_compaction(directory, chatbots), shard_size(directory)))
+
+        json_storage = storage.JsonStorage(directory, compact_threshold=1_000_000)
+        json_storage.load(tail_size=50)
+        records = []
+        for chatbot in chatbots:
+            for history in chatbot['histories'][:-1]:
+                latest = history['history_list'][-1]
+                records.append({'op': 'archive', 'chatbot_id': chatbot['chatbot_id'],
+                                'history_id': history['history_id'], 'before': list(storage.message_order_key(latest))})
+        begin = time.perf_counter()
+        json_storage.apply(records)
+        archive_time = time.perf_counter() - begin
+        json_storage.compact()
+        stats = json_storage.archive_stats
+        json_storage.close()
+        rows.append(('archived', *measure_load(directory), measure_compaction(directory, chatbots),
+                     shard_size(directory)))
+    del chatbots
+    print(f'{args.messages} messages, {stats["messages"]} archived in {archive_time:.2f}s: '
+          f'{stats["json_bytes"] / 1024 / 1024:.1f}MB of json in {stats["archive_bytes"] / 1024 / 1024:.1f}MB')
+    print(f'{"save":<10}{"load (s)":>10}{"memory (MB)":>13}{"compaction (s)":>16}{"shards (MB)":>13}')
+    for name, load_time, memory, compaction_time, size in rows:
+        print(f'{name:<10}{load_time:>10.2f}{memory:>13.1f}{compaction_time:>16.2f}{size:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
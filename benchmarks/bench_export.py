@@ -0,0 +1,93 @@
+"""
+Measure the export and import throughput of a chatbot, in messages per second, on both storages. One message in 20
+has a sound.
+
+    python benchmarks/bench_export.py --messages 200000
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exporter
+import storage
+
+
+def make_chatbot(message_count, history_count=4):
+    per_history = max(message_count // history_count, 1)
+    histories = []
+    for history_index in range(history_count):
+        start = datetime.datetime(2023, 1, 1 + history_index)
+        history_list = []
+        for message_index in range(per_history):
+            send_time = start + datetime.timedelta(seconds=message_index)
+            history_list.append({
+                'message_id': f'MS{history_index:04d}{message_index:08d}',
+                'chatbot_id': 'CB000000',
+                'message': f'这是第{message_index}条消息, message number {message_index} of this history.',
+                'send_time': send_time.strftime('%Y-%m-%d %H:%M:%S'),
+                'is_user': message_index % 2 == 0,
+                'name': 'user' if message_index % 2 == 0 else 'assistant',
+            })
+        histories.append({'history_id': f'HD{history_index:04d}', 'memory': '', 'history_list': history_list})
+    character = {'character_id': 'CH000000', 'name': 'bot', 'avatar_path': '', 'personality': '', 'description': '',
+                 'greeting': '', 'prompt': ''}
+    return {'chatbot_id': 'CB000000', 'gpt_params': {'model': 'gpt-3.5-turbo'}, 'character': character,
+            'histories': histories}
+
+
+def make_sounds(chatbot, sound_path):
+    # about a second of 16-bit 22kHz mono wave
+    sound = b'RIFF' + os.urandom(44100)
+    for history in chatbot['histories']:
+        for message in history['history_list'][::20]:
+            with open(os.path.join(sound_path, f'{message["message_id"]}.wav'), 'wb') as f:
+                f.write(sound)
+
+
+def measure(storage_class, chatbot, directory, sound_path):
+    """
+    :return: (export stats, import stats, archive MB)
+    """
+    source_path = os.path.join(directory, 'source')
+    source = storage_class(source_path)
+    source.load()
+    source.apply([{'op': 'chatbot', 'chatbot': chatbot}])
+    meta = {'chatbot_id': chatbot['chatbot_id'], 'gpt_params': chatbot['gpt_params'],
+            'character': chatbot['character'],
+            'histories': [{'history_id': history['history_id'], 'memory': history['memory']}
+                          for history in chatbot['histories']]}
+    archive_path = os.path.join(directory, 'chatbot.zip')
+    export_stats = exporter.export_chatbot(source, meta, archive_path, sound_path)
+    source.close()
+
+    target_path = os.path.join(directory, 'target')
+    target = storage_class(target_path)
+    target.load()
+    importer = exporter.ChatBotImporter(target.apply, os.path.join(target_path, 'imports'),
+                                        os.path.join(target_path, 'sounds'), os.path.join(target_path, 'avatars'))
+    import_stats = importer.run(archive_path)[1]
+    target.close()
+    return export_stats, import_stats, os.path.getsize(archive_path) / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200_000)
+    args = parser.parse_args()
+    chatbot = make_chatbot(args.messages)
+    print(f'{"storage":<10}{"export (msg/s)":>16}{"import (msg/s)":>16}{"sounds":>8}{"archive (MB)":>14}')
+    with tempfile.TemporaryDirectory() as sound_path:
+        make_sounds(chatbot, sound_path)
+        for name, storage_class in (('json', storage.JsonStorage), ('sqlite', storage.SQLiteStorage)):
+            with tempfile.TemporaryDirectory() as directory:
+                export_stats, import_stats, size = measure(storage_class, chatbot, directory, sound_path)
+            print(f'{name:<10}{export_stats["messages_per_second"]:>16.0f}{import_stats["messages_per_second"]:>16.0f}'
+                  f'{export_stats["sounds"]:>8}{size:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure the latency of sequential requests sent one by one with requests.get, and with the kept connections of
+HTTPPool, and the handshakes they pay. A local keep-alive server is used unless a url is given; a remote https url
+shows the saving of the TLS handshakes.
+
+    python benchmarks/bench_http_pool.py --requests 200
+    python benchmarks/bench_http_pool.py --requests 20 --url https://fanyi-api.baidu.com/api/trans/vip/translate
+"""
+import argparse
+import http.server
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from http_pool import HTTPPool
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written apart, do not wait for the ack of the headers
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        pass
+
+
+def measure(send, count):
+    latencies = []
+    for _ in range(count):
+        begin = time.perf_counter()
+        send()
+        latencies.append((time.perf_counter() - begin) * 1000)
+    return statistics.mean(latencies), statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--url')
+    args = parser.parse_args()
+    server = None
+    url = args.url
+    if url is None:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}/'
+
+    fresh_mean, fresh_median = measure(lambda: requests.get(url, timeout=30), args.requests)
+    pool = HTTPPool()
+    pool_mean, pool_median = measure(lambda: pool.get('bench', url), args.requests)
+    metrics = pool.get_metrics()['bench']
+    print(f'{"session":<14}{"mean (ms)":>12}{"median (ms)":>14}{"handshakes":>12}{"handshake (ms)":>16}')
+    print(f'{"per request":<14}{fresh_mean:>12.2f}{fresh_median:>14.2f}{args.requests:>12}{"":>16}')
+    print(f'{"pooled":<14}{pool_mean:>12.2f}{pool_median:>14.2f}{metrics["handshakes"]:>12}'
+          f'{metrics["handshake_seconds"] * 1000:>16.2f}')
+    pool.close()
+    if server:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Compare the memory and throughput of MessageData with the string send time it had before.
+The legacy class below is the MessageData of that version, with its strptime comparisons and re-sorting appends.
+
+    python benchmarks/bench_message.py --messages 100000
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+from functools import total_ordering
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import MessageData, HistoryData
+
+
+@total_ordering
+class LegacyMessageData:
+    def __init__(self, **kwargs):
+        self._chatbot_id = kwargs['chatbot_id']
+        self._message = kwargs['message']
+        self._send_time = kwargs['send_time']
+        self._is_user = kwargs['is_user']
+        self._name = kwargs['name']
+        self._id = kwargs['message_id']
+
+    def __lt__(self, other):
+        self_send_time = datetime.datetime.strptime(self._send_time, '%Y-%m-%d %H:%M:%S')
+        other_send_time = datetime.datetime.strptime(other.send_time, '%Y-%m-%d %H:%M:%S')
+        return self_send_time < other_send_time
+
+    def __eq__(self, other):
+        return self._id == other.message_id
+
+    def __hash__(self):
+        return hash(self._id)
+
+    message_id = property(lambda self: self._id)
+    send_time = property(lambda self: self._send_time)
+
+
+def make_messages(count):
+    start = datetime.datetime(2023, 1, 1)
+    for index in range(count):
+        yield {
+            'message_id': f'ME{index:010d}',
+            # build the repeated strings every time, like a json load does
+            'chatbot_id': ''.join(['CB', '0123456789ABCDEF']),
+            'message': f'message number {index}',
+            'send_time': (start + datetime.timedelta(seconds=index * 7)).strftime('%Y-%m-%d %H:%M:%S'),
+            'is_user': index % 2 == 0,
+            'name': ''.join(['assis', 'tant']) if index % 2 else ''.join(['M', 'e']),
+        }
+
+
+def measure_build(message_class, message_dicts):
+    begin = time.perf_counter()
+    messages = [message_class(**message) for message in message_dicts]
+    return messages, time.perf_counter() - begin
+
+
+def measure_memory(message_class, count):
+    # the dicts are dropped after each message, like after a load, so only what the messages keep is counted
+    tracemalloc.start()
+    messages = [message_class(**message) for message in make_messages(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del messages
+    return size
+
+
+def measure_sort(messages):
+    shuffled = messages[1::2] + messages[::2]
+    begin = time.perf_counter()
+    shuffled.sort()
+    return time.perf_counter() - begin
+
+
+def legacy_append(message_list, message):
+    message_list.append(message)
+    message_list.sort()
+
+
+def measure_append(append, history, messages):
+    begin = time.perf_counter()
+    for message in messages:
+        append(history, message)
+    return (time.perf_counter() - begin) / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--legacy-appends', type=int, default=20,
+                        help='appends to time for the legacy class, each one re-sorts the whole history')
+    args = parser.parse_args()
+    message_dicts = list(make_messages(args.messages + 1000))
+    loaded, appended = message_dicts[:args.messages], message_dicts[args.messages:]
+
+    legacy_size = measure_memory(LegacyMessageData, args.messages)
+    current_size = measure_memory(MessageData, args.messages)
+    legacy, legacy_build = measure_build(LegacyMessageData, loaded)
+    current, current_build = measure_build(MessageData, loaded)
+    legacy_sort = measure_sort(legacy)
+    current_sort = measure_sort(current)
+    legacy_append_time = measure_append(legacy_append, list(legacy),
+                                        [LegacyMessageData(**m) for m in appended[:args.legacy_appends]])
+    history = HistoryData(history_id='HDBENCH', history_list=current)
+    current_append_time = measure_append(HistoryData.append, history, [MessageData(**m) for m in appended])
+
+    print(f'{args.messages} messages')
+    print(f'{"":<24}{"legacy":>14}{"current":>14}')
+    print(f'{"memory (MB)":<24}{legacy_size / 1024 / 1024:>14.1f}{current_size / 1024 / 1024:>14.1f}')
+    print(f'{"build (messages/s)":<24}{args.messages / legacy_build:>14.0f}{args.messages / current_build:>14.0f}')
+    print(f'{"sort (s)":<24}{legacy_sort:>14.3f}{current_sort:>14.3f}')
+    print(f'{"append (us/message)":<24}{legacy_append_time * 1e6:>14.0f}{current_append_time * 1e6:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
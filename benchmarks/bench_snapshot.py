@@ -0,0 +1,103 @@
+"""
+Compare the snapshot codecs on a synthetic save: save time, load time and size.
+The save is sharded like JsonStorage writes it, an index file and one shard per chatbot, and it is loaded by
+JsonStorage, which reads the shards in parallel. The legacy row is the single file of utils.save_json /
+utils.load_json, which the save used before the codecs and the shards.
+
+    python benchmarks/bench_snapshot.py --messages 1000000
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+import storage
+from AIChatEnum import SnapshotCodec
+
+
+def make_data(message_count, chatbot_count=20, history_count=5):
+    start = datetime.datetime(2023, 1, 1)
+    chatbots = []
+    per_history = max(message_count // (chatbot_count * history_count), 1)
+    for chatbot_index in range(chatbot_count):
+        chatbot_id = f'CB{chatbot_index:06d}'
+        histories = []
+        for history_index in range(history_count):
+            history_list = []
+            for message_index in range(per_history):
+                send_time = start + datetime.timedelta(seconds=message_index * 30)
+                history_list.append({
+                    'message_id': f'MS{chatbot_index:04d}{history_index:04d}{message_index:08d}',
+                    'chatbot_id': chatbot_id,
+                    'message': f'这是第{message_index}条消息, message number {message_index} of this history.',
+                    'send_time': send_time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'is_user': message_index % 2 == 0,
+                    'name': 'user' if message_index % 2 == 0 else 'assistant',
+                })
+            histories.append({'history_id': f'HD{chatbot_index:04d}{history_index:04d}', 'memory': '',
+                              'history_list': history_list})
+        chatbots.append({'chatbot_id': chatbot_id, 'gpt_params': {'model': 'gpt-3.5-turbo'},
+                         'character': {'name': f'bot {chatbot_index}'}, 'histories': histories})
+    return {'config': {}, 'chatbots': chatbots}
+
+
+def save_sharded(directory, data, codec, shard_dir='chatbots'):
+    """
+    Write the save like JsonStorage does, the shards first and the index last.
+    """
+    os.makedirs(os.path.join(directory, shard_dir), exist_ok=True)
+    for chatbot in data['chatbots']:
+        storage.save_snapshot(os.path.join(directory, shard_dir, f'{chatbot["chatbot_id"]}.json'), chatbot, codec)
+    storage.save_snapshot(os.path.join(directory, 'save.json'),
+                          {'config': data['config'],
+                           'chatbot_ids': [chatbot['chatbot_id'] for chatbot in data['chatbots']]}, codec)
+
+
+def load_sharded(directory):
+    json_storage = storage.JsonStorage(directory)
+    data = json_storage.load()
+    json_storage.close()
+    return data
+
+
+def get_size(directory):
+    return sum(os.path.getsize(os.path.join(root, file_name)) for root, _, files in os.walk(directory)
+               for file_name in files)
+
+
+def measure(function, *args):
+    begin = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - begin, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    args = parser.parse_args()
+    data = make_data(args.messages)
+    with tempfile.TemporaryDirectory() as directory:
+        rows = []
+        path = os.path.join(directory, 'legacy.json')
+        save_time, _ = measure(utils.save_json, path, data)
+        load_time, _ = measure(utils.load_json, path)
+        rows.append(('legacy save_json', save_time, load_time, os.path.getsize(path)))
+        for codec in SnapshotCodec:
+            path = os.path.join(directory, codec.name)
+            save_time, _ = measure(save_sharded, path, data, codec)
+            load_time, loaded = measure(load_sharded, path)
+            assert loaded['chatbots'] == data['chatbots']
+            rows.append((codec.name, save_time, load_time, get_size(path)))
+    print(f'{args.messages} messages')
+    print(f'{"codec":<18}{"save (s)":>10}{"load (s)":>10}{"size (MB)":>12}')
+    for name, save_time, load_time, size in rows:
+        print(f'{name:<18}{save_time:>10.2f}{load_time:>10.2f}{size / 1024 / 1024:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
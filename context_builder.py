@@ -0,0 +1,177 @@
+import functools
+import re
+
+import utils
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# the context windows of the chat models, matched by the longest prefix of the model name
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# every chat message is wrapped in a few tokens of the chat format, and the reply is primed with a few more
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+MEMORY_PROMPT = '以下是你对之前对话的记忆：\n{memory}'
+
+# kana, Han and hangul are about a token per character, the other text about four characters per token
+_CJK = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]')
+
+
+def get_context_window(model) -> int:
+    """
+    The count of tokens a model takes, the prompt and the reply together.
+    :param model: str, the model name, e.g. 'gpt-3.5-turbo-0613'.
+    :return: int
+    """
+    names = [name for name in MODEL_CONTEXT_WINDOWS if model.startswith(name)]
+    return MODEL_CONTEXT_WINDOWS[max(names, key=len)] if names else DEFAULT_CONTEXT_WINDOW
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def get_tokenizer_name(model) -> str:
+    """
+    The name of the tokenizer counting the tokens for a model, token counts of the same tokenizer can be reused.
+    :param model: str
+    :return: str
+    """
+    encoding = _get_encoding(model)
+    return encoding.name if encoding else 'estimate'
+
+
+def count_tokens(text, model) -> int:
+    """
+    Count the tokens of a text. Without tiktoken installed, the count is estimated from the characters.
+    :param text: str
+    :param model: str
+    :return: int
+    """
+    encoding = _get_encoding(model)
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk_count = len(_CJK.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+
+def count_message_tokens(text, model) -> int:
+    """
+    Count the tokens a chat message takes in the prompt.
+    :param text: str, the content of the message.
+    :param model: str
+    :return: int
+    """
+    return count_tokens(text, model) + MESSAGE_OVERHEAD
+
+
+def get_budget(gpt_params, limit_token=None) -> int:
+    """
+    The count of tokens the prompt may take: what the model window leaves for it after the reply, and at most
+    limit_token.
+    :param gpt_params: GPTParamsData
+    :param limit_token: int, [optional] the max count of tokens of the prompt.
+    :return: int
+    """
+    budget = get_context_window(gpt_params.model) - gpt_params.max_tokens - REPLY_OVERHEAD
+    return budget if limit_token is None else min(budget, limit_token)
+
+
+def _iter_unsummarized(history, page_size=50):
+    """
+    Iterate the messages of a history which are not folded into the memory, the latest first. The older pages are read
+    without loading them into the history, see HistoryData.iter_latest.
+    """
+    for message in history.iter_latest(page_size):
+        if history.is_summarized(message):
+            return
+        yield message
+
+
+def build_context(prompt, history, gpt_params, limit_token=None) -> list[dict]:
+    """
+    Build the messages of a chat request: the system prompt, the memory of the history if there is one, and the
+    latest messages of the history which fit into the token budget, see get_budget. The messages folded into the memory
+    are not sent again. The messages are added from the latest one until the next one does not fit. The latest message
+    is always sent. The token count of every message is counted once and cached with the message.
+    :param prompt: str, the system prompt.
+    :param history: HistoryData
+    :param gpt_params: GPTParamsData
+    :param limit_token: int, [optional] the max count of tokens of the prompt.
+    :return: list of dict, the messages in the chat format.
+    """
+    model = gpt_params.model
+    budget = get_budget(gpt_params, limit_token)
+    used = count_message_tokens(prompt, model)
+    memory = MEMORY_PROMPT.format(memory=history.memory) if history.memory else None
+    if memory:
+        used += count_message_tokens(memory, model)
+    messages = []
+    for message in _iter_unsummarized(history):
+        tokens = message.get_token_count(model)
+        if messages and used + tokens > budget:
+            break
+        used += tokens
+        messages.append({
+            'role': 'user' if message.is_user else 'assistant',
+            'content': message.message
+        })
+    # the system messages are not counted
+    history_count = len(messages)
+    if memory:
+        messages.append({'role': 'system', 'content': memory})
+    messages.append({'role': 'system', 'content': prompt})
+    messages.reverse()
+    utils.debug(f'Context of {history_count} messages, {used} of {budget} tokens.')
+    return messages
+
+
+def get_summary_batch(history, model, threshold, keep_tokens, max_tokens) -> list:
+    """
+    Choose the messages to fold into the memory next. Nothing is folded until the messages after the memory take more
+    than threshold tokens, then the oldest of them are, leaving the latest keep_tokens of messages as they are. At most
+    max_tokens of messages are folded at once, the rest are left to the next time. The messages more than threshold +
+    max_tokens tokens back are not read, so a long history which was never summarized is summarized from there, and
+    the older messages are left out of the memory.
+    :param history: HistoryData
+    :param model: str
+    :param threshold: int
+    :param keep_tokens: int
+    :param max_tokens: int
+    :return: list of MessageData, the oldest first, or an empty list if nothing is to fold.
+    """
+    tail = []
+    total = 0
+    for message in _iter_unsummarized(history):
+        if total > threshold + max_tokens:
+            break
+        tail.append(message)
+        total += message.get_token_count(model)
+    if total <= threshold:
+        return []
+    kept = 0
+    while tail and kept + tail[0].get_token_count(model) <= keep_tokens:
+        kept += tail.pop(0).get_token_count(model)
+    batch = []
+    batch_tokens = 0
+    for message in reversed(tail):
+        tokens = message.get_token_count(model)
+        if batch and batch_tokens + tokens > max_tokens:
+            break
+        batch.append(message)
+        batch_tokens += tokens
+    return batch
@@ -1,5 +1,9 @@
+import bisect
+import collections
 import datetime
 import os
+import sys
+import threading
 from functools import total_ordering
 from typing import Iterable, Iterator
 
@@ -7,9 +11,13 @@ from PySide6.QtCore import QObject
 from PySide6.QtWidgets import QApplication
 
 import AIChatEnum
+import context_builder
+import exporter
 import event
 import utils
-from AIChatEnum import TranslaterAPIType
+import search
+import storage
+from AIChatEnum import TranslaterAPIType, DataChangeType, StorageType
 
 
 def load_data(path) -> dict:
@@ -32,22 +40,52 @@ def save_data(data, path):
 
 
 class DataLoader(QObject):
-    def __init__(self, data_path='./save', data_file='save.json'):
+    """
+    Load and save the app data.
+    :param data_path: the save directory.
+    :param data_file: the json save file name.
+    :param db_file: the sqlite save file name.
+    :param storage_type: StorageType, [optional] the storage to use, sqlite if it is None. Choosing sqlite while there
+    is only a json save migrates the json save into the database, so an existing install moves to sqlite on its next
+    start.
+    :param tail_size: int, how many of the latest messages of every history are loaded at startup, the older ones are
+    paged in on demand.
+    :param coalesce_window: float, seconds to gather a burst of saves into one write. The changes are turned into
+    records here, and written by a background writer.
+    :param snapshot_codec: SnapshotCodec, [optional] the snapshot format of the json storage, see
+    storage.encode_snapshot. If it is None, keep the format of the existing snapshot.
+    :param archive_after_days: int, [optional] the histories idle for longer are moved into the archive after loading,
+    see archive_idle_histories. If it is None, nothing is archived.
+    """
+
+    def __init__(self, data_path='./save', data_file='save.json', db_file='save.db', storage_type=None, tail_size=50,
+                 coalesce_window=0.5, snapshot_codec=None, archive_after_days=30):
         super().__init__()
-        self._data = None
+        self._tail_size = tail_size
+        self._archive_after_days = archive_after_days
         self._chatbots_data = None
         self._config_data = None
         self._data_path = data_path
         self._data_file = data_file
-        if not os.path.exists(data_path):
-            os.mkdir(data_path)
-        if not os.path.exists(os.path.join(data_path, data_file)):
-            utils.save_json(os.path.join(data_path, data_file), {})
+        has_database = os.path.exists(os.path.join(data_path, db_file))
+        if storage_type is None:
+            storage_type = StorageType.SQLite
+        match storage_type:
+            case StorageType.SQLite if not has_database and os.path.exists(os.path.join(data_path, data_file)):
+                self._storage = storage.migrate_json_to_sqlite(data_path, data_file, db_file)
+            case StorageType.SQLite:
+                self._storage = storage.SQLiteStorage(data_path, db_file)
+            case _:
+                self._storage = storage.JsonStorage(data_path, data_file, codec=snapshot_codec)
+        self._search_index = search.SearchIndex(data_path)
+        self._writer = storage.SaveWriter(self._storage, coalesce_window, indexes=[self._search_index])
+        self._importer = exporter.ChatBotImporter(self._save_records, os.path.join(data_path, 'imports'),
+                                                  tail_size=tail_size)
 
     def load_data(self):
-        self._data = load_data(os.path.join(self._data_path, self._data_file))
+        data = self._storage.load(self._tail_size)
         # if there is no 'config' key, emit a config init signal
-        if 'config' not in self._data:
+        if 'config' not in data:
             first_time = True
             self._config_data = ConfigData({
                 'user_config': {
@@ -111,44 +149,264 @@ class DataLoader(QObject):
             })
         else:
             first_time = False
-            self._config_data = ConfigData(self._data['config'])
-        if 'chatbots' not in self._data:
-            self._data['chatbots'] = []
-        chatbots_data = self._data['chatbots']
+            self._config_data = ConfigData(data['config'])
         self._chatbots_data = ChatBotDataList([])
-        if chatbots_data:
-            for chatbot_data in chatbots_data:
-                self._chatbots_data.append(ChatBotData(**chatbot_data))
+        # a chatbot being imported is loaded when its import is done, see resume_imports
+        chatbots = [chatbot_data for chatbot_data in data.get('chatbots', [])
+                    if not self._importer.is_unfinished(chatbot_data['chatbot_id'])]
+        if not self._search_index.is_built():
+            # the message dicts are turned into MessageData below, keep the loaded tails for the rebuild
+            tails = [(chatbot_data['chatbot_id'], history['history_id'], list(history['history_list']))
+                     for chatbot_data in chatbots for history in chatbot_data['histories']]
+            threading.Thread(target=self._rebuild_search_index, args=(tails,), daemon=True).start()
+        for chatbot_data in chatbots:
+            for history in chatbot_data['histories']:
+                history['pager'] = storage.HistoryPager(self._storage, chatbot_data['chatbot_id'],
+                                                        history['history_id'])
+            self._chatbots_data.append(ChatBotData(**chatbot_data))
+        # the loaded chatbots are already saved
+        self._chatbots_data.change_log.clear()
+        for chatbot in self._chatbots_data:
+            chatbot.mark_saved()
         self._chatbots_data.sort()
+        if self._archive_after_days is not None:
+            self.archive_idle_histories(self._archive_after_days)
         QApplication.sendEvent(self, event.DataLoadedEvent(self._config_data, self._chatbots_data, first_time))
 
+    def _rebuild_search_index(self, tails):
+        try:
+            if self._search_index.rebuild(search.iter_saved_messages(self._storage, tails)):
+                utils.info('The search index is rebuilt.')
+        except Exception as e:
+            utils.info(f'Rebuild the search index failed: {e}')
+
+    def search(self, query, limit=50, chatbot_id=None) -> list[tuple[str, str, str]]:
+        """
+        Search the messages of the chatbots, see search.SearchIndex.search.
+        :param query: str
+        :param limit: int, the max count of hits.
+        :param chatbot_id: str, [optional] only search the messages of this chatbot.
+        :return: list of (chatbot_id, history_id, message_id), the latest first.
+        """
+        return self._search_index.search(query, limit, chatbot_id)
+
+    def archive_idle_histories(self, idle_days) -> int:
+        """
+        Move the messages of the histories idle for idle_days into the archive of the storage, except the latest
+        message of every history, which is left as a stub. The latest history of a chatbot is never archived. The
+        archive files are written by the save writer in the background, see storage.HistoryArchive.
+        :param idle_days: int
+        :return: int, the count of the histories to archive.
+        """
+        deadline = parse_send_time(utils.get_current_time()) - idle_days * 24 * 60 * 60
+        records = []
+        for chatbot in self._chatbots_data:
+            latest_history = chatbot.histories.latest()
+            for history in chatbot.histories:
+                message = history.latest()
+                if history is latest_history or history.dirty or message is None or message.timestamp > deadline:
+                    continue
+                # nothing is left to archive besides the stub message
+                if len(history) - history.archived_count <= 1:
+                    continue
+                before = [message.send_time, message.message_id]
+                records.append({'op': 'archive', 'chatbot_id': chatbot.chatbot_id, 'history_id': history.history_id,
+                                'before': before})
+                # all the messages but the stub, so deleting one of them from now on restores the history
+                history.set_archive({'count': len(history) - 1, 'before': before})
+        self._writer.submit(records)
+        return len(records)
+
+    def get_archive_stats(self) -> dict:
+        """
+        The savings of the archive since the start.
+        :return: dict, {'histories': int, 'messages': int, 'json_bytes': int, 'archive_bytes': int}, json_bytes of the
+        archived messages are neither kept in memory nor written with the save any more.
+        """
+        return self._storage.archive_stats
+
+    def export_chatbot(self, chatbot_id, path) -> None:
+        """
+        Export a chatbot into an archive in the background, see exporter.export_chatbot.
+        :param chatbot_id: str
+        :param path: the archive path.
+        :return:
+        """
+        self.flush()
+        chatbot = self._chatbots_data[chatbot_id].get_meta_data()
+        threading.Thread(target=self._export_chatbot, args=(chatbot, path), daemon=True).start()
+
+    def _export_chatbot(self, chatbot, path):
+        try:
+            stats = exporter.export_chatbot(self._storage, chatbot, path)
+        except Exception as e:
+            utils.warn(f'Export the chatbot failed: {e}')
+            return
+        utils.notify(f'Exported {stats["messages"]} messages and {stats["sounds"]} sounds in {stats["seconds"]:.1f}s, '
+                     f'{stats["messages_per_second"]:.0f} messages/s.')
+
+    def import_chatbot(self, path) -> None:
+        """
+        Import a chatbot from an archive in the background, see exporter.ChatBotImporter. A ChatBotImportedEvent is
+        posted when it is saved.
+        :param path: the archive path.
+        :return:
+        """
+        try:
+            chatbot_id = exporter.read_manifest(path)['chatbot_id']
+        except Exception as e:
+            utils.warn(f'Import the chatbot failed: {e}')
+            return
+        if chatbot_id in self._chatbots_data:
+            utils.warn('The chatbot is imported already.')
+            return
+        threading.Thread(target=self._import_chatbot, args=(path,), daemon=True).start()
+
+    def resume_imports(self) -> None:
+        """
+        Go on with the imports interrupted by the last exit.
+        :return:
+        """
+        for chatbot_id, path in self._importer.get_unfinished():
+            if os.path.exists(path):
+                threading.Thread(target=self._import_chatbot, args=(path,), daemon=True).start()
+            else:
+                utils.warn(f'The archive of an unfinished import is missing: {path}')
+                self._importer.discard(chatbot_id)
+
+    def _import_chatbot(self, path):
+        try:
+            chatbot, stats = self._importer.run(path)
+        except Exception as e:
+            utils.warn(f'Import the chatbot failed: {e}, import it again to go on.')
+            return
+        for history in chatbot['histories']:
+            history['pager'] = storage.HistoryPager(self._storage, chatbot['chatbot_id'], history['history_id'])
+        chatbot_data = ChatBotData(**chatbot)
+        # the importer has saved it
+        chatbot_data.mark_saved()
+        utils.notify(f'Imported {stats["messages"]} messages and {stats["sounds"]} sounds in {stats["seconds"]:.1f}s, '
+                     f'{stats["messages_per_second"]:.0f} messages/s.')
+        QApplication.postEvent(self, event.ChatBotImportedEvent(chatbot_data))
+
+    def _save_records(self, records):
+        self._writer.submit(records)
+        self._writer.flush()
+
     def save_data(self, data_type):
         match data_type:
             case AIChatEnum.DataType.Config:
-                self._data['config'] = self._config_data.data
+                self._writer.submit([{'op': 'config', 'config': self._config_data.data}])
             case AIChatEnum.DataType.ChatBot:
-                self._data['chatbots'] = self._chatbots_data.data
-        self._save_data_to_file()
+                self._writer.submit(self._get_journal_records(self._chatbots_data.change_log.drain()))
 
     def update_data(self, data_type, data):
         match data_type:
             case AIChatEnum.DataType.ChatBot:
                 self._chatbots_data[data.chatbot_id].update(data)
-                self._data['chatbots'] = self._chatbots_data.data
-        self._save_data_to_file()
+        self.save_data(data_type)
+
+    @staticmethod
+    def _get_journal_records(changes) -> list:
+        """
+        Turn the data changes into storage journal records.
+        :param changes: list of DataChange
+        :return: list of dict
+        """
+        records = []
+        for change in changes:
+            match change.change_type:
+                case DataChangeType.AppendMessage:
+                    records.append({'op': 'append', 'chatbot_id': change.chatbot.chatbot_id,
+                                    'history_id': change.history_id, 'message': change.payload.data})
+                case DataChangeType.DeleteMessage:
+                    records.append({'op': 'delete', 'chatbot_id': change.chatbot.chatbot_id,
+                                    'history_id': change.history_id, 'message_id': change.payload.message_id})
+                case DataChangeType.UpdateChatBot:
+                    records.append({'op': 'chatbot', 'chatbot': change.chatbot.get_changed_data(bool(change.payload))})
+                case DataChangeType.DeleteChatBot:
+                    records.append({'op': 'delete_chatbot', 'chatbot_id': change.chatbot.chatbot_id})
+        # the changes are all in the records now, the histories changed later are dirty again
+        for change in changes:
+            change.chatbot.mark_saved()
+        return records
+
+    def flush(self):
+        """
+        Block until all the changes are written.
+        :return:
+        """
+        if self._chatbots_data is not None:
+            self.save_data(AIChatEnum.DataType.ChatBot)
+        self._writer.flush()
 
-    def _save_data_to_file(self):
-        utils.save_json(os.path.join(self._data_path, self._data_file), self._data)
+    def close(self):
+        """
+        Save the pending changes and close the storage.
+        :return:
+        """
+        if self._chatbots_data is not None:
+            self.save_data(AIChatEnum.DataType.ChatBot)
+        self._writer.close()
+        self._search_index.close()
+        self._storage.close()
 
     openai_api_key = property(lambda self: self._config_data.openai_config.openai_api_key)
     config_data = property(lambda self: self._config_data)
     chatbots_data = property(lambda self: self._chatbots_data)
 
 
+class DataChange:
+    """
+    A change of the chatbot data, waiting to be saved.
+    :param change_type: DataChangeType
+    :param chatbot: the changed ChatBotData
+    :param history_id: str, the id of the changed history
+    :param payload: the MessageData of a message change, or whether the histories are changed of a chatbot update
+    """
+
+    def __init__(self, change_type: DataChangeType, chatbot, history_id=None, payload=None):
+        self._change_type = change_type
+        self._chatbot = chatbot
+        self._history_id = history_id
+        self._payload = payload
+
+    change_type = property(lambda self: self._change_type)
+    chatbot = property(lambda self: self._chatbot)
+    history_id = property(lambda self: self._history_id)
+    payload = property(lambda self: self._payload)
+
+
+class DataChangeLog:
+    """
+    Thread safe queue of the data changes which are not saved yet. Messages are appended by the chat threads, and the
+    log is drained by the DataLoader in the GUI thread.
+    """
+
+    def __init__(self):
+        self._changes = collections.deque()
+
+    def __len__(self):
+        return len(self._changes)
+
+    def record(self, change: DataChange):
+        self._changes.append(change)
+
+    def drain(self) -> list[DataChange]:
+        changes = []
+        while self._changes:
+            changes.append(self._changes.popleft())
+        return changes
+
+    def clear(self):
+        self._changes.clear()
+
+
 class Data:
     """
     Base class for all data classes
     """
+    __slots__ = ('_id',)
 
     def __init__(self, data_id):
         self._id = data_id
@@ -231,6 +489,8 @@ class OpenAIConfigData(Data):
     """
     Data class for OpenAI config
     :param openai_api_key: str
+    :param api_keys: list of dict, [optional] more keys to spread the requests over, see key_pool.APIKey for the keys
+    of a dict.
     :param model: int, see OpenAIModel enum
     :param temperature: float
     :param top_p: float
@@ -242,10 +502,12 @@ class OpenAIConfigData(Data):
     def __init__(self, **kwargs):
         super().__init__('openai_config')
         self._openai_api_key = kwargs['openai_api_key']
+        self._api_keys = kwargs.get('api_keys', [])
         gpt_params = kwargs['gpt_params']
         self._gpt_params = GPTParamsData(**gpt_params)
 
     openai_api_key = property(lambda self: self._openai_api_key)
+    api_keys = property(lambda self: self._api_keys)
     model = property(lambda self: self._gpt_params.model)
     max_tokens = property(lambda self: self._gpt_params.max_tokens)
     temperature = property(lambda self: self._gpt_params.temperature)
@@ -256,6 +518,7 @@ class OpenAIConfigData(Data):
     def _get_data(self):
         return {
             'openai_api_key': self._openai_api_key,
+            'api_keys': self._api_keys,
             'gpt_params': self._gpt_params.data
         }
 
@@ -264,6 +527,7 @@ class OpenAIConfigData(Data):
 
     def update(self, data):
         self._openai_api_key = data.openai_api_key
+        self._api_keys = data.api_keys
         self._gpt_params.update(data.get_gpt_params())
 
 
@@ -493,6 +757,15 @@ class ConfigData(Data):
             },
         'openai_config': {
             'openai_api_key': str,
+            'api_keys': [optional] [
+                {
+                    'api_key': str
+                    'api_base': str, [optional]
+                    'organization': str, [optional]
+                    'requests_per_minute': int, [optional]
+                    'tokens_per_minute': int, [optional]
+                    'chatbot_ids': [str], [optional] the chatbots pinned to the key
+                }],
             'gpt_params': {
                 'model': int, see OpenAIModel enum
                 'temperature': float
@@ -595,7 +868,7 @@ class ChatBotData(Data):
             }
         'histories': [{
             'id_': str,[optional],
-            'memory': dict[int, str],
+            'memory': str,
             'history_list': [{
                 'id_': str,[optional]
                 'chatbot_id': str,
@@ -611,12 +884,12 @@ class ChatBotData(Data):
         self._gpt_params: GPTParamsData = GPTParamsData(**kwargs['gpt_params'])
         self._character: CharacterData = CharacterData(**kwargs['character'])
         self._histories: HistoryDataList = HistoryDataList(kwargs['histories'])
-        if 'chatbot_id' in kwargs:
-            self._id = kwargs['chatbot_id']
-        else:
-            self._id = 'CB' + hex(
-                hash(utils.save_json_string(self._gpt_params.data) + utils.save_json_string(
-                    self._character.data))).split('x')[1].upper()
+        self._id = kwargs['chatbot_id'] if 'chatbot_id' in kwargs else utils.generate_id('CB')
+        self._change_log: DataChangeLog | None = None
+        # bumped by every change of the chatbot itself, the histories count their own changes
+        self._revision = 0
+        self._data_cache = None
+        self._data_cache_key = None
         super().__init__(self._id)
 
     def __getitem__(self, item):
@@ -626,27 +899,34 @@ class ChatBotData(Data):
         self.data[key] = value
 
     def __lt__(self, other):
-        if len(self._histories) > len(other.histories):
-            return True
-        if len(self._histories) < len(other.histories):
-            return False
-        if len(self._histories) == 1 and not self._histories[0]:
-            return False
-        elif len(other.histories) == 1 and not other.histories[0]:
-            return True
-        else:
-            return self._histories.last_modified() > other.histories.last_modified()
+        return self.get_order_key() < other.get_order_key()
+
+    def get_order_key(self):
+        """
+        The order of the chatbots: more histories first, then the latest talked, and a single empty history last.
+        :return: tuple
+        """
+        only_empty = len(self._histories) == 1 and not len(self._histories[0])
+        latest_timestamp = self._histories.last_modified_timestamp()
+        return -len(self._histories), only_empty, -latest_timestamp if latest_timestamp is not None else 0
 
     def __eq__(self, other):
-        return self.data == other.data
+        if isinstance(other, ChatBotData):
+            return self._id == other.chatbot_id
+        return False
+
+    def __hash__(self):
+        return hash(self._id)
 
     def get_history(self, history_id):
         """
-        Get history by history_id
+        Get history by history_id. An archived history is rehydrated.
         :param history_id: str
         :return: HistoryData
         """
-        return self._histories[history_id]
+        history = self._histories[history_id]
+        history.rehydrate()
+        return history
 
     def update(self, data):
         """
@@ -654,6 +934,7 @@ class ChatBotData(Data):
         :param data: ChatBotData or dict
         :return:
         """
+        histories_updated = False
         if isinstance(data, ChatBotData):
             if data.gpt_params:
                 self._gpt_params.update(data.gpt_params)
@@ -661,6 +942,7 @@ class ChatBotData(Data):
                 self._character.update(data.character)
             if data.histories:
                 self._histories.update(data.histories)
+                histories_updated = True
         if isinstance(data, dict):
             if 'gpt_params' in data:
                 self._gpt_params.update(GPTParamsData(**data['gpt_params']))
@@ -668,8 +950,23 @@ class ChatBotData(Data):
                 self._character.update(CharacterData(**data['character']))
             if 'histories' in data:
                 self._histories.update(HistoryDataList(data['histories']))
+                histories_updated = True
+        self._revision += 1
+        self._record_change(DataChangeType.UpdateChatBot, payload=histories_updated)
         return self
 
+    def bind_change_log(self, change_log):
+        """
+        Bind the change log which records the unsaved changes of this chatbot.
+        :param change_log: DataChangeLog or None
+        :return:
+        """
+        self._change_log = change_log
+
+    def _record_change(self, change_type, history_id=None, payload=None):
+        if self._change_log is not None:
+            self._change_log.record(DataChange(change_type, self, history_id, payload))
+
     def append_message(self, message, history_id=None):
         """
         Append message to chatbot history
@@ -677,10 +974,11 @@ class ChatBotData(Data):
         :param message: the message to append
         :return:
         """
-        if history_id is None:
-            self._histories.latest().append(message)
-        else:
-            self._histories[history_id].append(message)
+        history = self._histories.latest() if history_id is None else self._histories[history_id]
+        history.append(message)
+        self._histories.message_appended(history)
+        self._revision += 1
+        self._record_change(DataChangeType.AppendMessage, history.history_id, message)
 
     def delete_message(self, history_id, message):
         """
@@ -690,9 +988,29 @@ class ChatBotData(Data):
         :return: if the message is the latest one.
         """
         is_latest = self._histories[history_id].is_latest(message)
+        is_archived = self._histories[history_id].is_archived_message(message)
         self._histories[history_id].remove(message)
+        self._histories.message_removed(self._histories[history_id])
+        self._revision += 1
+        self._record_change(DataChangeType.DeleteMessage, history_id, message)
+        if is_archived:
+            # an archived message can not be deleted alone, save the whole history again to restore it
+            self._record_change(DataChangeType.UpdateChatBot, payload=True)
         return is_latest
 
+    def update_memory(self, history_id, memory, summarized_until):
+        """
+        Update the memory of a history, which the older messages are folded into.
+        :param history_id: the id of the history.
+        :param memory: str, the new memory.
+        :param summarized_until: the message_order_key of the latest message folded into the memory.
+        :return:
+        """
+        # the messages are not changed, only the metadata of the history is saved
+        self._histories[history_id].update_memory(memory, summarized_until)
+        self._revision += 1
+        self._record_change(DataChangeType.UpdateChatBot, payload=False)
+
     def has_history(self, history_id):
         """
         Check if the chatbot has history.
@@ -701,32 +1019,90 @@ class ChatBotData(Data):
         """
         return history_id in self._histories
 
+    def get_meta_data(self):
+        """
+        Get the chatbot data without the messages.
+        :return: dict
+        """
+        return {
+            'chatbot_id': self._id,
+            'gpt_params': self._gpt_params.data,
+            'character': self._character.data,
+            'histories': [history.get_meta_data() for history in self._histories],
+        }
+
+    def get_changed_data(self, with_messages=True):
+        """
+        Get the chatbot data with the messages of the histories changed since the last save only.
+        :param with_messages: bool, if False, the metadata of the histories only, e.g. when only the memory or the
+        settings are changed, the messages are saved by their append and delete records.
+        :return: dict
+        """
+        data = self.get_meta_data()
+        if with_messages:
+            data['histories'] = [history.data if history.dirty else meta
+                                 for history, meta in zip(self._histories, data['histories'])]
+        return data
+
+    def mark_saved(self):
+        """
+        Mark all the histories as saved.
+        :return:
+        """
+        for history in self._histories:
+            history.mark_saved()
+
+    def _get_data(self):
+        # reuse the data while neither the chatbot nor any history changed. the data of partly loaded histories is not
+        # kept, it would hold all the unloaded messages in memory.
+        key = (self._revision, tuple(history.revision for history in self._histories))
+        if self._data_cache_key == key:
+            return self._data_cache
+        data = {
+            'chatbot_id': self._id,
+            'gpt_params': self._gpt_params.data,
+            'character': self._character.data,
+            'histories': self._histories.data,
+        }
+        if not any(history.unloaded_count for history in self._histories):
+            self._data_cache = data
+            self._data_cache_key = key
+        return data
+
     chatbot_id = property(lambda self: self._id)
     gpt_params = property(lambda self: self._gpt_params)
     character = property(lambda self: self._character)
     histories = property(lambda self: self._histories)
+    revision = property(lambda self: self._revision)
 
 
 class ChatBotDataList(Data):
     """
-    Data class for chatbot list.
+    Data class for chatbot list. The chatbots are kept in the order of ChatBotData.get_order_key, by the key every
+    chatbot is placed with, so a chatbot is found by bisect. A changed chatbot keeps its place until it is repositioned.
     :param chatbot_list: list of ChatBotData
     """
 
     def __init__(self, chatbot_list):
+        self._change_log = DataChangeLog()
         if chatbot_list:
             self._chatbot_list = [ChatBotData(**chatbot) for chatbot in chatbot_list]
         else:
             self._chatbot_list = []
-        super().__init__('CL' + hex(hash(utils.save_json_string(chatbot_list))).split('x')[1].upper())
+        self._chatbot_index = {chatbot.chatbot_id: chatbot for chatbot in self._chatbot_list}
+        # chatbot id -> the order key the chatbot is placed with
+        self._order_keys = {}
+        self.sort()
+        for chatbot in self._chatbot_list:
+            chatbot.bind_change_log(self._change_log)
+        super().__init__(utils.generate_id('CL'))
 
     def __getitem__(self, key) -> ChatBotData:
         if isinstance(key, int):
             return self._chatbot_list[key]
         elif isinstance(key, str):
-            for chatbot in self._chatbot_list:
-                if chatbot.chatbot_id == key:
-                    return chatbot
+            if key in self._chatbot_index:
+                return self._chatbot_index[key]
             raise ValueError('No such chatbot')
         else:
             raise ValueError('Invalid key type')
@@ -734,6 +1110,11 @@ class ChatBotDataList(Data):
     def __len__(self):
         return len(self._chatbot_list)
 
+    def __contains__(self, item):
+        if isinstance(item, ChatBotData):
+            item = item.chatbot_id
+        return item in self._chatbot_index
+
     def __iter__(self):
         return iter(self._chatbot_list)
 
@@ -741,23 +1122,68 @@ class ChatBotDataList(Data):
         return [chatbot.data for chatbot in self._chatbot_list]
 
     def append(self, chatbot_data):
-        self._chatbot_list.append(chatbot_data)
+        """
+        Add a chatbot in order.
+        :param chatbot_data: ChatBotData
+        :return: int, the index of the chatbot.
+        """
+        index = self._insert(chatbot_data)
+        self._chatbot_index[chatbot_data.chatbot_id] = chatbot_data
+        chatbot_data.bind_change_log(self._change_log)
+        self._change_log.record(DataChange(DataChangeType.UpdateChatBot, chatbot_data, payload=True))
+        return index
+
+    def reposition(self, chatbot_id):
+        """
+        Move a changed chatbot to its place in order, the other chatbots keep theirs.
+        :param chatbot_id: str
+        :return: (int, int), the old and the new index of the chatbot.
+        """
+        chatbot = self._chatbot_index[chatbot_id]
+        old_index = self.index(chatbot_id)
+        del self._chatbot_list[old_index]
+        new_index = self._insert(chatbot)
+        return old_index, new_index
+
+    def _insert(self, chatbot):
+        key = chatbot.get_order_key()
+        index = bisect.bisect_right(self._chatbot_list, key, key=self._get_placed_key)
+        self._chatbot_list.insert(index, chatbot)
+        self._order_keys[chatbot.chatbot_id] = key
+        return index
+
+    def _get_placed_key(self, chatbot):
+        return self._order_keys[chatbot.chatbot_id]
+
+    def index(self, chatbot_id):
+        """
+        Find a chatbot by bisect on the key it is placed with.
+        :param chatbot_id: str
+        :return: int
+        """
+        chatbot = self._chatbot_index[chatbot_id]
+        index = bisect.bisect_left(self._chatbot_list, self._order_keys[chatbot_id], key=self._get_placed_key)
+        # the chatbots with the same key are next to each other
+        while self._chatbot_list[index] is not chatbot:
+            index += 1
+        return index
 
     def remove(self, chatbot_id):
-        for chatbot in self._chatbot_list:
-            if chatbot.chatbot_id == chatbot_id:
-                self._chatbot_list.remove(chatbot)
-                return True
-        return False
+        if chatbot_id not in self._chatbot_index:
+            return False
+        del self._chatbot_list[self.index(chatbot_id)]
+        chatbot = self._chatbot_index.pop(chatbot_id)
+        del self._order_keys[chatbot_id]
+        chatbot.bind_change_log(None)
+        self._change_log.record(DataChange(DataChangeType.DeleteChatBot, chatbot))
+        return True
 
     def get_chatbot_by_id(self, chatbot_id):
-        for chatbot in self._chatbot_list:
-            if chatbot.chatbot_id == chatbot_id:
-                return chatbot
-        return None
+        return self._chatbot_index.get(chatbot_id)
 
     def sort(self):
-        self._chatbot_list.sort()
+        self._order_keys = {chatbot.chatbot_id: chatbot.get_order_key() for chatbot in self._chatbot_list}
+        self._chatbot_list.sort(key=self._get_placed_key)
 
     def update(self, data) -> None:
         """
@@ -766,7 +1192,7 @@ class ChatBotDataList(Data):
         :return:
         """
         if isinstance(data, ChatBotDataList):
-            for chatbot in self._chatbot_list:
+            for chatbot in list(self._chatbot_list):
                 if not chatbot.chatbot_id in data:
                     self.remove(chatbot.chatbot_id)
             for chatbot in data:
@@ -776,6 +1202,7 @@ class ChatBotDataList(Data):
                     self.append(chatbot)
 
     chatbot_list = property(lambda self: self._chatbot_list)
+    change_log = property(lambda self: self._change_log)
 
 
 class GPTParamsData(Data):
@@ -798,10 +1225,7 @@ class GPTParamsData(Data):
         self._frequency_penalty = kwargs['frequency_penalty']
         self._presence_penalty = kwargs['presence_penalty']
         # generate id
-        self._id = 'GP' + hex(hash(
-            self._model + str(self._max_tokens) + str(self._temperature) + str(self._top_p) + str(
-                self._frequency_penalty) + str(self._presence_penalty)))[
-                          2:]
+        self._id = utils.generate_id('GP')
         super().__init__(self._id)
 
     def update(self, data) -> None:
@@ -821,48 +1245,60 @@ class GPTParamsData(Data):
     presence_penalty = property(lambda self: self._presence_penalty)
 
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def parse_send_time(send_time) -> int:
+    """
+    Parse a send time into seconds since the epoch.
+    :param send_time: str, format: '%Y-%m-%d %H:%M:%S'
+    :return: int
+    """
+    return int((datetime.datetime.fromisoformat(send_time) - _EPOCH).total_seconds())
+
+
 @total_ordering
 class MessageData(Data):
     """
-    Data class for message
+    Data class for message. There are many messages, so it keeps its fields in slots, parses the send time once and
+    shares the repeated strings.
     :param chatbot_id: str, start with 'CB'
     :param message: str
     :param send_time: str, format: '%Y-%m-%d %H:%M:%S'
     :param is_user: bool
     :param name: str
     """
+    __slots__ = ('_chatbot_id', '_message', '_send_time', '_timestamp', '_is_user', '_name', '_revision',
+                 '_data_cache', '_token_count', '_tokenizer_name')
 
     def __init__(self, **kwargs):
-        self._chatbot_id = kwargs['chatbot_id']
+        self._chatbot_id = sys.intern(kwargs['chatbot_id'])
         self._message = kwargs['message']
         self._send_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') if 'send_time' not in kwargs else \
             kwargs['send_time']
+        self._timestamp = parse_send_time(self._send_time)
         self._is_user = kwargs['is_user']
-        self._name = kwargs['name']
-        self._id = 'ME' + self._chatbot_id[2:] + self._send_time.replace('-', '').replace(':', '').replace(' ',
-                                                                                                           '') if 'message_id' not in kwargs else \
-            kwargs['message_id']
+        self._name = sys.intern(kwargs['name'])
+        self._id = kwargs['message_id'] if 'message_id' in kwargs else utils.generate_id('ME')
+        self._revision = 0
+        self._data_cache = None
+        # the token count of the message, by the tokenizer which counted it
+        self._token_count = None
+        self._tokenizer_name = None
         super().__init__(self._id)
 
+    # the messages are ordered by send time, the id breaks the ties like the storages do
     def __lt__(self, other):
-        self_send_time = datetime.datetime.strptime(self._send_time, '%Y-%m-%d %H:%M:%S')
-        other_send_time = datetime.datetime.strptime(other.send_time, '%Y-%m-%d %H:%M:%S')
-        return self_send_time < other_send_time
+        return (self._timestamp, self._id) < (other.timestamp, other.message_id)
 
     def __gt__(self, other):
-        self_send_time = datetime.datetime.strptime(self._send_time, '%Y-%m-%d %H:%M:%S')
-        other_send_time = datetime.datetime.strptime(other.send_time, '%Y-%m-%d %H:%M:%S')
-        return self_send_time > other_send_time
+        return (self._timestamp, self._id) > (other.timestamp, other.message_id)
 
     def __le__(self, other):
-        self_send_time = datetime.datetime.strptime(self._send_time, '%Y-%m-%d %H:%M:%S')
-        other_send_time = datetime.datetime.strptime(other.send_time, '%Y-%m-%d %H:%M:%S')
-        return self_send_time <= other_send_time
+        return (self._timestamp, self._id) <= (other.timestamp, other.message_id)
 
     def __ge__(self, other):
-        self_send_time = datetime.datetime.strptime(self._send_time, '%Y-%m-%d %H:%M:%S')
-        other_send_time = datetime.datetime.strptime(other.send_time, '%Y-%m-%d %H:%M:%S')
-        return self_send_time >= other_send_time
+        return (self._timestamp, self._id) >= (other.timestamp, other.message_id)
 
     def __hash__(self):
         return hash(self._id)
@@ -877,33 +1313,96 @@ class MessageData(Data):
             self._chatbot_id = data.chatbot_id
             self._message = data.message
             self._send_time = data.send_time
+            self._timestamp = data.timestamp
             self._is_user = data.is_user
             self._name = data.name
+            self._revision += 1
+            self._data_cache = None
+            self._token_count = None
+
+    def _get_data(self):
+        # the serialized message is cached until the message changes, do not modify it
+        if self._data_cache is None:
+            self._data_cache = {
+                'message_id': self._id,
+                'chatbot_id': self._chatbot_id,
+                'message': self._message,
+                'send_time': self._send_time,
+                'is_user': self._is_user,
+                'name': self._name,
+            }
+        return self._data_cache
+
+    def _get_json_safe_data(self):
+        return dict(self._get_data())
+
+    def get_token_count(self, model) -> int:
+        """
+        The count of tokens the message takes in a chat request, counted once and kept until the message changes.
+        :param model: str, the model name.
+        :return: int
+        """
+        tokenizer_name = context_builder.get_tokenizer_name(model)
+        if self._token_count is None or self._tokenizer_name != tokenizer_name:
+            self._token_count = context_builder.count_message_tokens(self._message, model)
+            self._tokenizer_name = tokenizer_name
+        return self._token_count
 
     message_id = property(lambda self: self._id)
     chatbot_id = property(lambda self: self._chatbot_id)
     message = property(lambda self: self._message)
     send_time = property(lambda self: self._send_time)
+    timestamp = property(lambda self: self._timestamp)
     is_user = property(lambda self: self._is_user)
     name = property(lambda self: self._name)
+    revision = property(lambda self: self._revision)
 
 
 class HistoryData(Data):
     """
-    Data class for message history.
+    Data class for message history. Only the latest messages may be loaded, the older ones are paged in by the pager.
+    :param history_id: str, start with 'HD' [optional]
     :param memory: str, the memory of chatbot in this conversation.
-    :param history_list: list of MessageData or message data dict.
+    :param history_list: list of MessageData or message data dict, the loaded messages.
+    :param message_count: int, [optional] the count of all the messages, loaded or not.
+    :param pager: storage.HistoryPager, [optional] required when not all the messages are loaded.
+    :param archive: dict, [optional] the archive of an archived history, see storage.HistoryArchive. Only the latest
+    messages of an archived history are loaded, the archived ones are paged in like the other unloaded ones.
+    :param summarized_until: list, [optional] the message_order_key of the latest message folded into the memory.
     """
 
     def __init__(self, **kwargs):
-        self._memory = '' if 'memory' not in kwargs else kwargs['memory']
+        # the histories of older versions were created with an empty dict as the memory
+        self._memory = kwargs.get('memory') or ''
         self._message_list = [MessageData(**message) if isinstance(message, dict) else message for message in
                               kwargs['history_list']]
         self._message_list.sort()
-        super().__init__('HD' + hex(hash(utils.save_json_string(self.data))).split('x')[1].upper())
+        # the loaded messages by id
+        self._message_index = {message.message_id: message for message in self._message_list}
+        self._pager: storage.HistoryPager | None = kwargs.get('pager')
+        self._unloaded_count = kwargs['message_count'] - len(self._message_list) if 'message_count' in kwargs else 0
+        # the unloaded messages are all ordered before the cursor
+        self._page_cursor = self._order_key(self._message_list[0]) if self._message_list else None
+        self._archive = kwargs.get('archive')
+        self._summarized_until = tuple(kwargs['summarized_until']) if kwargs.get('summarized_until') else None
+        self._id = kwargs['history_id'] if 'history_id' in kwargs else utils.generate_id('HD')
+        # bumped by every change, the history is dirty until the changed revision is saved
+        self._revision = 0
+        self._saved_revision = -1
+        # the serialized loaded messages, by revision
+        self._loaded_data_cache = None
+        self._loaded_data_revision = None
+        super().__init__(self._id)
 
     def __len__(self):
-        return len(self._message_list)
+        return len(self._message_list) + self._unloaded_count
+
+    def __contains__(self, item):
+        if isinstance(item, MessageData):
+            item = item.message_id
+        if not isinstance(item, str):
+            return False
+        return item in self._message_index or self.get_message(item) is not None
 
     def __hash__(self):
         return hash(tuple(self._message_list))
@@ -919,14 +1418,124 @@ class HistoryData(Data):
         :return: message data
         """
         if isinstance(key, str):
-            for message in self._message_list:
-                if message.message_id == key:
-                    return message
+            return self.get_message(key)
         if isinstance(key, int):
-            return self._message_list[key]
+            index = key if key >= 0 else len(self) + key
+            if 0 <= index < self._unloaded_count:
+                self.load_more(self._unloaded_count - index)
+            return self._message_list[index - self._unloaded_count]
 
     def __iter__(self):
-        return iter(self._message_list)
+        """
+        Iterate all the messages. The unloaded messages are paged in, but not kept in the history.
+        """
+        yield from self._iter_unloaded()
+        yield from list(self._message_list)
+
+    @staticmethod
+    def _order_key(message):
+        return message.send_time, message.message_id
+
+    def _iter_unloaded(self, page_size=200):
+        before = self._page_cursor
+        after = None
+        while self._unloaded_count:
+            page = self._pager.load_messages(before=before, after=after, limit=page_size, from_oldest=True)
+            if not page:
+                return
+            for message in page:
+                yield MessageData(**message)
+            after = storage.message_order_key(page[-1])
+
+    def iter_latest(self, page_size=50):
+        """
+        Iterate the messages from the latest one back. The unloaded messages are paged in, but not kept in the history,
+        so the history is not changed, e.g. when a worker reads it while the GUI shows it.
+        :param page_size: the count of the unloaded messages read at once.
+        :return: generator of MessageData
+        """
+        # the loaded messages and the cursor are taken together, the older pages are read from there
+        messages = list(self._message_list)
+        before = self._page_cursor
+        unloaded = self._unloaded_count
+        yield from reversed(messages)
+        while unloaded and before is not None:
+            page = self._pager.load_messages(before=before, limit=page_size)
+            if not page:
+                return
+            for message in reversed(page):
+                yield MessageData(**message)
+            before = storage.message_order_key(page[0])
+
+    def get_earlier(self, message, count=50) -> list[MessageData]:
+        """
+        Get the messages before a message, without loading them into the history, e.g. to show a search hit with the
+        messages around it.
+        :param message: MessageData
+        :param count: the max count of the messages.
+        :return: list of MessageData, in order.
+        """
+        if not self._unloaded_count and self._message_list:
+            index = bisect.bisect_left(self._message_list, self._order_key(message), key=self._order_key)
+            return self._message_list[max(index - count, 0):index]
+        return [MessageData(**data) for data in self._pager.load_messages(before=self._order_key(message), limit=count)]
+
+    def get_later(self, message, count=50) -> list[MessageData]:
+        """
+        Get the unloaded messages after a message, without loading them into the history. The loaded messages are not
+        returned, they follow the last of the unloaded ones.
+        :param message: MessageData
+        :param count: the max count of the messages.
+        :return: list of MessageData, in order, fewer than count when the loaded messages are reached.
+        """
+        if not self._unloaded_count:
+            return []
+        return [MessageData(**data) for data in self._pager.load_messages(
+            before=self._page_cursor, after=self._order_key(message), limit=count, from_oldest=True)]
+
+    def load_more(self, count=50) -> list[MessageData]:
+        """
+        Load a page of the older messages into the history.
+        :param count: the max count of messages to load.
+        :return: the loaded messages, in order.
+        """
+        if not self._unloaded_count:
+            return []
+        page = [MessageData(**message) for message in self._pager.load_messages(before=self._page_cursor, limit=count)]
+        if not page:
+            self._unloaded_count = 0
+            return []
+        self._message_list[:0] = page
+        self._message_index.update((message.message_id, message) for message in page)
+        self._unloaded_count = max(self._unloaded_count - len(page), 0)
+        self._page_cursor = self._order_key(page[0])
+        self._loaded_data_revision = None
+        return page
+
+    def rehydrate(self, count=50) -> None:
+        """
+        Page the latest messages of an archived history in, so it is shown like a history which is not archived.
+        :param count: the count of the messages to have loaded.
+        :return:
+        """
+        if self._archive and len(self._message_list) < count:
+            self.load_more(count - len(self._message_list))
+
+    def is_archived_message(self, message) -> bool:
+        """
+        If the message is one of the archived messages of the history.
+        :param message: MessageData
+        :return: bool
+        """
+        return bool(self._archive) and self._order_key(message) < tuple(self._archive['before'])
+
+    def set_archive(self, archive) -> None:
+        """
+        Set the archive of the history when its messages are archived, see DataLoader.archive_idle_histories.
+        :param archive: dict, {'count': int, 'before': list}, see storage.HistoryArchive.
+        :return:
+        """
+        self._archive = archive
 
     def sort(self):
         self._message_list.sort()
@@ -939,13 +1548,51 @@ class HistoryData(Data):
     def history_list(self):
         return self._message_list
 
+    @property
+    def history_id(self):
+        return self._id
+
+    @property
+    def unloaded_count(self):
+        return self._unloaded_count
+
+    @property
+    def summarized_until(self):
+        return self._summarized_until
+
+    @property
+    def archived_count(self):
+        return self._archive['count'] if self._archive else 0
+
+    @property
+    def revision(self):
+        return self._revision
+
+    @property
+    def dirty(self):
+        return self._revision != self._saved_revision
+
+    def mark_saved(self):
+        self._saved_revision = self._revision
+
+    def is_loaded(self, message_id) -> bool:
+        """
+        If the message is loaded into the history, not only saved in the storage.
+        :param message_id: str
+        :return: bool
+        """
+        return message_id in self._message_index
+
     def get_message(self, message_id):
-        for message in self._message_list:
-            if message.message_id == message_id:
-                return message
-        return None
+        message = self._message_index.get(message_id)
+        if message is None and self._unloaded_count:
+            message_data = self._pager.get_message(message_id)
+            message = MessageData(**message_data) if message_data else None
+        return message
 
     def oldest(self):
+        if self._unloaded_count:
+            return MessageData(**self._pager.load_messages(before=self._page_cursor, limit=1, from_oldest=True)[0])
         return self._message_list[0]
 
     def latest(self):
@@ -954,48 +1601,111 @@ class HistoryData(Data):
         return self._message_list[-1]
 
     def _get_data(self):
-        return {'memory': self._memory, 'history_list': [message.data for message in self._message_list]}
+        if self._loaded_data_revision != self._revision:
+            self._loaded_data_cache = [message.data for message in self._message_list]
+            self._loaded_data_revision = self._revision
+        # the unloaded messages are already serialized by the storage
+        history_list = []
+        before = self._page_cursor
+        after = None
+        while len(history_list) < self._unloaded_count:
+            page = self._pager.load_messages(before=before, after=after, limit=200, from_oldest=True)
+            if not page:
+                break
+            history_list.extend(page)
+            after = storage.message_order_key(page[-1])
+        history_list.extend(self._loaded_data_cache)
+        return dict(self.get_meta_data(), history_list=history_list)
 
     def _get_json_safe_data(self):
-        return {'memory': self._memory, 'history_list': [message.json_safe_data for message in self._message_list]}
+        return dict(self.get_meta_data(), history_list=[message.json_safe_data for message in self])
+
+    def get_meta_data(self):
+        """
+        Get the history data without the messages.
+        :return: dict
+        """
+        data = {'history_id': self._id, 'memory': self._memory}
+        if self._summarized_until:
+            data['summarized_until'] = list(self._summarized_until)
+        return data
+
+    def update_memory(self, memory, summarized_until) -> None:
+        """
+        Set the memory, which the messages until summarized_until are folded into.
+        :param memory: str
+        :param summarized_until: the message_order_key of the latest message folded into the memory.
+        :return:
+        """
+        self._memory = memory
+        self._summarized_until = tuple(summarized_until)
+
+    def is_summarized(self, message) -> bool:
+        """
+        If the message is folded into the memory.
+        :param message: MessageData
+        :return: bool
+        """
+        return self._summarized_until is not None and self._order_key(message) <= self._summarized_until
 
     def is_latest(self, message):
         return message == self.latest()
 
     def append(self, message):
-        self._message_list.append(message)
-        self._message_list.sort()
+        # the new message is almost always the latest one
+        if not self._message_list or message >= self._message_list[-1]:
+            self._message_list.append(message)
+        else:
+            bisect.insort(self._message_list, message)
+        self._message_index[message.message_id] = message
+        self._revision += 1
 
     def remove(self, message):
-        self._message_list.remove(message)
-        self._message_list.sort()
+        message = self._message_index.pop(message.message_id)
+        # the list is ordered, find the message by bisect instead of comparing it to every message
+        index = bisect.bisect_left(self._message_list, message)
+        if index < len(self._message_list) and self._message_list[index] is message:
+            del self._message_list[index]
+        else:
+            self._message_list.remove(message)
+        self._revision += 1
 
     def latest_n(self, n):
+        if n > len(self._message_list) and self._unloaded_count:
+            self.load_more(n - len(self._message_list))
         return self._message_list[-n:]
 
     def update(self, data) -> None:
         if isinstance(data, HistoryData):
             self._memory = data.memory
-            for message in self.history_list:
-                if message.message_id not in data:
-                    self.remove(message)
-            for message in data.history_list:
-                if message.message_id not in self:
-                    self.append(message)
-                else:
-                    self[message.message_id].update(message)
+            self._summarized_until = data.summarized_until
+            self._merge_messages(data.history_list)
         if isinstance(data, dict):
             if 'memory' in data:
-                self._memory = data['memory']
+                self._memory = data['memory'] or ''
+            if 'summarized_until' in data:
+                self._summarized_until = tuple(data['summarized_until']) if data['summarized_until'] else None
             if 'history_list' in data:
-                for message in self.history_list:
-                    if message.message_id not in data['history_list']:
-                        self.remove(message)
-                for message in data['history_list']:
-                    if message['message_id'] not in self:
-                        self.append(MessageData(**message))
-                    else:
-                        self[message['message_id']].update(MessageData(**message))
+                self._merge_messages(
+                    [MessageData(**message) if isinstance(message, dict) else message for message in
+                     data['history_list']])
+        self._revision += 1
+
+    def _merge_messages(self, messages):
+        """
+        Make the loaded messages the same as messages, by id.
+        :param messages: list of MessageData
+        :return:
+        """
+        message_index = {}
+        for message in messages:
+            if message.message_id in self._message_index:
+                self._message_index[message.message_id].update(message)
+                message_index[message.message_id] = self._message_index[message.message_id]
+            else:
+                message_index[message.message_id] = message
+        self._message_index = message_index
+        self._message_list = sorted(message_index.values())
 
 
 class CharacterData(Data):
@@ -1018,8 +1728,7 @@ class CharacterData(Data):
         self._greeting = kwargs['greeting']
         self._prompt = kwargs['prompt']
         # generate chatbot id
-        self._id = kwargs['character_id'] if 'character_id' in kwargs else 'CH' + hex(
-            hash(self._name + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))).split('x')[1].upper()
+        self._id = kwargs['character_id'] if 'character_id' in kwargs else utils.generate_id('CH')
         super().__init__(self._id)
 
     def update(self, data) -> None:
@@ -1047,16 +1756,19 @@ class HistoryDataList(Data):
     """
 
     def __init__(self, history_list):
-        super().__init__('HL' + hex(hash(utils.save_json_string(history_list))).split('x')[1].upper())
         self._history_list = [HistoryData(**history) for history in history_list]
+        self._history_index = {history.history_id: history for history in self._history_list}
+        # the history with the latest message, found again after a change it can not follow
+        self._latest_history: HistoryData | None = None
+        self._latest_stale = True
+        super().__init__(utils.generate_id('HL'))
 
     def __getitem__(self, key) -> HistoryData:
         if isinstance(key, int):
             return self._history_list[key]
         elif isinstance(key, str):
-            for history in self._history_list:
-                if history.id_ == key:
-                    return history
+            if key in self._history_index:
+                return self._history_index[key]
             raise ValueError('No such history')
         else:
             raise ValueError('Invalid key type')
@@ -1069,49 +1781,80 @@ class HistoryDataList(Data):
 
     def __contains__(self, item):
         if isinstance(item, HistoryData):
-            return item in self._history_list
+            return item.history_id in self._history_index
         elif isinstance(item, str):
-            for history in self._history_list:
-                if history.id_ == item:
-                    return True
-            return False
+            return item in self._history_index
         else:
             return False
 
     def append(self, history):
-        self._history_list.append(HistoryData(history))
+        if isinstance(history, dict):
+            history = HistoryData(**history)
+        self._history_list.append(history)
+        self._history_index[history.history_id] = history
+        self._latest_stale = True
+
+    @staticmethod
+    def _latest_key(history):
+        message = history.latest()
+        return (0,) if message is None else (1, message.timestamp, message.message_id)
 
     def latest(self) -> HistoryData:
-        # compare each history's latest message time
-        latest_history = None
-        for history in self._history_list:
-            if latest_history is None:
-                latest_history = history
-            elif history.latest() > latest_history.latest():
-                latest_history = history
-        return latest_history
-
-    def last_modified(self) -> datetime.datetime:
-        """
-        :return: datetime.datetime, the last modified time of the history list
-        """
-        last_modified = None
-        for history in self._history_list:
-            if last_modified is None:
-                last_modified = history.latest().send_time
-            elif history.latest().send_time > last_modified:
-                last_modified = history.latest().send_time
-        return last_modified
+        """
+        :return: HistoryData, the history with the latest message.
+        """
+        if self._latest_stale:
+            self._latest_history = max(self._history_list, key=self._latest_key, default=None)
+            self._latest_stale = False
+        return self._latest_history
+
+    def message_appended(self, history):
+        """
+        Follow the latest history after a message is appended to history.
+        :param history: HistoryData
+        :return:
+        """
+        if not self._latest_stale and self._latest_key(history) > self._latest_key(self._latest_history):
+            self._latest_history = history
+
+    def message_removed(self, history):
+        """
+        Follow the latest history after a message is removed from history.
+        :param history: HistoryData
+        :return:
+        """
+        if history is self._latest_history:
+            self._latest_stale = True
+
+    def last_modified(self) -> str | None:
+        """
+        :return: str, the send time of the latest message, or None if there is no message.
+        """
+        latest_history = self.latest()
+        if latest_history is None or latest_history.latest() is None:
+            return None
+        return latest_history.latest().send_time
+
+    def last_modified_timestamp(self) -> int | None:
+        """
+        :return: int, the timestamp of the latest message, or None if there is no message.
+        """
+        latest_history = self.latest()
+        if latest_history is None or latest_history.latest() is None:
+            return None
+        return latest_history.latest().timestamp
 
     def _get_data(self):
         return [history.data for history in self._history_list]
 
     def remove(self, history):
-        self._history_list.remove(history)
+        history = self._history_index.pop(history.history_id)
+        self._history_list = [item for item in self._history_list if item is not history]
+        self._latest_stale = True
 
     def update(self, data) -> None:
         if isinstance(data, HistoryDataList):
-            for history in self:
+            for history in list(self):
                 if history.id_ not in data:
                     self.remove(history)
             for history in data:
@@ -1119,5 +1862,6 @@ class HistoryDataList(Data):
                     self.append(history)
                 else:
                     self[history.id_].update(history)
+            self._latest_stale = True
 
     history_list = property(lambda self: self._history_list)
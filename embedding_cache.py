@@ -0,0 +1,212 @@
+import glob
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import utils
+
+# the max count of vectors kept for a model, about 6MB for the 1536 dimensions of text-embedding-ada-002
+DEFAULT_CAPACITY = 1024
+_KEY_SIZE = 16
+# the key of a free row
+_EMPTY_KEY = bytes(_KEY_SIZE)
+
+
+def get_key(text) -> bytes:
+    """
+    :param text: str
+    :return: bytes, the hash of the text the vector is kept by.
+    """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=_KEY_SIZE).digest()
+
+
+class _ModelStore:
+    """
+    The vectors of a model in a .npy file of fixed size, opened as a memory map. A row holds the key of the text, the
+    time it was used last, and the float32 vector. A row is written before its key, so a row broken by a crash is not
+    found again.
+    """
+
+    def __init__(self, path, capacity, dimensions):
+        self._path = path
+        self._capacity = capacity
+        self._dimensions = dimensions
+        self._rows = self._open()
+        # key -> row index, the least recently used first
+        self._index: OrderedDict[bytes, int] = OrderedDict()
+        used = self._rows['used']
+        for row in np.argsort(used, kind='stable'):
+            key = self._rows['key'][row].tobytes()
+            if key != _EMPTY_KEY:
+                self._index[key] = int(row)
+        self._free = [row for row in range(self._capacity - 1, -1, -1) if not self._rows['key'][row].any()]
+        self._clock = int(used.max()) if len(used) else 0
+
+    def _open(self):
+        # the key is kept as raw bytes, a bytes field would drop its trailing zeros
+        dtype = np.dtype([('key', 'u1', (_KEY_SIZE,)), ('used', '<u8'), ('vector', '<f4', (self._dimensions,))])
+        latest_rows = None
+        if os.path.exists(self._path):
+            rows = np.load(self._path, mmap_mode='r+')
+            if rows.dtype == dtype and len(rows) == self._capacity:
+                return rows
+            if rows.dtype == dtype:
+                # the capacity is changed, the latest rows are kept
+                latest = np.argsort(rows['used'], kind='stable')[::-1][:self._capacity]
+                latest_rows = np.array(rows[latest[rows['key'][latest].any(axis=1)]])
+            # the file is replaced, it is not mapped while it is
+            del rows
+        temp_path = self._path + '.tmp'
+        rows = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=(self._capacity,))
+        if latest_rows is not None:
+            rows[:len(latest_rows)] = latest_rows
+        rows.flush()
+        del rows
+        os.replace(temp_path, self._path)
+        return np.load(self._path, mmap_mode='r+')
+
+    def get(self, key) -> np.ndarray | None:
+        row = self._index.get(key)
+        if row is None:
+            return None
+        self._index.move_to_end(key)
+        self._clock += 1
+        self._rows['used'][row] = self._clock
+        return self._rows['vector'][row]
+
+    def put(self, key, vector) -> np.ndarray:
+        row = self._index.get(key)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                # the least recently used row is taken
+                _, row = self._index.popitem(last=False)
+                self._rows['key'][row] = 0
+        self._rows['vector'][row] = vector
+        self._clock += 1
+        self._rows['used'][row] = self._clock
+        self._rows['key'][row] = np.frombuffer(key, dtype=np.uint8)
+        self._index[key] = row
+        self._index.move_to_end(key)
+        return self._rows['vector'][row]
+
+    def flush(self):
+        self._rows.flush()
+
+    dimensions = property(lambda self: self._dimensions)
+    size = property(lambda self: len(self._index))
+
+
+class EmbeddingCache:
+    """
+    The embeddings of the texts, kept on disk so a text is not sent to the api again, e.g. a message spoken again or the
+    context which repeats over the turns. The vectors of a model are kept by the hash of the text, as float32 in a
+    memory mapped file of capacity rows. When it is full, the least recently used vector is dropped.
+    The vectors are returned without a copy, they stay valid until capacity other vectors are added, copy the ones
+    which are kept longer.
+    :param data_path: str, the cache directory.
+    :param capacity: int, the max count of vectors of a model.
+    """
+
+    def __init__(self, data_path='./cache/embeddings', capacity=DEFAULT_CAPACITY):
+        self._data_path = data_path
+        self._capacity = capacity
+        self._stores: dict[str, _ModelStore] = {}
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, model, text, fetch) -> np.ndarray:
+        """
+        See get_many.
+        :param model: str
+        :param text: str
+        :param fetch: callable(list of str) -> list of vectors
+        :return: np.ndarray
+        """
+        return self.get_many(model, [text], fetch)[0]
+
+    def get_many(self, model, texts, fetch) -> list[np.ndarray]:
+        """
+        Get the embeddings of the texts, the ones not in the cache are fetched together in one call, and added.
+        :param model: str, the embedding model.
+        :param texts: list of str
+        :param fetch: callable(list of str) -> list of vectors, fetches the embeddings of the texts, in order.
+        :return: list of np.ndarray, float32, in the order of the texts.
+        """
+        keys = [get_key(text) for text in texts]
+        vectors: dict[bytes, np.ndarray] = {}
+        with self._lock:
+            store = self._get_store(model)
+            for key in keys:
+                if key not in vectors and store is not None:
+                    vector = store.get(key)
+                    if vector is not None:
+                        vectors[key] = vector
+            missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+            self._hits += len(keys) - sum(key in missing for key in keys)
+            self._misses += sum(key in missing for key in keys)
+        if missing:
+            # the api is called without the lock, the other lookups go on meanwhile
+            fetched = [np.asarray(vector, dtype=np.float32) for vector in fetch(list(missing.values()))]
+            with self._lock:
+                store = self._get_store(model, len(fetched[0]))
+                for key, vector in zip(missing, fetched):
+                    if len(vector) == store.dimensions:
+                        vector = store.put(key, vector)
+                    vectors[key] = vector
+                store.flush()
+        return [vectors[key] for key in keys]
+
+    def _get_store(self, model, dimensions=None):
+        store = self._stores.get(model)
+        if store is not None:
+            return store
+        name = re.sub(r'[^\w.-]', '_', model)
+        if dimensions is None:
+            # the cache of an earlier run
+            paths = glob.glob(os.path.join(glob.escape(self._data_path), f'{glob.escape(name)}.*.npy'))
+            if not paths:
+                return None
+            dimensions = int(paths[0].rsplit('.', 2)[-2])
+        os.makedirs(self._data_path, exist_ok=True)
+        path = os.path.join(self._data_path, f'{name}.{dimensions}.npy')
+        try:
+            store = _ModelStore(path, self._capacity, dimensions)
+        except (OSError, ValueError) as e:
+            # a broken cache is started again
+            utils.warn(f'The embedding cache {path} is not readable, it is cleared: {e}')
+            os.remove(path)
+            store = _ModelStore(path, self._capacity, dimensions)
+        self._stores[model] = store
+        return store
+
+    def get_metrics(self) -> dict:
+        """
+        :return: dict, the hits, misses and hit rate of the lookups, and the count of the vectors.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_rate': self._hits / lookups if lookups else 0.0,
+                    'size': sum(store.size for store in self._stores.values())}
+
+    def close(self) -> None:
+        """
+        Write the vectors out, e.g. before the app quits.
+        :return:
+        """
+        with self._lock:
+            for store in self._stores.values():
+                store.flush()
+            self._stores.clear()
+
+
+# the embeddings of the process
+cache = EmbeddingCache()
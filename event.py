@@ -262,3 +262,147 @@ class StopChatbotThreadEvent(QEvent):
     @property
     def chatbot_id(self):
         return self._chatbot_id
+
+class SearchMessageEvent(QEvent):
+    """
+    This event is used to search the messages of all the chatbots.
+    :param query: the text to search.
+    """
+    def __init__(self, query):
+        super().__init__(QEvent.User)
+        self._query = query
+
+    def type(self):
+        return SearchMessageEventType
+
+    @property
+    def query(self):
+        return self._query
+
+
+class ExportChatBotEvent(QEvent):
+    """
+    This event is used to export a chatbot with its histories and sounds into an archive.
+    :param chatbot_id: the id of the chatbot.
+    :param path: the archive path.
+    """
+    def __init__(self, chatbot_id, path):
+        super().__init__(QEvent.User)
+        self._chatbot_id = chatbot_id
+        self._path = path
+
+    def type(self):
+        return ExportChatBotEventType
+
+    @property
+    def chatbot_id(self):
+        return self._chatbot_id
+
+    @property
+    def path(self):
+        return self._path
+
+
+class ImportChatBotEvent(QEvent):
+    """
+    This event is used to import a chatbot from an exported archive.
+    :param path: the archive path.
+    """
+    def __init__(self, path):
+        super().__init__(QEvent.User)
+        self._path = path
+
+    def type(self):
+        return ImportChatBotEventType
+
+    @property
+    def path(self):
+        return self._path
+
+
+class ChatBotImportedEvent(QEvent):
+    """
+    This event is used to notify that a chatbot is imported and saved.
+    :param data: the chatbot data.
+    """
+    def __init__(self, data):
+        super().__init__(QEvent.User)
+        self._data = data
+
+    def type(self):
+        return ChatBotImportedEventType
+
+    @property
+    def data(self):
+        return self._data
+
+
+class StreamMessageEvent(QEvent):
+    """
+    This event is used to show a chunk of a reply being generated.
+    :param history_id: the id of the history.
+    :param chatbot_id: the id of the chatbot.
+    :param text: the chunk of the reply.
+    :param finished: if the reply is done or stopped.
+    """
+    def __init__(self, history_id, chatbot_id, text, finished=False):
+        super().__init__(QEvent.User)
+        self._history_id = history_id
+        self._chatbot_id = chatbot_id
+        self._text = text
+        self._finished = finished
+
+    def type(self):
+        return StreamMessageEventType
+
+    @property
+    def history_id(self):
+        return self._history_id
+
+    @property
+    def chatbot_id(self):
+        return self._chatbot_id
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def finished(self):
+        return self._finished
+
+
+class SpeakSegmentEvent(QEvent):
+    """
+    This event is used to play a sentence of a reply being spoken, the sentences come in order.
+    :param history_id: the id of the history.
+    :param chatbot_id: the id of the chatbot.
+    :param path: the wave file of the sentence.
+    :param index: the index of the segment among the ones of the reply, from 0. The first one is 0 also if the first
+    sentences failed.
+    """
+    def __init__(self, history_id, chatbot_id, path, index):
+        super().__init__(QEvent.User)
+        self._history_id = history_id
+        self._chatbot_id = chatbot_id
+        self._path = path
+        self._index = index
+
+    def type(self):
+        return SpeakSegmentEventType
+
+    @property
+    def history_id(self):
+        return self._history_id
+
+    @property
+    def chatbot_id(self):
+        return self._chatbot_id
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def index(self):
+        return self._index
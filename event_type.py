@@ -12,4 +12,10 @@ DeleteMessageEventType = QEvent.registerEventType()
 SendMessageEventType = QEvent.registerEventType()
 SpeakMessageEventType = QEvent.registerEventType()
 ChatBotThreadStatusChangedEventType = QEvent.registerEventType()
-StopChatbotThreadEventType = QEvent.registerEventType()
\ No newline at end of file
+StopChatbotThreadEventType = QEvent.registerEventType()
+SearchMessageEventType = QEvent.registerEventType()
+ExportChatBotEventType = QEvent.registerEventType()
+ImportChatBotEventType = QEvent.registerEventType()
+ChatBotImportedEventType = QEvent.registerEventType()
+StreamMessageEventType = QEvent.registerEventType()
+SpeakSegmentEventType = QEvent.registerEventType()
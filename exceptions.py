@@ -5,4 +5,10 @@ class ChatGPTException(Exception):
     pass
 
 class SpeakerException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an endpoint which is down, see resilience.CircuitBreaker.
+    """
+    pass
@@ -0,0 +1,264 @@
+import collections
+import io
+import json
+import os
+import re
+import shutil
+import time
+import zipfile
+
+from storage import message_order_key
+
+EXPORT_FORMAT = 'aichat-chatbot'
+EXPORT_VERSION = 1
+SOUND_PATH = './download/sounds'
+AVATAR_PATH = './resources/images/imported'
+
+
+def export_chatbot(storage, chatbot, path, sound_path=SOUND_PATH, page_size=500) -> dict:
+    """
+    Export a chatbot into a zip archive:
+    manifest.json, the format and the ids.
+    chatbot.json, the gpt params, the character and the metadata of the histories.
+    histories/<history_id>.jsonl, the messages of a history, one per line from the oldest.
+    sounds/<message_id>.wav, the speech of the messages which have one.
+    avatar/<file name>, the avatar of the character.
+    The messages are paged out of the storage and written one by one, so only one page is in memory.
+    :param storage: storage.Storage
+    :param chatbot: dict, the chatbot without messages, see ChatBotData.get_meta_data. Save the changes first.
+    :param path: the archive path, it is written to a temporary file and moved there when done.
+    :param sound_path: the directory of the message sounds.
+    :param page_size: how many messages are read from the storage at once.
+    :return: dict, {'messages': int, 'sounds': int, 'seconds': float, 'messages_per_second': float}
+    """
+    begin = time.perf_counter()
+    message_count = 0
+    sound_count = 0
+    temp_path = path + '.tmp'
+    with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        avatar_path = chatbot['character'].get('avatar_path')
+        avatar_name = None
+        if avatar_path and os.path.isfile(avatar_path):
+            avatar_name = f'avatar/{os.path.basename(avatar_path)}'
+            archive.write(avatar_path, avatar_name)
+        archive.writestr('manifest.json', json.dumps({
+            'format': EXPORT_FORMAT,
+            'version': EXPORT_VERSION,
+            'chatbot_id': chatbot['chatbot_id'],
+            'history_ids': [history['history_id'] for history in chatbot['histories']],
+            'avatar': avatar_name,
+        }, ensure_ascii=False))
+        archive.writestr('chatbot.json', json.dumps(chatbot, ensure_ascii=False))
+        for history in chatbot['histories']:
+            # the sounds are written after the history, the archive takes one file at a time
+            sound_files = []
+            with archive.open(f'histories/{history["history_id"]}.jsonl', 'w', force_zip64=True) as f:
+                for message in _iter_messages(storage, chatbot['chatbot_id'], history['history_id'], page_size):
+                    f.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+                    message_count += 1
+                    sound_file = os.path.join(sound_path, f'{message["message_id"]}.wav')
+                    if os.path.isfile(sound_file):
+                        sound_files.append(sound_file)
+            for sound_file in sound_files:
+                # the wave data hardly compresses
+                archive.write(sound_file, f'sounds/{os.path.basename(sound_file)}', zipfile.ZIP_STORED)
+            sound_count += len(sound_files)
+    os.replace(temp_path, path)
+    return _get_stats(message_count, sound_count, begin)
+
+
+def _iter_messages(storage, chatbot_id, history_id, page_size):
+    after = None
+    while True:
+        page = storage.load_messages(chatbot_id, history_id, after=after, limit=page_size, from_oldest=True)
+        if not page:
+            return
+        yield from page
+        after = message_order_key(page[-1])
+
+
+def _get_stats(message_count, sound_count, begin):
+    seconds = time.perf_counter() - begin
+    return {'messages': message_count, 'sounds': sound_count, 'seconds': seconds,
+            'messages_per_second': message_count / seconds if seconds else 0.0}
+
+
+# the ids of an archive are used in file names, they may only be plain names, like the ones of utils.generate_id
+_SAFE_ID = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def check_id(id_, kind) -> str:
+    """
+    Check an id read from an archive before it is used in a path, so a crafted archive can not write outside the save.
+    :param id_: the id.
+    :param kind: str, what the id is of, for the error.
+    :return: str, the id.
+    :raise ValueError: if the id is not a plain name.
+    """
+    if not isinstance(id_, str) or not _SAFE_ID.fullmatch(id_):
+        raise ValueError(f'The archive has an invalid {kind} id: {id_!r}')
+    return id_
+
+
+def read_manifest(path) -> dict:
+    """
+    Read the manifest of an exported chatbot.
+    :param path: the archive path.
+    :return: dict
+    :raise ValueError: if the archive is not an export, or its chatbot id is not a plain name.
+    """
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read('manifest.json'))
+    if manifest.get('format') != EXPORT_FORMAT or manifest.get('version', 0) > EXPORT_VERSION:
+        raise ValueError(f'{path} is not a chatbot export this version can read.')
+    check_id(manifest.get('chatbot_id'), 'chatbot')
+    return manifest
+
+
+class ChatBotImporter:
+    """
+    Import a chatbot exported by export_chatbot into a storage. The messages are streamed out of the archive and saved
+    in batches, and the progress is saved after every batch, so an interrupted import goes on from there when it is
+    run again. Saving a message twice is a no-op for the storages, so a batch interrupted in the middle is safe to
+    save again.
+    :param apply: callable(records), saves the journal records before it returns, e.g. Storage.apply.
+    :param progress_path: the directory of the progress files, one per chatbot being imported.
+    :param sound_path: the directory the message sounds are extracted into.
+    :param avatar_path: the directory the avatar is extracted into.
+    :param batch_size: how many messages are saved at once.
+    :param tail_size: how many of the latest messages of every history are returned for loading.
+    """
+
+    def __init__(self, apply, progress_path, sound_path=SOUND_PATH, avatar_path=AVATAR_PATH, batch_size=1000,
+                 tail_size=50):
+        self._apply = apply
+        self._progress_path = progress_path
+        self._sound_path = sound_path
+        self._avatar_path = avatar_path
+        self._batch_size = batch_size
+        self._tail_size = tail_size
+
+    def _get_progress_file(self, chatbot_id):
+        return os.path.join(self._progress_path, f'{check_id(chatbot_id, "chatbot")}.import.json')
+
+    def get_unfinished(self) -> list[tuple[str, str]]:
+        """
+        The interrupted imports.
+        :return: list of (chatbot_id, archive path)
+        """
+        if not os.path.isdir(self._progress_path):
+            return []
+        unfinished = []
+        for file_name in sorted(os.listdir(self._progress_path)):
+            if file_name.endswith('.import.json'):
+                with open(os.path.join(self._progress_path, file_name), 'r', encoding='utf-8') as f:
+                    unfinished.append((file_name.removesuffix('.import.json'), json.load(f)['source']))
+        return unfinished
+
+    def is_unfinished(self, chatbot_id) -> bool:
+        return os.path.exists(self._get_progress_file(chatbot_id))
+
+    def discard(self, chatbot_id) -> None:
+        """
+        Forget an interrupted import, e.g. when its archive is gone.
+        :param chatbot_id: str
+        :return:
+        """
+        if self.is_unfinished(chatbot_id):
+            os.remove(self._get_progress_file(chatbot_id))
+
+    def run(self, path) -> tuple[dict, dict]:
+        """
+        Import a chatbot, or go on with its interrupted import.
+        :param path: the archive path.
+        :return: (dict, dict), the chatbot with the latest messages of every history and a 'message_count', like
+        Storage.load with a tail_size, and {'messages': int, 'sounds': int, 'seconds': float,
+        'messages_per_second': float}, the messages saved by this run.
+        """
+        begin = time.perf_counter()
+        manifest = read_manifest(path)
+        chatbot_id = manifest['chatbot_id']
+        progress = self._load_progress(chatbot_id, path)
+        message_count = 0
+        sound_count = 0
+        with zipfile.ZipFile(path) as archive:
+            chatbot = json.loads(archive.read('chatbot.json'))
+            # the chatbot is saved under the id of the manifest, which the progress and the avatar are named by
+            chatbot['chatbot_id'] = chatbot_id
+            if manifest.get('avatar'):
+                avatar_file = os.path.join(self._avatar_path, f'{chatbot_id}_{os.path.basename(manifest["avatar"])}')
+                self._extract(archive, manifest['avatar'], avatar_file)
+                chatbot['character']['avatar_path'] = avatar_file
+            if not progress['histories']:
+                self._apply([{'op': 'chatbot', 'chatbot': chatbot}])
+            names = set(archive.namelist())
+            for history in chatbot['histories']:
+                history_id = check_id(history['history_id'], 'history')
+                # the lines before done are saved already, they are read again only for the tail
+                done = progress['histories'].get(history_id, 0)
+                tail = collections.deque(maxlen=self._tail_size)
+                batch = []
+                line_count = 0
+                with archive.open(f'histories/{history_id}.jsonl') as f:
+                    # the archive inflates in small steps, a large buffer reads the lines several times faster
+                    for line in io.TextIOWrapper(io.BufferedReader(f, 1 << 20), encoding='utf-8'):
+                        if not line.strip():
+                            continue
+                        message = json.loads(line)
+                        check_id(message.get('message_id'), 'message')
+                        message['chatbot_id'] = chatbot_id
+                        tail.append(message)
+                        line_count += 1
+                        if line_count <= done:
+                            continue
+                        batch.append({'op': 'append', 'chatbot_id': chatbot_id, 'history_id': history_id,
+                                      'message': message})
+                        sound_name = f'sounds/{message["message_id"]}.wav'
+                        if sound_name in names:
+                            self._extract(archive, sound_name, os.path.join(self._sound_path,
+                                                                             f'{message["message_id"]}.wav'))
+                            sound_count += 1
+                        if len(batch) >= self._batch_size:
+                            message_count += self._save_batch(batch, progress, chatbot_id, history_id, line_count)
+                            batch = []
+                if batch:
+                    message_count += self._save_batch(batch, progress, chatbot_id, history_id, line_count)
+                progress['histories'][history_id] = line_count
+                history['history_list'] = list(tail)
+                history['message_count'] = line_count
+        os.remove(self._get_progress_file(chatbot_id))
+        return chatbot, _get_stats(message_count, sound_count, begin)
+
+    def _save_batch(self, batch, progress, chatbot_id, history_id, line_count) -> int:
+        self._apply(batch)
+        progress['histories'][history_id] = line_count
+        self._save_progress(chatbot_id, progress)
+        return len(batch)
+
+    def _load_progress(self, chatbot_id, path) -> dict:
+        progress_file = self._get_progress_file(chatbot_id)
+        if os.path.exists(progress_file):
+            with open(progress_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        progress = {'source': os.path.abspath(path), 'histories': {}}
+        self._save_progress(chatbot_id, progress)
+        return progress
+
+    def _save_progress(self, chatbot_id, progress):
+        os.makedirs(self._progress_path, exist_ok=True)
+        progress_file = self._get_progress_file(chatbot_id)
+        with open(progress_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(progress, f, ensure_ascii=False)
+        os.replace(progress_file + '.tmp', progress_file)
+
+    @staticmethod
+    def _extract(archive, name, target):
+        """
+        Extract one file of the archive, a file extracted by an interrupted run is kept.
+        """
+        if os.path.exists(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with archive.open(name) as source, open(target + '.tmp', 'wb') as f:
+            shutil.copyfileobj(source, f)
+        os.replace(target + '.tmp', target)
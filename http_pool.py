@@ -0,0 +1,154 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import utils
+
+# the connect and read timeouts of a request, in seconds
+DEFAULT_TIMEOUT = (3.05, 30)
+
+# the handshakes of the current thread, a request reads them after it is sent
+_handshakes = threading.local()
+
+
+def _record_handshake(begin):
+    _handshakes.count = getattr(_handshakes, 'count', 0) + 1
+    _handshakes.seconds = getattr(_handshakes, 'seconds', 0.0) + time.perf_counter() - begin
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        begin = time.perf_counter()
+        super().connect()
+        _record_handshake(begin)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        # the TCP and the TLS handshakes
+        begin = time.perf_counter()
+        super().connect()
+        _record_handshake(begin)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool,
+                                                   'https': _TimedHTTPSConnectionPool}
+
+
+class HTTPPool:
+    """
+    The HTTP sessions of the providers, e.g. the translaters and the TTS server. Every provider has a session of its own
+    which keeps its connections alive, so only the first request to a host pays the TCP and TLS handshakes. The sessions
+    are created on the first request and shared by the threads.
+    The time of every request and of the handshakes it paid is counted per provider, see get_metrics.
+    :param pool_size: int, the max count of kept connections per host, at least the thread count which sends the
+    requests.
+    :param timeout: (float, float), the default connect and read timeouts in seconds.
+    """
+
+    def __init__(self, pool_size=4, timeout=DEFAULT_TIMEOUT):
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._sessions: dict[str, requests.Session] = {}
+        self._metrics: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, provider) -> requests.Session:
+        """
+        Get the session of a provider, create it if there is none.
+        :param provider: str, the provider name, e.g. 'Youdao'.
+        :return: requests.Session
+        """
+        with self._lock:
+            session = self._sessions.get(provider)
+            if session is None:
+                session = requests.Session()
+                adapter = _TimedAdapter(pool_connections=2, pool_maxsize=self._pool_size, pool_block=False)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[provider] = session
+                # the counts go on after the sessions are closed
+                self._metrics.setdefault(provider, {'requests': 0, 'seconds': 0.0, 'handshakes': 0,
+                                                    'handshake_seconds': 0.0})
+            return session
+
+    def request(self, provider, method, url, timeout=None, **kwargs) -> requests.Response:
+        """
+        Send a request with the session of a provider. The arguments are the ones of requests.request.
+        :param provider: str, the provider name.
+        :param method: str, e.g. 'GET'.
+        :param url: str
+        :param timeout: float or (float, float), [optional] the connect and read timeouts, the default ones of the pool
+        if not set.
+        :return: requests.Response
+        """
+        session = self.get_session(provider)
+        _handshakes.count = 0
+        _handshakes.seconds = 0.0
+        begin = time.perf_counter()
+        try:
+            return session.request(method, url, timeout=timeout or self._timeout, **kwargs)
+        finally:
+            seconds = time.perf_counter() - begin
+            with self._lock:
+                metrics = self._metrics[provider]
+                metrics['requests'] += 1
+                metrics['seconds'] += seconds
+                metrics['handshakes'] += _handshakes.count
+                metrics['handshake_seconds'] += _handshakes.seconds
+            utils.debug(f'{provider} {method} {url} in {seconds * 1000:.0f}ms, '
+                        f'{_handshakes.count} handshakes in {_handshakes.seconds * 1000:.0f}ms.')
+
+    def get(self, provider, url, **kwargs) -> requests.Response:
+        return self.request(provider, 'GET', url, **kwargs)
+
+    def post(self, provider, url, **kwargs) -> requests.Response:
+        return self.request(provider, 'POST', url, **kwargs)
+
+    def warm_up(self, provider, url) -> bool:
+        """
+        Open a connection to the host of a url and keep it, so the first real request does not wait for the handshakes.
+        Any response of the host will do, the errors are only logged.
+        :param provider: str, the provider name.
+        :param url: str
+        :return: bool, if the host answered.
+        """
+        try:
+            self.request(provider, 'HEAD', url, allow_redirects=False)
+        except requests.RequestException as e:
+            utils.debug(f'Warming up {provider} failed: {e}')
+            return False
+        return True
+
+    def get_metrics(self) -> dict[str, dict]:
+        """
+        The counts of the providers since the start.
+        :return: dict, {provider: {'requests': int, 'seconds': float, 'handshakes': int, 'handshake_seconds': float}}
+        """
+        with self._lock:
+            return {provider: dict(metrics) for provider, metrics in self._metrics.items()}
+
+    def close(self) -> None:
+        """
+        Close the kept connections, the sessions are created again by the next request.
+        :return:
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
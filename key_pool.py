@@ -0,0 +1,157 @@
+import itertools
+import threading
+import time
+
+import openai
+
+import utils
+
+# how long a key is left out after the api throttles it without a Retry-After, and after it rejects it
+THROTTLED_COOL_DOWN = 20.0
+REJECTED_COOL_DOWN = 600.0
+
+
+class APIKey:
+    """
+    An openai account the requests can be sent with.
+    :param api_key: str
+    :param api_base: str, [optional] the base url, e.g. of a proxy.
+    :param organization: str, [optional]
+    :param requests_per_minute: int, [optional] the quota of the key for every model, instead of the one of the model,
+    see rate_limiter.MODEL_RATE_LIMITS.
+    :param tokens_per_minute: int, [optional] see requests_per_minute.
+    :param chatbot_ids: list of str, [optional] the chatbots pinned to the key.
+    """
+
+    def __init__(self, api_key, api_base=None, organization=None, requests_per_minute=None, tokens_per_minute=None,
+                 chatbot_ids=()):
+        self._api_key = api_key
+        self._api_base = api_base
+        self._organization = organization
+        self._requests_per_minute = requests_per_minute
+        self._tokens_per_minute = tokens_per_minute
+        self._chatbot_ids = set(chatbot_ids)
+
+    def get_credentials(self) -> dict:
+        """
+        The arguments which send an openai request with the key.
+        :return: dict
+        """
+        credentials = {'api_key': self._api_key}
+        if self._api_base:
+            credentials['api_base'] = self._api_base
+        if self._organization:
+            credentials['organization'] = self._organization
+        return credentials
+
+    def get_limits(self) -> tuple[int, int] | None:
+        """
+        :return: (requests per minute, tokens per minute), or None if the key has no quota of its own.
+        """
+        if self._requests_per_minute and self._tokens_per_minute:
+            return self._requests_per_minute, self._tokens_per_minute
+        return None
+
+    def is_pinned_to(self, chatbot_id) -> bool:
+        return chatbot_id in self._chatbot_ids
+
+    is_pinned = property(lambda self: bool(self._chatbot_ids))
+
+    api_key = property(lambda self: self._api_key)
+    # the key is not shown in the logs
+    name = property(lambda self: f'...{self._api_key[-4:]}')
+
+
+class APIKeyPool:
+    """
+    The openai keys of the app. Every request is sent with the available key which has the most quota left, the keys
+    throttled or rejected by the api are left out for a while. A chatbot pinned to keys only uses them, and the other
+    chatbots leave them to it.
+    """
+
+    def __init__(self):
+        self._keys: list[APIKey] = []
+        # api key -> the time it is available again
+        self._cool_downs: dict[str, float] = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def setup(self, openai_config) -> None:
+        """
+        Set the keys of the config, the main key first.
+        :param openai_config: OpenAIConfigData
+        :return:
+        """
+        keys = []
+        if openai_config.openai_api_key:
+            keys.append(APIKey(openai_config.openai_api_key))
+        for key_data in openai_config.api_keys:
+            if not key_data.get('api_key'):
+                continue
+            key = APIKey(**key_data)
+            # the main key may be listed again with its settings
+            keys = [old_key for old_key in keys if old_key.api_key != key.api_key] + [key]
+        with self._lock:
+            self._keys = keys
+            self._cool_downs.clear()
+
+    def get_key(self, api_key) -> APIKey | None:
+        with self._lock:
+            return next((key for key in self._keys if key.api_key == api_key), None)
+
+    def choose(self, chatbot_id=None, get_remaining=None) -> APIKey | None:
+        """
+        Choose the key of the next request.
+        :param chatbot_id: str, [optional] the chatbot which sends the request.
+        :param get_remaining: callable(api key) -> float, [optional] the share of the quota the key has left.
+        :return: APIKey, or None if there is no key.
+        """
+        with self._lock:
+            # the pinned keys are kept for their chatbots, unless there are only pinned keys
+            keys = ([key for key in self._keys if key.is_pinned_to(chatbot_id)]
+                    or [key for key in self._keys if not key.is_pinned] or self._keys)
+            if not keys:
+                return None
+            now = time.monotonic()
+            available = [key for key in keys if self._cool_downs.get(key.api_key, 0) <= now]
+            if not available:
+                # all the keys are out, the one back first is tried
+                return min(keys, key=lambda key: self._cool_downs[key.api_key])
+            turn = next(self._turn)
+        # the quota is read without the lock, the limiter looks up the keys too
+        remaining = [get_remaining(key.api_key) if get_remaining else 0.0 for key in available]
+        # the turn breaks the ties, so the keys with the same quota take turns
+        index = max(range(len(available)), key=lambda i: (remaining[i], -((i - turn) % len(available))))
+        return available[index]
+
+    def cool_down(self, key: APIKey, seconds) -> None:
+        """
+        Leave a key out of the rotation for a while.
+        :param key: APIKey
+        :param seconds: float
+        :return:
+        """
+        with self._lock:
+            self._cool_downs[key.api_key] = max(self._cool_downs.get(key.api_key, 0), time.monotonic() + seconds)
+
+    def report_error(self, key: APIKey, error, retry_after=None) -> None:
+        """
+        Leave a key out after the api throttles or rejects it.
+        :param key: APIKey
+        :param error: Exception, the error of the request.
+        :param retry_after: float, [optional] the seconds the api asked to wait.
+        :return:
+        """
+        if isinstance(error, openai.error.RateLimitError):
+            self.cool_down(key, retry_after or THROTTLED_COOL_DOWN)
+            utils.debug(f'The openai key {key.name} is throttled.')
+        elif isinstance(error, (openai.error.AuthenticationError, openai.error.PermissionError)):
+            self.cool_down(key, REJECTED_COOL_DOWN)
+            utils.warn(f'The openai key {key.name} is rejected: {error}')
+
+    def __len__(self):
+        return len(self._keys)
+
+
+# the keys of the process
+pool = APIKeyPool()
@@ -0,0 +1,297 @@
+import threading
+import time
+
+import openai
+
+import context_builder
+import key_pool
+import resilience
+import utils
+from AIChatEnum import CallPriority
+
+# the requests and tokens per minute of a key, matched by the longest prefix of the model name
+MODEL_RATE_LIMITS = {
+    'gpt-3.5-turbo': (3500, 90_000),
+    'gpt-4': (200, 40_000),
+    'text-embedding-ada-002': (3000, 1_000_000),
+}
+DEFAULT_RATE_LIMITS = (3500, 90_000)
+# the tokens reserved for a reply without max_tokens, corrected by the usage of the response
+DEFAULT_COMPLETION_TOKENS = 256
+# the share of the buckets the background calls leave to the interactive ones
+BACKGROUND_RESERVE = 0.2
+
+
+class TokenBucket:
+    """
+    A bucket which is refilled evenly, up to a limit per minute. It is full at the start. Taking more than there is
+    drives it below zero, which is waited out before the next take.
+    :param per_minute: int, the capacity, refilled every minute.
+    """
+
+    def __init__(self, per_minute):
+        self._capacity = float(per_minute)
+        self._level = float(per_minute)
+        self._updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self._capacity, self._level + (now - self._updated_at) * self._capacity / 60)
+        self._updated_at = now
+
+    def get_wait(self, amount, reserve=0.0) -> float:
+        """
+        :param amount: float, the amount to take, at most the capacity.
+        :param reserve: float, the share of the capacity to leave in the bucket.
+        :return: float, the seconds until the amount can be taken, 0 if it can be now.
+        """
+        self._refill()
+        missing = min(amount, self._capacity) + reserve * self._capacity - self._level
+        return max(missing, 0.0) * 60 / self._capacity
+
+    def get_level(self) -> float:
+        self._refill()
+        return self._level
+
+    def take(self, amount) -> None:
+        self._refill()
+        self._level -= amount
+
+    def give_back(self, amount) -> None:
+        """
+        Put back what was taken but not used, or take what was used more, if the amount is negative.
+        :param amount: float
+        :return:
+        """
+        self._refill()
+        self._level = min(self._capacity, self._level + amount)
+
+    capacity = property(lambda self: self._capacity)
+
+
+class Reservation:
+    """
+    The request and the tokens a call took from the buckets of its key and model. Settle it with the tokens the call
+    used when they are known, the difference goes back to the bucket.
+    """
+
+    def __init__(self, limiter, bucket_key, tokens):
+        self._limiter = limiter
+        self._bucket_key = bucket_key
+        self._tokens = tokens
+        self._settled = False
+
+    def settle(self, used_tokens=None) -> None:
+        """
+        :param used_tokens: int, [optional] the tokens the call used, the reserved tokens are kept if not known.
+        :return:
+        """
+        if self._settled:
+            return
+        self._settled = True
+        if used_tokens is not None:
+            self._limiter.give_back(self._bucket_key, self._tokens - used_tokens)
+
+    tokens = property(lambda self: self._tokens)
+
+
+class RateLimiter:
+    """
+    The requests per minute and the tokens per minute of the openai calls, per api key and model, shared by all the
+    chatbots. The limits are the ones of the model, or the quota of the key if it has one, see key_pool.APIKey. A call
+    waits until both buckets have room for it. The background calls also leave a share of the buckets
+    to the interactive ones, and wait while any interactive call waits.
+    :param limits: dict, [optional] {model prefix: (requests per minute, tokens per minute)}, see MODEL_RATE_LIMITS.
+    """
+
+    def __init__(self, limits=None):
+        self._limits = dict(MODEL_RATE_LIMITS)
+        self._limits.update(limits or {})
+        # (api key, model) -> (requests bucket, tokens bucket)
+        self._buckets: dict[tuple[str, str], tuple[TokenBucket, TokenBucket]] = {}
+        self._interactive_waiting = 0
+        self._condition = threading.Condition()
+
+    def set_limits(self, model, requests_per_minute, tokens_per_minute) -> None:
+        """
+        Set the limits of the models starting with a name, e.g. the ones of the account tier. The buckets are created
+        again.
+        :param model: str, the model name or prefix.
+        :param requests_per_minute: int
+        :param tokens_per_minute: int
+        :return:
+        """
+        with self._condition:
+            self._limits[model] = (requests_per_minute, tokens_per_minute)
+            self._buckets = {key: buckets for key, buckets in self._buckets.items() if not key[1].startswith(model)}
+            self._condition.notify_all()
+
+    def get_limits(self, model) -> tuple[int, int]:
+        names = [name for name in self._limits if model.startswith(name)]
+        return self._limits[max(names, key=len)] if names else DEFAULT_RATE_LIMITS
+
+    def reset(self) -> None:
+        """
+        Forget the buckets, e.g. when the keys or their quotas change.
+        :return:
+        """
+        with self._condition:
+            self._buckets.clear()
+            self._condition.notify_all()
+
+    def get_remaining(self, api_key, model) -> float:
+        """
+        The share of the requests or the tokens a key has left for a model, whichever is less.
+        :param api_key: str
+        :param model: str
+        :return: float, 1 for full buckets, below 0 while the taken ones are waited out.
+        """
+        with self._condition:
+            requests_bucket, tokens_bucket = self._get_buckets((api_key or '', model))
+            return min(requests_bucket.get_level() / requests_bucket.capacity,
+                       tokens_bucket.get_level() / tokens_bucket.capacity)
+
+    def _get_buckets(self, bucket_key):
+        buckets = self._buckets.get(bucket_key)
+        if buckets is None:
+            key = key_pool.pool.get_key(bucket_key[0])
+            limits = key.get_limits() if key else None
+            requests_per_minute, tokens_per_minute = limits or self.get_limits(bucket_key[1])
+            buckets = self._buckets[bucket_key] = (TokenBucket(requests_per_minute), TokenBucket(tokens_per_minute))
+        return buckets
+
+    def acquire(self, api_key, model, tokens, priority=CallPriority.Interactive) -> Reservation:
+        """
+        Wait until a call may be sent, and take a request and its tokens from the buckets.
+        :param api_key: str
+        :param model: str
+        :param tokens: int, the estimated tokens of the call, the prompt and the reply.
+        :param priority: CallPriority
+        :return: Reservation
+        """
+        bucket_key = (api_key or '', model)
+        interactive = priority == CallPriority.Interactive
+        begin = time.monotonic()
+        with self._condition:
+            if interactive:
+                self._interactive_waiting += 1
+            try:
+                while True:
+                    requests_bucket, tokens_bucket = self._get_buckets(bucket_key)
+                    reserve = 0.0 if interactive else BACKGROUND_RESERVE
+                    wait = max(requests_bucket.get_wait(1, reserve), tokens_bucket.get_wait(tokens, reserve))
+                    if not interactive and self._interactive_waiting:
+                        # woken up when the interactive calls are sent
+                        wait = max(wait, 1.0)
+                    elif wait <= 0:
+                        requests_bucket.take(1)
+                        tokens_bucket.take(tokens)
+                        break
+                    self._condition.wait(wait)
+            finally:
+                if interactive:
+                    self._interactive_waiting -= 1
+                    self._condition.notify_all()
+        waited = time.monotonic() - begin
+        if waited > 0.05:
+            utils.debug(f'{priority.name} {model} call waited {waited:.2f}s for the rate limit.')
+        return Reservation(self, bucket_key, tokens)
+
+    def give_back(self, bucket_key, tokens) -> None:
+        with self._condition:
+            self._get_buckets(bucket_key)[1].give_back(tokens)
+            self._condition.notify_all()
+
+
+# the limiter of the process
+limiter = RateLimiter()
+
+
+def estimate_tokens(model, messages=None, input_=None, max_tokens=None) -> int:
+    """
+    Estimate the tokens of an openai call before it is sent, see context_builder.count_tokens.
+    :param model: str
+    :param messages: list of dict, [optional] the messages of a chat call.
+    :param input_: str or list of str, [optional] the input of an embedding call.
+    :param max_tokens: int, [optional] the max tokens of the reply of a chat call.
+    :return: int
+    """
+    tokens = 0
+    if messages is not None:
+        tokens += sum(context_builder.count_message_tokens(message['content'], model) for message in messages)
+        tokens += context_builder.REPLY_OVERHEAD + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+    if input_ is not None:
+        for text in [input_] if isinstance(input_, str) else input_:
+            tokens += context_builder.count_tokens(text, model)
+    return tokens
+
+
+class _Stream:
+    """
+    A streamed reply which settles its reservation when it ends: the reply tokens are counted from the chunks, the
+    stream has no usage.
+    """
+
+    def __init__(self, response, reservation, prompt_tokens, model):
+        self._response = response
+        self._reservation = reservation
+        self._prompt_tokens = prompt_tokens
+        self._model = model
+        self._chunks = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._response)
+        except Exception:
+            # the end of the stream too
+            self._settle()
+            raise
+        choices = chunk.get('choices') if hasattr(chunk, 'get') else None
+        if choices:
+            self._chunks.append(choices[0].get('delta', {}).get('content') or '')
+        return chunk
+
+    def close(self):
+        self._settle()
+        if hasattr(self._response, 'close'):
+            self._response.close()
+
+    def _settle(self):
+        self._reservation.settle(self._prompt_tokens + context_builder.count_tokens(''.join(self._chunks), self._model))
+
+
+def call_openai(function, priority=CallPriority.Interactive, chatbot_id=None, **kwargs):
+    """
+    Call an openai api function with a key of the key pool, see key_pool.APIKeyPool, when the rate limit of the key and
+    the model lets it, see RateLimiter. The tokens of the call are estimated and reserved before, and corrected by the
+    usage of the response after. A streamed reply is corrected when it ends.
+    :param function: callable, e.g. openai.ChatCompletion.create.
+    :param priority: CallPriority
+    :param chatbot_id: str, [optional] the chatbot which sends the call, for the keys pinned to it.
+    :param kwargs: the arguments of the function, with the model.
+    :return: the response of the function.
+    """
+    model = kwargs['model']
+    key = key_pool.pool.choose(chatbot_id, lambda api_key: limiter.get_remaining(api_key, model))
+    if key:
+        kwargs.update(key.get_credentials())
+    api_key = kwargs.get('api_key') or openai.api_key
+    tokens = estimate_tokens(model, kwargs.get('messages'), kwargs.get('input'), kwargs.get('max_tokens'))
+    reservation = limiter.acquire(api_key, model, tokens, priority)
+    try:
+        response = function(**kwargs)
+    except Exception as e:
+        # the request is counted by the api, the tokens are not
+        reservation.settle(0)
+        if key:
+            key_pool.pool.report_error(key, e, resilience.get_retry_after(e))
+        raise
+    if kwargs.get('stream'):
+        prompt_tokens = tokens - (kwargs.get('max_tokens') or DEFAULT_COMPLETION_TOKENS)
+        return _Stream(response, reservation, prompt_tokens, model)
+    usage = response.get('usage') if hasattr(response, 'get') else None
+    reservation.settle(usage.get('total_tokens') if usage else None)
+    return response
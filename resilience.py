@@ -0,0 +1,200 @@
+import email.utils
+import random
+import threading
+import time
+
+import openai
+import requests
+
+import utils
+from exceptions import CircuitOpenError
+
+OPENAI_ENDPOINT = 'openai'
+# the openai errors which may go away by themselves
+OPENAI_RETRY_ERRORS = (openai.error.RateLimitError, openai.error.APIConnectionError, openai.error.Timeout,
+                       openai.error.ServiceUnavailableError, openai.error.APIError, openai.error.TryAgain)
+# the requests errors which may go away by themselves, see raise_for_retry for the status codes
+HTTP_RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.HTTPError)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RetryPolicy:
+    """
+    How a call is retried: the delay before the n-th retry is random between 0 and base_delay * 2 ** (n - 1), at most
+    max_delay, so the clients which failed together do not come back together. A Retry-After of the backend is waited
+    instead, if it is longer, but no longer than max_delay.
+    :param attempts: int, the max count of calls, the first one included.
+    :param base_delay: float, in seconds.
+    :param max_delay: float, in seconds.
+    """
+
+    def __init__(self, attempts=4, base_delay=0.5, max_delay=20.0):
+        self._attempts = attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    def get_delay(self, retry, retry_after=None) -> float:
+        """
+        :param retry: int, the count of the retry, from 1.
+        :param retry_after: float, [optional] the seconds the backend asked to wait.
+        :return: float, the seconds to wait.
+        """
+        delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** (retry - 1)))
+        if retry_after:
+            delay = max(delay, retry_after)
+        return min(delay, self._max_delay)
+
+    attempts = property(lambda self: self._attempts)
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """
+    Fail the calls of an endpoint at once while it is down. After failure_threshold failures in a row the breaker
+    opens, and the calls fail with CircuitOpenError without trying. After reset_timeout one call is let through: if it
+    succeeds the breaker closes, else it opens again.
+    :param name: str, the endpoint name.
+    :param failure_threshold: int
+    :param reset_timeout: float, in seconds.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        If a call may be tried now.
+        :return: bool
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self._reset_timeout:
+                return False
+            # half open, one call finds out if the endpoint is back
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                utils.info(f'{self._name} is back.')
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self._failure_threshold):
+                if not self._probing:
+                    # warn once per outage, not per call
+                    utils.warn(f'{self._name} is not available, the calls are stopped for a while.')
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def get_retry_in(self) -> float:
+        """
+        :return: float, the seconds until a call is let through again, 0 if the breaker is closed.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(self._reset_timeout - (time.monotonic() - self._opened_at), 0.0)
+
+    is_open = property(lambda self: self._opened_at is not None)
+    name = property(lambda self: self._name)
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint) -> CircuitBreaker:
+    """
+    Get the circuit breaker of an endpoint, create it if there is none.
+    :param endpoint: str, e.g. 'openai', 'Youdao'.
+    :return: CircuitBreaker
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+        return breaker
+
+
+def get_retry_after(error) -> float | None:
+    """
+    Read the Retry-After header of the response an error is raised for.
+    :param error: Exception, an openai error or a requests error.
+    :return: float, the seconds to wait, or None if there is no header.
+    """
+    headers = getattr(error, 'headers', None)
+    if headers is None and getattr(error, 'response', None) is not None:
+        headers = error.response.headers
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        # an HTTP date
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def raise_for_retry(response: requests.Response) -> requests.Response:
+    """
+    Raise requests.HTTPError for the status codes a retry may help with, see RETRY_STATUS_CODES, so call retries them.
+    :param response: requests.Response
+    :return: the response, if it is not raised for.
+    """
+    if response.status_code in RETRY_STATUS_CODES:
+        raise requests.HTTPError(f'{response.status_code} {response.reason}', response=response)
+    return response
+
+
+def call(endpoint, function, *args, retry_on=OPENAI_RETRY_ERRORS, policy=DEFAULT_POLICY, **kwargs):
+    """
+    Call a function which sends a request to an endpoint, retry it on the errors of retry_on, see RetryPolicy, and
+    fail at once while the endpoint is down, see CircuitBreaker. The other errors are raised at once.
+    :param endpoint: str, the endpoint name, the calls of the same endpoint share a circuit breaker.
+    :param function: callable, called with args and kwargs.
+    :param retry_on: tuple of Exception types.
+    :param policy: RetryPolicy
+    :return: the return of the function.
+    :raise CircuitOpenError: if the endpoint is down.
+    """
+    breaker = get_breaker(endpoint)
+    retry = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(f'{endpoint} is not available, try again in {breaker.get_retry_in():.0f}s.')
+        try:
+            result = function(*args, **kwargs)
+        except retry_on as e:
+            breaker.record_failure()
+            retry += 1
+            if retry >= policy.attempts:
+                raise
+            delay = policy.get_delay(retry, get_retry_after(e))
+            utils.info(f'{endpoint} failed: {e}, retry {retry} in {delay:.1f}s.')
+            time.sleep(delay)
+        except Exception:
+            # the endpoint answered, the request itself is wrong
+            breaker.record_success()
+            raise
+        else:
+            breaker.record_success()
+            return result
@@ -0,0 +1,254 @@
+import heapq
+import os
+import re
+import sqlite3
+import threading
+
+from storage import message_order_key
+
+# kana, Han, hangul and the half-width katakana
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af\uff66-\uff9f'
+_CJK_RUN = re.compile(f'[{_CJK}]+')
+# a run of CJK characters, or a word of the other letters and digits
+_TOKEN = re.compile(f'[{_CJK}]+|[^\\W_{_CJK}]+')
+# the messages indexed in a transaction by a rebuild, the searches wait for one batch at most
+REBUILD_BATCH_SIZE = 500
+
+
+def tokenize(text) -> tuple[str, str]:
+    """
+    Split a text for the full-text index. CJK text has no spaces between the words, so a CJK run is split into
+    overlapping bigrams, and every character is kept too for the one-character queries. The other text is split into
+    lower case words.
+    :param text: str
+    :return: (str, str), the words and bigrams, and the CJK characters, separated by spaces.
+    """
+    tokens = []
+    chars = []
+    for match in _TOKEN.finditer(text):
+        run = match.group()
+        if _CJK_RUN.fullmatch(run):
+            chars.extend(run)
+            tokens.extend(run[index:index + 2] for index in range(len(run) - 1))
+        else:
+            tokens.append(run.lower())
+    return ' '.join(tokens), ' '.join(chars)
+
+
+def build_query(query) -> str | None:
+    """
+    Turn a search text into a fts5 query, which matches the messages containing every part of the text.
+    :param query: str
+    :return: str, or None if there is nothing to search.
+    """
+    parts = []
+    for match in _TOKEN.finditer(query):
+        run = match.group()
+        if not _CJK_RUN.fullmatch(run):
+            parts.append(f'tokens : "{run.lower()}"*')
+        elif len(run) == 1:
+            parts.append(f'chars : "{run}"')
+        else:
+            # the bigrams of a run are next to each other, a phrase of them matches the run
+            bigrams = ' '.join(run[index:index + 2] for index in range(len(run) - 1))
+            parts.append(f'tokens : "{bigrams}"')
+    return ' AND '.join(parts) if parts else None
+
+
+class SearchIndex:
+    """
+    A full-text index of the messages of all the chatbots, in a sqlite fts5 table next to the save. It is kept up to
+    date with the same journal records as the storage, see storage.Storage.
+    :param data_path: the save directory.
+    :param db_file: the index database file name.
+    """
+    _SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_index USING fts5(tokens, chars, tokenize = 'unicode61');
+        CREATE TABLE IF NOT EXISTS message_rows (
+            row_id INTEGER PRIMARY KEY,
+            chatbot_id TEXT NOT NULL,
+            history_id TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            send_time TEXT NOT NULL,
+            UNIQUE (history_id, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_message_rows_chatbot ON message_rows (chatbot_id);
+        CREATE INDEX IF NOT EXISTS idx_message_rows_send_time ON message_rows (send_time, message_id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, data_path='./save', db_file='search.db'):
+        if not os.path.exists(data_path):
+            os.mkdir(data_path)
+        self._lock = threading.Lock()
+        self._closing = False
+        # the records applied while rebuilding, they are indexed after it so the save writer is not blocked
+        self._pending_lock = threading.Lock()
+        self._pending_records = None
+        self._connection = sqlite3.connect(os.path.join(data_path, db_file), check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.executescript(self._SCHEMA)
+
+    def is_built(self) -> bool:
+        """
+        If the index has all the saved messages, otherwise rebuild it.
+        :return: bool
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = 'built'").fetchone()
+            return row is not None and row[0] == '1'
+
+    def rebuild(self, messages) -> bool:
+        """
+        Index all the messages again. The records applied meanwhile are queued, and indexed after it. The messages
+        are read without the lock and indexed in batches, so the searches meanwhile are not blocked, they find the
+        messages indexed so far.
+        :param messages: iterable of (chatbot_id, history_id, message dict), all the saved messages.
+        :return: bool, if the index is built, False if it is closed first.
+        """
+        with self._pending_lock:
+            self._pending_records = []
+        try:
+            with self._lock, self._connection:
+                self._connection.execute("DELETE FROM meta WHERE key = 'built'")
+                self._connection.execute('DELETE FROM message_index')
+                self._connection.execute('DELETE FROM message_rows')
+            batch = []
+            for item in messages:
+                batch.append(item)
+                if len(batch) >= REBUILD_BATCH_SIZE:
+                    self._insert_batch(batch)
+                    batch = []
+            self._insert_batch(batch, built=True)
+        except _RebuildCancelled:
+            with self._pending_lock:
+                self._pending_records = None
+            return False
+        with self._pending_lock:
+            records, self._pending_records = self._pending_records, None
+        self.apply(records)
+        return True
+
+    def search(self, query, limit=50, chatbot_id=None) -> list[tuple[str, str, str]]:
+        """
+        Find the messages containing the text, the latest first.
+        :param query: str, the words to find. A message has to contain all of them.
+        :param limit: int, the max count of hits.
+        :param chatbot_id: str, [optional] only search the messages of this chatbot.
+        :return: list of (chatbot_id, history_id, message_id)
+        """
+        match_query = build_query(query)
+        if match_query is None:
+            return []
+        # the rows are not inserted in send time order, e.g. the messages of an import, so the hits are sorted like
+        # storage.message_order_key
+        sql = ('SELECT r.chatbot_id, r.history_id, r.message_id FROM message_index '
+               'JOIN message_rows r ON r.row_id = message_index.rowid WHERE message_index MATCH ?')
+        params = [match_query]
+        if chatbot_id is not None:
+            sql += ' AND r.chatbot_id = ?'
+            params.append(chatbot_id)
+        sql += ' ORDER BY r.send_time DESC, r.message_id DESC LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def apply(self, records) -> None:
+        """
+        Index the changes of the journal records.
+        :param records: list of journal records.
+        :return:
+        """
+        with self._pending_lock:
+            if self._pending_records is not None:
+                self._pending_records.extend(records)
+                return
+        with self._lock, self._connection:
+            for record in records:
+                self._apply_record(record)
+
+    def _apply_record(self, record):
+        match record['op']:
+            case 'batch':
+                for batch_record in record['records']:
+                    self._apply_record(batch_record)
+            case 'chatbot':
+                chatbot = record['chatbot']
+                for history in chatbot['histories']:
+                    if 'history_list' not in history:
+                        continue
+                    self._delete_rows('history_id = ?', (history['history_id'],))
+                    for message in history['history_list']:
+                        self._insert_message(chatbot['chatbot_id'], history['history_id'], message)
+            case 'delete_chatbot':
+                self._delete_rows('chatbot_id = ?', (record['chatbot_id'],))
+            case 'append':
+                self._insert_message(record['chatbot_id'], record['history_id'], record['message'])
+            case 'delete':
+                self._delete_rows('history_id = ? AND message_id = ?', (record['history_id'], record['message_id']))
+
+    def _insert_batch(self, batch, built=False):
+        with self._lock:
+            if self._closing:
+                # the index is not marked built, it is built again on the next start
+                raise _RebuildCancelled
+            with self._connection:
+                for chatbot_id, history_id, message in batch:
+                    self._insert_message(chatbot_id, history_id, message)
+                if built:
+                    self._connection.execute("INSERT INTO meta (key, value) VALUES ('built', '1')")
+
+    def _insert_message(self, chatbot_id, history_id, message):
+        cursor = self._connection.execute(
+            'INSERT OR IGNORE INTO message_rows (chatbot_id, history_id, message_id, send_time) VALUES (?, ?, ?, ?)',
+            (chatbot_id, history_id, message['message_id'], message['send_time']))
+        if cursor.rowcount:
+            tokens, chars = tokenize(message['message'])
+            self._connection.execute('INSERT INTO message_index (rowid, tokens, chars) VALUES (?, ?, ?)',
+                                     (cursor.lastrowid, tokens, chars))
+
+    def _delete_rows(self, condition, params):
+        self._connection.execute(
+            f'DELETE FROM message_index WHERE rowid IN (SELECT row_id FROM message_rows WHERE {condition})', params)
+        self._connection.execute(f'DELETE FROM message_rows WHERE {condition}', params)
+
+    def close(self) -> None:
+        self._closing = True
+        with self._lock:
+            self._connection.close()
+
+
+class _RebuildCancelled(Exception):
+    pass
+
+
+def iter_saved_messages(storage, tails):
+    """
+    Iterate all the saved messages for SearchIndex.rebuild, the oldest first. The histories are paged at the same time
+    and merged by send time.
+    :param storage: storage.Storage, where the unloaded messages are paged from.
+    :param tails: list of (chatbot_id, history_id, list of message dict), the loaded messages of every history.
+    :return: generator of (chatbot_id, history_id, message dict)
+    """
+    histories = [_iter_history_messages(storage, chatbot_id, history_id, history_list)
+                 for chatbot_id, history_id, history_list in tails]
+    return heapq.merge(*histories, key=lambda item: message_order_key(item[2]))
+
+
+def _iter_history_messages(storage, chatbot_id, history_id, history_list):
+    after = None
+    history_list = sorted(history_list, key=message_order_key)
+    while history_list:
+        page = storage.load_messages(chatbot_id, history_id, before=message_order_key(history_list[0]), after=after,
+                                     limit=500, from_oldest=True)
+        if not page:
+            break
+        for message in page:
+            yield chatbot_id, history_id, message
+        after = message_order_key(page[-1])
+    for message in history_list:
+        yield chatbot_id, history_id, message
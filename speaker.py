@@ -2,23 +2,31 @@ import os
 import random
 import re
 import string
-import time
 
+import httpx
 import numpy as np
 import openai
 import requests
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
+import embedding_cache
+import rate_limiter
+import resilience
 import utils
 from AIChatEnum import SpeakerAPIType
 from gradio_client import Client
 
 from data import VITSConfigData, VITSConfigDataList
-from exceptions import SpeakerException
+from exceptions import CircuitOpenError, SpeakerException
+from http_pool import HTTPPool
+
+# the synthesis of a long text takes a while
+VITS_TIMEOUT = (3.05, 120)
+EMBEDDING_MODEL = 'text-embedding-ada-002'
 
 
 class Speaker:
-    def __init__(self, vits_config: VITSConfigDataList,
+    def __init__(self, vits_config: VITSConfigDataList, http_pool: HTTPPool,
                  emotion_mapping_path='./resources/mapping/emotion_no_duplicated.csv',
                  marked_emotion_mapping_path='./resources/mapping/nene_emotion_mapping.json',
                  dialogue_emotion_ordering_mapping_path='./resources/mapping/dialogue_emotion_ordering_mapping.json',
@@ -27,9 +35,11 @@ class Speaker:
         """
         The speaker class.
         :param vits_config: The vits config.
+        :param http_pool: The sessions to send the requests with.
         :param emotion_mapping_path: [optional] The path of the nene emotion mapping.
         """
         self._config = vits_config
+        self._http_pool = http_pool
         self._emotion_mapping_path = emotion_mapping_path
         self._marked_emotion_mapping_path = marked_emotion_mapping_path
         self._dialogue_emotion_ordering_mapping_path = dialogue_emotion_ordering_mapping_path
@@ -60,7 +70,8 @@ class Speaker:
                 self._marked_emotion_mapping_path,
                 self._dialogue_emotion_ordering_mapping_path,
                 self._dialogues_emotion_mapping_path,
-                self._dialogues_emotion_mapping_npy_path)
+                self._dialogues_emotion_mapping_npy_path,
+                self._http_pool)
 
     @staticmethod
     def join_address(api_address, api_port):
@@ -81,6 +92,23 @@ class Speaker:
         """
         return self._speaker(text, **kwargs)
 
+    def warm_up(self):
+        """
+        Connect to the speaker server before the first speech.
+        :return:
+        """
+        if self._speaker:
+            self._speaker.warm_up()
+
+    def get_emotion_candidates(self, text, context=None):
+        """
+        Look up the emotions which fit a text, before it is translated, see SpeakerW2V2.get_emotion_candidates.
+        :param text: the raw text.
+        :param context: [optional] the context.
+        :return: the candidates, pass them to speak as emotion_candidates.
+        """
+        return self._speaker.get_emotion_candidates(text, context)
+
     def play_emotion_sample_file(self, emotion_id, root_path):
         """
         Play the emotion sample file.
@@ -129,11 +157,19 @@ class SpeakerW2V2:
         self._processed_dialogues_emotion_mapping_npy = self._dialogues_emotion_mapping_npy[:, 0,
                                                         :] * self._text_weight + self._dialogues_emotion_mapping_npy[:,
                                                                                  1, :] * self._context_weight
+        self._dialogue_texts = [dialogue[0] for dialogue in self._dialogues_emotion_mapping.values()]
 
     @property
     def last_emotion_sample(self):
         return self._last_emotion_sample
 
+    def warm_up(self):
+        """
+        Connect to the server before the first speech, if the connection is kept.
+        :return:
+        """
+        pass
+
     def _get_emotion_sample(self, emotion, nsfw=None):
         """
         Get the emotion sample.
@@ -178,26 +214,50 @@ class SpeakerW2V2:
         :param text: the text.
         :return:
         """
+        return self.choose_emotion_sample(self.get_emotion_candidates(text, context), translated_text)
+
+    def get_emotion_candidates(self, text, context=None):
+        """
+        Find the dialogues closest to the text and the context by their embeddings. It only needs the raw text, so it
+        can run while the text is translated. The embeddings are cached, see embedding_cache.EmbeddingCache.
+        :param text: the raw text.
+        :param context: [optional] the context.
+        :return: list of int, the indices of the closest dialogues.
+        """
         if context:
-            r = openai.Embedding.create(
-                model='text-embedding-ada-002',
-                input=[text, context]
-            )
-            text_embedding = np.array(r['data'][0]['embedding'])
-            context_embedding = np.array(r['data'][1]['embedding'])
+            text_embedding, context_embedding = embedding_cache.cache.get_many(EMBEDDING_MODEL, [text, context],
+                                                                               self._fetch_embeddings)
             result_embedding = text_embedding * self._text_weight + context_embedding * self._context_weight
         else:
-            r = openai.Embedding.create(
-                model='text-embedding-ada-002',
-                input=text,
-            )
-            text_embedding = np.array(r['data'][0]['embedding'])
-            result_embedding = text_embedding
-        topn_closest = utils.find_topn_closest_indices(result_embedding, self._processed_dialogues_emotion_mapping_npy,
-                                                       6).tolist()
-        topn_closest_string = [list(self._dialogues_emotion_mapping.values())[index][0] for index in topn_closest]
+            result_embedding = embedding_cache.cache.get(EMBEDDING_MODEL, text, self._fetch_embeddings)
+        return utils.find_topn_closest_indices(result_embedding, self._processed_dialogues_emotion_mapping_npy,
+                                               6).tolist()
+
+    @staticmethod
+    def _fetch_embeddings(texts):
+        """
+        :param texts: list of str
+        :return: list of list of float, the embeddings in the order of the texts.
+        """
+        r = resilience.call(
+            resilience.OPENAI_ENDPOINT,
+            rate_limiter.call_openai,
+            openai.Embedding.create,
+            model=EMBEDDING_MODEL,
+            input=texts,
+        )
+        return [data['embedding'] for data in sorted(r['data'], key=lambda data: data['index'])]
+
+    def choose_emotion_sample(self, candidates, translated_text):
+        """
+        Choose the emotion of the candidate dialogue closest to the translated text in length.
+        :param candidates: list of int, see get_emotion_candidates.
+        :param translated_text: the text to speak.
+        :return: the emotion sample.
+        """
+        topn_closest_string = [self._dialogue_texts[index] for index in candidates]
         index = utils.find_closest_string(translated_text, topn_closest_string)
-        return self._dialogue_emotion_ordering_mapping[str(topn_closest[index])]
+        return self._dialogue_emotion_ordering_mapping[str(candidates[index])]
 
     def play_emotion_sample_file(self, emotion, root):
         """
@@ -243,7 +303,8 @@ class SpeakerNeneEmotion(SpeakerW2V2):
         :return: file_path, emotion_sample
         """
         emotion = kwargs['emotion']
-        result = self._client.predict(text, emotion, fn_index=2)
+        result = resilience.call(SpeakerAPIType.NeneEmotion.name, self._client.predict, text, emotion, fn_index=2,
+                                 retry_on=(httpx.TransportError, ConnectionError, TimeoutError))
         message = result[0]
         if message != 'Success':
             raise SpeakerException(message)
@@ -263,7 +324,8 @@ class SpeakerVitsSimpleApi(SpeakerW2V2):
                  marked_emotion_mapping_path,
                  dialogue_emotion_ordering_mapping_path,
                  dialogues_emotion_mapping_path,
-                 dialogues_emotion_mapping_npy_path):
+                 dialogues_emotion_mapping_npy_path,
+                 http_pool: HTTPPool):
         """
         The speaker class for vits simple api. This class is callable.
         """
@@ -273,6 +335,10 @@ class SpeakerVitsSimpleApi(SpeakerW2V2):
                          dialogue_emotion_ordering_mapping_path,
                          dialogues_emotion_mapping_path,
                          dialogues_emotion_mapping_npy_path)
+        self._http_pool = http_pool
+
+    def warm_up(self):
+        self._http_pool.warm_up(SpeakerAPIType.VitsSimpleAPI.name, self._api_address)
 
     def __call__(self, text, id_=0, format_="wav", lang="ja", length=1, noise=0.667, noisew=0.8, max_=50, **kwargs):
         """
@@ -281,9 +347,13 @@ class SpeakerVitsSimpleApi(SpeakerW2V2):
         :param kwargs: the arguments for the speaker.
         :param nsfw: [required] whether the text is nsfw. Must be a boolean.
         :param emotion: [required] the emotion of the speaker. Must be a list of float. The emotion is an ADV model array.
+        :param emotion_candidates: [optional] the emotions looked up before, see get_emotion_candidates, instead of
+        context and raw_text.
         :return: file_path, emotion_sample
         """
-        if 'context' in kwargs and 'raw_text' in kwargs:
+        if kwargs.get('emotion_candidates'):
+            emotion = self.choose_emotion_sample(kwargs['emotion_candidates'], text)
+        elif 'context' in kwargs and 'raw_text' in kwargs:
             emotion = self.get_emotion_sample_by_text(kwargs['raw_text'], kwargs['context'], text)
         elif 'nsfw' in kwargs:
             emotion = self._get_emotion_sample(kwargs['emotion'], kwargs['nsfw'])
@@ -298,17 +368,22 @@ class SpeakerVitsSimpleApi(SpeakerW2V2):
             "max": str(max_),
             "emotion": str(emotion)
         }
-        boundary = '----VoiceConversionFormBoundary' + ''.join(random.sample(string.ascii_letters + string.digits, 16))
-
-        m = MultipartEncoder(fields=fields, boundary=boundary)
-        headers = {"Content-Type": m.content_type}
         url = f"{self._api_address}/voice/w2v2-vits"
+
+        def post():
+            # the encoder is a stream, every try needs a new one
+            boundary = '----VoiceConversionFormBoundary' + ''.join(
+                random.sample(string.ascii_letters + string.digits, 16))
+            m = MultipartEncoder(fields=fields, boundary=boundary)
+            headers = {"Content-Type": m.content_type}
+            return resilience.raise_for_retry(self._http_pool.post(SpeakerAPIType.VitsSimpleAPI.name, url, data=m,
+                                                                   headers=headers, timeout=VITS_TIMEOUT))
+
         try:
-            res = requests.post(url=url, data=m, headers=headers)
-        except requests.exceptions.ConnectionError:
-            time.sleep(2)
-            utils.warn(f"[Vits Simple API]ConnectionError, retrying...")
-            return self(text, id_, format_, lang, length, noise, noisew, max_, **kwargs)
+            res = resilience.call(SpeakerAPIType.VitsSimpleAPI.name, post, retry_on=resilience.HTTP_RETRY_ERRORS)
+        except (requests.RequestException, CircuitOpenError) as e:
+            utils.warn(f"[Vits Simple API]{e}, please check the server.")
+            return None, None
         if res.status_code != 200:
             utils.warn(f"[Vits Simple API]Status code: {res.status_code}, please check the server.")
             return None, None
@@ -0,0 +1,288 @@
+import os
+import re
+import wave
+
+from PySide6.QtCore import QObject, Signal, Slot
+
+import utils
+from AIChatEnum import WorkerStage
+from data import MessageData
+from worker_pool import Task, TaskGraph
+
+# a sentence ends after these, with the closing quotes and brackets which follow
+_SENTENCE_END = re.compile(r'(?:[。！？!?…]+|\.(?=\s)|\n+)[」』”"\'）)]*')
+_OPEN_BRACKETS = '（('
+_CLOSE_BRACKETS = '）)'
+# the shorter sentences are spoken with the next one, a request per word sounds choppy
+MIN_SENTENCE_LENGTH = 6
+
+
+class SentenceSplitter:
+    """
+    Split a streamed text into sentences as they are complete. A sentence does not end inside brackets, so the
+    bracketed content, which is not spoken, is removed as a whole.
+    """
+
+    def __init__(self):
+        self._text = ''
+
+    def feed(self, chunk) -> list[str]:
+        """
+        :param chunk: str, the next part of the text.
+        :return: list of str, the sentences completed by the chunk.
+        """
+        self._text += chunk
+        sentences = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._text):
+            sentence = self._text[start:match.end()]
+            if _get_bracket_depth(sentence) > 0 or len(sentence.strip()) < MIN_SENTENCE_LENGTH:
+                continue
+            sentences.append(sentence)
+            start = match.end()
+        self._text = self._text[start:]
+        return sentences
+
+    def flush(self) -> str:
+        """
+        :return: str, the rest of the text when it is done.
+        """
+        text, self._text = self._text, ''
+        return text
+
+
+def _get_bracket_depth(text):
+    depth = 0
+    for char in text:
+        if char in _OPEN_BRACKETS:
+            depth += 1
+        elif char in _CLOSE_BRACKETS and depth:
+            depth -= 1
+    return depth
+
+
+def stitch_wav(paths, target) -> bool:
+    """
+    Join wave files of the same format into one, the ones of another format than the first are left out.
+    :param paths: list of str, the wave files in order.
+    :param target: str, the path of the joined file.
+    :return: bool, if the file is written.
+    """
+    params = None
+    temp_path = target + '.tmp'
+    with wave.open(temp_path, 'wb') as output:
+        for path in paths:
+            with wave.open(path, 'rb') as segment:
+                segment_params = segment.getparams()[:3]
+                if params is None:
+                    params = segment_params
+                    output.setnchannels(params[0])
+                    output.setsampwidth(params[1])
+                    output.setframerate(params[2])
+                elif segment_params != params:
+                    utils.warn(f'{path} is not of the format of the speech, it is left out.')
+                    continue
+                output.writeframes(segment.readframes(segment.getnframes()))
+    if params is None:
+        os.remove(temp_path)
+        return False
+    os.replace(temp_path, target)
+    return True
+
+
+def _remove_files(paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+class EmotionTask(Task):
+    """
+    Look up the emotion candidates of a text, see Speaker.get_emotion_candidates.
+    """
+
+    def __init__(self, speaker, raw_text, context):
+        super().__init__()
+        self._speaker = speaker
+        self._raw_text = raw_text
+        self._context = context
+
+    def run(self) -> None:
+        try:
+            self._result = self._speaker.get_emotion_candidates(self._raw_text, self._context)
+        except Exception as e:
+            utils.warn(f'Look up the emotion failed: {e}')
+
+
+class TranslateSentenceTask(Task):
+    def __init__(self, text, translater):
+        super().__init__()
+        self._text = text
+        self._translater = translater
+
+    def run(self) -> None:
+        try:
+            self._result = self._translater.translate(self._text) or None
+        except Exception as e:
+            utils.warn(f'Translate the speech failed: {e}')
+
+
+class SpeakSentenceTask(Task):
+    def __init__(self, text, emotion_candidates, speaker):
+        super().__init__()
+        self._text = text
+        self._emotion_candidates = emotion_candidates
+        self._speaker = speaker
+
+    def run(self) -> None:
+        path = None
+        try:
+            path, _ = self._speaker.speak(self._text, id_=0, emotion_candidates=self._emotion_candidates)
+        except Exception as e:
+            utils.warn(f'Speak the sentence failed: {e}')
+        if not self._is_running:
+            if path and os.path.exists(path):
+                os.remove(path)
+            return
+        self._result = path
+
+
+class StitchTask(Task):
+    def __init__(self, paths, target):
+        super().__init__()
+        self._paths = paths
+        self._target = target
+
+    def run(self) -> None:
+        try:
+            written = stitch_wav(self._paths, self._target)
+        except (OSError, wave.Error) as e:
+            utils.warn(f'Save the speech failed: {e}')
+            return
+        _remove_files(self._paths)
+        if written:
+            utils.debug(f'The speech is saved to {self._target}.')
+
+
+class SpeechPipeline(QObject):
+    """
+    Speak a reply while it is streamed: every sentence is translated and synthesized as soon as it is complete, while
+    the later sentences are still generated. The emotion of a sentence is looked up while it is translated, see
+    TaskGraph. The sentences are spoken in parallel, and passed on for playing in order.
+    When the reply and all its sentences are done, the sentences are joined into <message_id>.wav for replaying.
+    Connect it to the signals of the ChatTask of the reply: streamMessage to feed, sendMessage to set_message and
+    finished to end_chat.
+    :param history_id: str
+    :param chatbot_id: str
+    :param speaker: Speaker
+    :param translater: Translater, [optional] translates the sentences which are not Japanese.
+    :param context: str, the latest messages, see SpeakerW2V2.get_emotion_sample_by_text.
+    :param run_task: callable(WorkerStage, Task), runs a task, e.g. in the worker pool of the chatbot.
+    """
+    # history id, chatbot id, wave path, index among the segments passed on, the failed sentences are not counted
+    segmentReady = Signal(str, str, str, int)
+
+    def __init__(self, history_id, chatbot_id, speaker, translater, context, run_task):
+        super().__init__()
+        self._history_id = history_id
+        self._chatbot_id = chatbot_id
+        self._speaker = speaker
+        self._translater = translater
+        self._context = context
+        self._run_task = run_task
+        self._splitter = SentenceSplitter()
+        self._translate = None
+        self._raw_texts = []
+        self._graphs: list[TaskGraph] = []
+        # the index of a sentence -> its wave path, empty if it failed
+        self._paths = {}
+        self._next_index = 0
+        # the count of the segments passed on
+        self._segment_count = 0
+        self._message: MessageData | None = None
+        self._chat_done = False
+        self._is_running = True
+
+    @Slot(str, str, str, bool)
+    def feed(self, history_id, chatbot_id, chunk, finished):
+        if not self._is_running:
+            return
+        sentences = self._splitter.feed(chunk)
+        if finished:
+            sentences.append(self._splitter.flush())
+        for sentence in sentences:
+            self._speak_sentence(sentence)
+
+    @Slot(str, MessageData)
+    def set_message(self, history_id, message: MessageData):
+        self._message = message
+
+    @Slot()
+    def end_chat(self):
+        self._chat_done = True
+        self._try_save()
+
+    def stop(self):
+        if not self._is_running:
+            return
+        self._is_running = False
+        for graph in self._graphs:
+            graph.stop()
+        # the stopped reply is not saved for replaying. the sentences passed on are queued for playing already, the
+        # queue has read them
+        _remove_files(self._paths.values())
+        self._paths.clear()
+
+    def _speak_sentence(self, raw_text):
+        text = utils.remove_brackets_content(raw_text).strip()
+        if not text:
+            return
+        if self._translate is None:
+            # the language of the reply is told by its first sentence
+            self._translate = self._translater is not None and utils.detect_language(raw_text) != 'ja'
+        index = len(self._raw_texts)
+        self._raw_texts.append(raw_text)
+        graph = TaskGraph(self._run_task)
+        graph.add('emotion', WorkerStage.Emotion, lambda: EmotionTask(self._speaker, raw_text, self._context))
+        if self._translate:
+            graph.add('translation', WorkerStage.Translate, lambda: TranslateSentenceTask(text, self._translater))
+            depends_on = ('emotion', 'translation')
+        else:
+            depends_on = ('emotion',)
+        graph.add('speech', WorkerStage.TTS,
+                  lambda emotion, translation=text: SpeakSentenceTask(translation, emotion, self._speaker), depends_on)
+        graph.done.connect(lambda: self._on_spoken(index, graph.get_result('speech') or ''))
+        self._graphs.append(graph)
+        graph.start()
+
+    def _on_spoken(self, index, path):
+        if not self._is_running:
+            # a sentence spoken just before the stop
+            _remove_files([path])
+            return
+        self._paths[index] = path
+        # the sentences are played in order, a sentence spoken early waits for the ones before it
+        while self._next_index in self._paths:
+            path = self._paths[self._next_index]
+            if path:
+                self.segmentReady.emit(self._history_id, self._chatbot_id, path, self._segment_count)
+                self._segment_count += 1
+            self._next_index += 1
+        self._try_save()
+
+    def _try_save(self):
+        if not self._is_running or not self._chat_done or self._next_index < len(self._raw_texts):
+            return
+        self._is_running = False
+        self._graphs.clear()
+        paths = [self._paths[index] for index in range(len(self._raw_texts)) if self._paths[index]]
+        # the stitching owns the files from here
+        self._paths.clear()
+        if not paths:
+            return
+        if self._message is None:
+            # the reply is stopped, there is nothing to replay
+            _remove_files(paths)
+            return
+        self._run_task(WorkerStage.TTS, StitchTask(
+            paths, os.path.join(os.path.dirname(paths[0]), f'{self._message.message_id}.wav')))
@@ -0,0 +1,1391 @@
+import bisect
+import collections
+import concurrent.futures
+import gzip
+import json
+import marshal
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+
+import utils
+from AIChatEnum import SnapshotCodec
+
+# binary snapshot: magic, format version, marshal version, then the marshalled dict
+SNAPSHOT_MAGIC = b'AICHATSS'
+SNAPSHOT_FORMAT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<8sHH')
+
+
+def message_order_key(message: dict):
+    """
+    The order of the messages in a history. send_time is '%Y-%m-%d %H:%M:%S', so it sorts as a string.
+    :param message: message dict
+    :return: tuple
+    """
+    return message['send_time'], message['message_id']
+
+
+def page_messages(messages, before=None, after=None, limit=None, from_oldest=False) -> list[dict]:
+    """
+    Take a page of a sorted message list, see Storage.load_messages.
+    :param messages: list of message dict, ordered by message_order_key.
+    :return: list of message dict
+    """
+    start = 0 if after is None else bisect.bisect_right(messages, after, key=message_order_key)
+    end = len(messages) if before is None else bisect.bisect_left(messages, before, key=message_order_key)
+    if limit is not None and from_oldest:
+        end = min(end, start + limit)
+    elif limit is not None:
+        start = max(start, end - limit)
+    return messages[start:end]
+
+
+def join_pages(older, newer, limit=None, from_oldest=False) -> list[dict]:
+    """
+    Join the pages of two message lists, e.g. the archived and the saved messages of a history, into one page.
+    :param older: list of message dict, all ordered before the messages of newer.
+    :param newer: list of message dict
+    :return: list of message dict
+    """
+    page = older + newer
+    if limit is None:
+        return page
+    return page[:limit] if from_oldest else page[-limit:]
+
+
+def encode_snapshot(data: dict, codec: SnapshotCodec) -> bytes:
+    """
+    Encode a save dict.
+    :param data: dict
+    :param codec: SnapshotCodec. Json is the indented json of the older versions, CompactJson the same json without
+    whitespace, Binary a versioned marshal dump, which is the fastest to load and save.
+    :return: bytes
+    """
+    match codec:
+        case SnapshotCodec.Json:
+            return json.dumps(data, ensure_ascii=False, indent=4).encode('utf-8')
+        case SnapshotCodec.CompactJson:
+            return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        case SnapshotCodec.Binary:
+            header = _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, marshal.version)
+            return header + marshal.dumps(data)
+    raise ValueError(f'Unknown snapshot codec {codec}')
+
+
+def decode_snapshot(content: bytes) -> dict:
+    """
+    Decode a save dict of any codec, the codec is told by the header.
+    :param content: bytes
+    :return: dict
+    """
+    if not content.startswith(SNAPSHOT_MAGIC):
+        return json.loads(content.decode('utf-8'))
+    _, format_version, marshal_version = _SNAPSHOT_HEADER.unpack_from(content)
+    if format_version > SNAPSHOT_FORMAT_VERSION or marshal_version > marshal.version:
+        raise ValueError(f'The snapshot format {format_version} (marshal {marshal_version}) is newer than this '
+                         f'version supports, convert it to json with the version that saved it.')
+    return marshal.loads(content[_SNAPSHOT_HEADER.size:])
+
+
+def snapshot_codec_of(content: bytes) -> SnapshotCodec:
+    """
+    Tell the codec of an encoded snapshot.
+    :param content: bytes
+    :return: SnapshotCodec
+    """
+    if content.startswith(SNAPSHOT_MAGIC):
+        return SnapshotCodec.Binary
+    # the indented json has a line break right after the opening brace
+    return SnapshotCodec.Json if content[1:2] == b'\n' else SnapshotCodec.CompactJson
+
+
+def load_snapshot(path) -> dict:
+    with open(path, 'rb') as f:
+        return decode_snapshot(f.read())
+
+
+def save_snapshot(path, data: dict, codec: SnapshotCodec):
+    """
+    Write a snapshot atomically.
+    :param path: the snapshot path.
+    :param data: dict
+    :param codec: SnapshotCodec
+    :return:
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(encode_snapshot(data, codec))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def convert_snapshot(path, codec: SnapshotCodec, target_path=None, shard_dir='chatbots'):
+    """
+    Convert a snapshot into another codec, both ways between json and binary. The shards of a sharded snapshot are
+    converted too, into the shard directory next to the target, and the index is written last.
+    :param path: the snapshot path, the index file of a sharded snapshot.
+    :param codec: SnapshotCodec, the target codec.
+    :param target_path: [optional] where to write the converted snapshot, default the snapshot itself.
+    :param shard_dir: the directory of the shards, next to the snapshot, see JsonStorage.
+    :return:
+    """
+    target_path = target_path or path
+    data = load_snapshot(path)
+    if 'chatbot_ids' in data:
+        source_shard_path = os.path.join(os.path.dirname(path), shard_dir)
+        target_shard_path = os.path.join(os.path.dirname(target_path), shard_dir)
+        os.makedirs(target_shard_path, exist_ok=True)
+        for chatbot_id in data['chatbot_ids']:
+            shard_file = f'{chatbot_id}.json'
+            # a missing shard is a chatbot deleted before the compaction, see JsonStorage._load_shards
+            if os.path.exists(os.path.join(source_shard_path, shard_file)):
+                save_snapshot(os.path.join(target_shard_path, shard_file),
+                              load_snapshot(os.path.join(source_shard_path, shard_file)), codec)
+    save_snapshot(target_path, data, codec)
+
+
+def migrate_ids(data: dict) -> bool:
+    """
+    Give the histories without an id one, and the messages sharing an id in a chatbot new ones. Older versions made the
+    message id of the chatbot and the send time in seconds, so two messages of a second had the same id. The first
+    message keeps the id, and its voice file.
+    :param data: dict, a save dict, changed in place.
+    :return: bool, if any id was changed.
+    """
+    changed = False
+    for chatbot in data.get('chatbots', []):
+        message_ids = set()
+        for history in chatbot['histories']:
+            if 'history_id' not in history:
+                history['history_id'] = utils.generate_id('HD')
+                changed = True
+            for message in history.get('history_list', []):
+                if message['message_id'] in message_ids:
+                    message['message_id'] = utils.generate_id('ME')
+                    changed = True
+                message_ids.add(message['message_id'])
+    return changed
+
+
+class SnapshotReplayer:
+    """
+    Apply journal records to a snapshot dict.
+    Replaying is idempotent: a message that already exists is not appended twice, and deleting a missing message or
+    chatbot is a no-op, so a journal can safely be replayed over a snapshot that already contains part of it.
+    :param data: the snapshot dict, {'config': dict, 'chatbots': list}.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        if 'chatbots' not in self._data:
+            self._data['chatbots'] = []
+        self._chatbots = {}
+        self._histories = {}
+        self._message_ids = {}
+        for chatbot in self._data['chatbots']:
+            self._index_chatbot(chatbot)
+
+    def _index_chatbot(self, chatbot):
+        chatbot_id = chatbot['chatbot_id']
+        self._chatbots[chatbot_id] = chatbot
+        for history in chatbot['histories']:
+            self._index_history(chatbot_id, history)
+
+    def _index_history(self, chatbot_id, history):
+        key = (chatbot_id, history.get('history_id'))
+        self._histories[key] = history
+        self._message_ids[key] = {message['message_id'] for message in history['history_list']}
+
+    def apply(self, record):
+        """
+        Apply one journal record.
+        :param record: dict, see JsonStorage for the record format.
+        :return:
+        """
+        match record['op']:
+            case 'batch':
+                for batch_record in record['records']:
+                    self.apply(batch_record)
+            case 'config':
+                self._data['config'] = record['config']
+            case 'chatbot':
+                self._apply_chatbot(record['chatbot'])
+            case 'delete_chatbot':
+                chatbot = self._chatbots.pop(record['chatbot_id'], None)
+                if chatbot is not None:
+                    self._data['chatbots'].remove(chatbot)
+                    for history in chatbot['histories']:
+                        self._histories.pop((record['chatbot_id'], history.get('history_id')), None)
+                        self._message_ids.pop((record['chatbot_id'], history.get('history_id')), None)
+            case 'append':
+                key = (record['chatbot_id'], record['history_id'])
+                if key not in self._histories or record['message']['message_id'] in self._message_ids[key]:
+                    return
+                self._histories[key]['history_list'].append(record['message'])
+                self._message_ids[key].add(record['message']['message_id'])
+            case 'delete':
+                key = (record['chatbot_id'], record['history_id'])
+                if key not in self._histories or record['message_id'] not in self._message_ids[key]:
+                    return
+                history_list = self._histories[key]['history_list']
+                for index, message in enumerate(history_list):
+                    if message['message_id'] == record['message_id']:
+                        del history_list[index]
+                        break
+                self._message_ids[key].discard(record['message_id'])
+            case 'archive':
+                key = (record['chatbot_id'], record['history_id'])
+                if key not in self._histories:
+                    return
+                history = self._histories[key]
+                before = tuple(record['before'])
+                history['history_list'] = [message for message in history['history_list']
+                                           if message_order_key(message) >= before]
+                history['archive'] = {'count': record['count'], 'before': record['before']}
+                self._index_history(record['chatbot_id'], history)
+
+    def _apply_chatbot(self, chatbot_record):
+        """
+        Insert or update a chatbot. Histories without 'history_list' only update the metadata and keep the messages.
+        :param chatbot_record: dict, chatbot data.
+        :return:
+        """
+        chatbot_id = chatbot_record['chatbot_id']
+        chatbot = self._chatbots.get(chatbot_id)
+        if chatbot is None:
+            chatbot = {'chatbot_id': chatbot_id, 'histories': []}
+            self._data['chatbots'].append(chatbot)
+            self._chatbots[chatbot_id] = chatbot
+        chatbot['gpt_params'] = chatbot_record['gpt_params']
+        chatbot['character'] = chatbot_record['character']
+        for history_record in chatbot_record['histories']:
+            key = (chatbot_id, history_record['history_id'])
+            history = self._histories.get(key)
+            if history is None:
+                history = {'history_id': history_record['history_id'], 'history_list': []}
+                chatbot['histories'].append(history)
+                self._index_history(chatbot_id, history)
+            history['memory'] = history_record['memory']
+            if history_record.get('summarized_until'):
+                history['summarized_until'] = history_record['summarized_until']
+            else:
+                history.pop('summarized_until', None)
+            if 'history_list' in history_record:
+                history['history_list'] = list(history_record['history_list'])
+                # a history saved with its messages is restored from the archive, unless the record is a stub too
+                if history_record.get('archive'):
+                    history['archive'] = history_record['archive']
+                else:
+                    history.pop('archive', None)
+                self._index_history(chatbot_id, history)
+
+    @property
+    def data(self):
+        return self._data
+
+
+class HistoryArchive:
+    """
+    The cold tier of the save: the older messages of the idle histories, in one gzip compressed json file per history.
+    An archived history is saved as a stub with an 'archive' dict, {'count': int, 'before': list}, the count of the
+    archived messages and the message_order_key they are all ordered before. The storages page the archived messages
+    in from here, and a history saved again with its 'history_list' is restored, its archive file is removed.
+    :param archive_path: the archive directory.
+    :param cache_size: how many archived histories are kept in memory after they are read.
+    """
+
+    def __init__(self, archive_path, cache_size=4):
+        self._archive_path = archive_path
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        # the recently read histories, (chatbot_id, history_id): list of message dict
+        self._cache = collections.OrderedDict()
+        self._message_indexes = {}
+        self._stats = {'histories': 0, 'messages': 0, 'json_bytes': 0, 'archive_bytes': 0}
+
+    def _get_file(self, chatbot_id, history_id):
+        return os.path.join(self._archive_path, chatbot_id, f'{history_id}.json.gz')
+
+    def read(self, chatbot_id, history_id, archive) -> list[dict]:
+        """
+        Read the archived messages of a history.
+        :param chatbot_id: str
+        :param history_id: str
+        :param archive: dict, the archive of the history.
+        :return: list of message dict, ordered by message_order_key. Do not modify it.
+        """
+        key = (chatbot_id, history_id)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        try:
+            with gzip.open(self._get_file(chatbot_id, history_id), 'rb') as f:
+                messages = json.loads(f.read())
+        except FileNotFoundError:
+            utils.warn(f'The archive of the history {history_id} is missing.')
+            messages = []
+        # a file written for a later archive of the history may have more messages than this archive
+        messages = messages[:bisect.bisect_left(messages, tuple(archive['before']), key=message_order_key)]
+        with self._lock:
+            self._cache[key] = messages
+            while len(self._cache) > self._cache_size:
+                self._message_indexes.pop(self._cache.popitem(last=False)[0], None)
+        return messages
+
+    def get_message(self, chatbot_id, history_id, archive, message_id) -> dict | None:
+        """
+        Get an archived message by id.
+        :return: dict, or None if there is no such message.
+        """
+        messages = self.read(chatbot_id, history_id, archive)
+        key = (chatbot_id, history_id)
+        with self._lock:
+            if key not in self._message_indexes:
+                self._message_indexes[key] = {message['message_id']: message for message in messages}
+            return self._message_indexes[key].get(message_id)
+
+    def add(self, chatbot_id, history_id, archive, messages, before) -> dict | None:
+        """
+        Move messages into the archive of a history. The archive file is written before the storage drops the
+        messages, so a crash in between only leaves an unused file.
+        :param chatbot_id: str
+        :param history_id: str
+        :param archive: dict, the current archive of the history, or None.
+        :param messages: list of message dict, sorted, all ordered after the archived ones.
+        :param before: tuple, the message_order_key all the archived messages are ordered before.
+        :return: dict, the new archive of the history, or None if there is nothing to archive.
+        """
+        if not messages:
+            return None
+        archived = (self.read(chatbot_id, history_id, archive) if archive else []) + messages
+        content = json.dumps(archived, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        path = self._get_file(chatbot_id, history_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(gzip.compress(content))
+            f.flush()
+            os.fsync(f.fileno())
+            archive_bytes = f.tell()
+        os.replace(temp_path, path)
+        self._forget(chatbot_id, history_id)
+        with self._lock:
+            self._stats['histories'] += 1
+            self._stats['messages'] += len(messages)
+            self._stats['json_bytes'] += len(content)
+            self._stats['archive_bytes'] += archive_bytes
+        utils.info(f'Archived {len(messages)} messages of the history {history_id}, {len(content)} bytes of json '
+                   f'in {archive_bytes} bytes.')
+        return {'count': len(archived), 'before': list(before)}
+
+    def remove(self, chatbot_id, history_id) -> None:
+        """
+        Remove the archive of a restored history.
+        :return:
+        """
+        self._forget(chatbot_id, history_id)
+        path = self._get_file(chatbot_id, history_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def remove_chatbot(self, chatbot_id) -> None:
+        """
+        Remove the archives of a deleted chatbot.
+        :return:
+        """
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == chatbot_id]:
+                del self._cache[key]
+                self._message_indexes.pop(key, None)
+        shutil.rmtree(os.path.join(self._archive_path, chatbot_id), ignore_errors=True)
+
+    def _forget(self, chatbot_id, history_id):
+        with self._lock:
+            self._cache.pop((chatbot_id, history_id), None)
+            self._message_indexes.pop((chatbot_id, history_id), None)
+
+    stats = property(lambda self: dict(self._stats))
+
+
+class Storage:
+    """
+    Base class for the save storages. A storage loads the whole save as a dict, and persists the changes as journal
+    records:
+    {'op': 'batch', 'records': list}, records which are saved all or none
+    {'op': 'config', 'config': dict}
+    {'op': 'chatbot', 'chatbot': dict}, histories without 'history_list' only carry the metadata: the 'memory', and
+    the 'summarized_until' message_order_key of the messages folded into the memory if there are any
+    {'op': 'delete_chatbot', 'chatbot_id': str}
+    {'op': 'append', 'chatbot_id': str, 'history_id': str, 'message': dict}
+    {'op': 'delete', 'chatbot_id': str, 'history_id': str, 'message_id': str}
+    {'op': 'archive', 'chatbot_id': str, 'history_id': str, 'before': list}, move the messages ordered before the
+    message_order_key into the HistoryArchive. The storage adds the 'count' of the archived messages when it applies it.
+    """
+
+    def load(self, tail_size=None) -> dict:
+        """
+        Load the save.
+        :param tail_size: int, [optional] only load the latest tail_size messages of every history, the others are paged
+        in by load_messages. The histories then carry a 'message_count'.
+        :return: dict, {'config': dict, 'chatbots': list}, 'config' is absent on the first run. An archived history
+        carries its 'archive', and only the messages not archived are in its 'history_list'.
+        """
+        raise NotImplementedError
+
+    def load_messages(self, chatbot_id, history_id, before=None, after=None, limit=None,
+                      from_oldest=False) -> list[dict]:
+        """
+        Load a page of messages of a history, in order.
+        :param chatbot_id: str
+        :param history_id: str
+        :param before: tuple, [optional] only load the messages ordered before this message_order_key.
+        :param after: tuple, [optional] only load the messages ordered after this message_order_key.
+        :param limit: int, [optional] the max count of messages, counted from the latest one.
+        :param from_oldest: bool, count the limit from the oldest message instead.
+        :return: list of message dict
+        """
+        raise NotImplementedError
+
+    def get_message(self, chatbot_id, history_id, message_id) -> dict | None:
+        """
+        Get a message which load_messages can return by the message id.
+        :param chatbot_id: str
+        :param history_id: str
+        :param message_id: str
+        :return: dict, or None if there is no such message.
+        """
+        raise NotImplementedError
+
+    def apply(self, records) -> None:
+        """
+        Persist the journal records.
+        :param records: list of journal records.
+        :return:
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """
+        Release the storage.
+        :return:
+        """
+
+    @property
+    def archive_stats(self) -> dict:
+        """
+        See HistoryArchive.stats.
+        """
+        return self._history_archive.stats
+
+
+class JsonStorage(Storage):
+    """
+    A json snapshot plus an append-only journal next to it. Every save only appends the changed records to the journal,
+    and when the journal grows over compact_threshold records, a background thread rolls it into the snapshot.
+    The snapshot is an index file with the config and the chatbot order, and one shard file per chatbot. A compaction
+    only rewrites the shards of the chatbots in the journal, and deleting a chatbot unlinks its shard.
+    :param data_path: the save directory.
+    :param data_file: the snapshot index file name.
+    :param journal_file: the journal file name.
+    :param shard_dir: the directory of the chatbot shards, in data_path.
+    :param compact_threshold: the journal record count that triggers a compaction.
+    :param codec: SnapshotCodec, [optional] how the snapshot is written. Any codec is read, and a snapshot of another
+    codec is converted on load. If it is None, keep the codec of the snapshot.
+    :param load_workers: int, how many shards are read at once.
+    :param archive_dir: the directory of the HistoryArchive, in data_path.
+    """
+
+    def __init__(self, data_path='./save', data_file='save.json', journal_file='save.journal', shard_dir='chatbots',
+                 compact_threshold=500, codec=None, load_workers=8, archive_dir='archive'):
+        self._snapshot_path = os.path.join(data_path, data_file)
+        self._shard_path = os.path.join(data_path, shard_dir)
+        self._load_workers = load_workers
+        # the chatbots deleted since the load, the compaction must not write their shards again
+        self._deleted_chatbot_ids = set()
+        self._journal_path = os.path.join(data_path, journal_file)
+        # the journal being rolled into the snapshot by the compaction thread
+        self._compacting_path = self._journal_path + '.compacting'
+        self._compact_threshold = compact_threshold
+        self._codec = codec
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_count = 0
+        self._compact_thread: threading.Thread | None = None
+        # the saved messages which are not archived, sorted, by (chatbot_id, history_id). they are kept up to date with
+        # the records, and the GUI pages the messages left out of a tail load from here
+        self._messages = {}
+        # the messages of _messages by id, built on the first lookup
+        self._message_indexes = {}
+        self._messages_lock = threading.Lock()
+        # the archives of the archived histories, by (chatbot_id, history_id)
+        self._archives = {}
+        self._history_archive = HistoryArchive(os.path.join(data_path, archive_dir))
+        if not os.path.exists(data_path):
+            os.mkdir(data_path)
+        if not os.path.exists(self._shard_path):
+            os.mkdir(self._shard_path)
+        if not os.path.exists(self._snapshot_path):
+            save_snapshot(self._snapshot_path, {'chatbot_ids': []}, codec or SnapshotCodec.Json)
+
+    def load(self, tail_size=None) -> dict:
+        with open(self._snapshot_path, 'rb') as f:
+            content = f.read()
+        codec = snapshot_codec_of(content)
+        if self._codec is None:
+            self._codec = codec
+        index = decode_snapshot(content)
+        del content
+        # the saves of older versions keep all the chatbots in one file, split it into shards
+        is_single_file = 'chatbot_ids' not in index
+        if is_single_file:
+            data = index
+        else:
+            data = {'chatbots': self._load_shards(index['chatbot_ids'])}
+            if 'config' in index:
+                data['config'] = index['config']
+        replayer = SnapshotReplayer(data)
+        journal_count = 0
+        for path in (self._compacting_path, self._journal_path):
+            for record in self._read_journal(path):
+                replayer.apply(record)
+                journal_count += 1
+        data = replayer.data
+        # histories saved before the journal existed have no persistent id, so the journal can not refer to them, and
+        # the messages of older versions may share an id. give them unique ones and rewrite the snapshot once. a
+        # snapshot of another codec is rewritten too.
+        if migrate_ids(data) or codec != self._codec or is_single_file:
+            self._write_snapshot(data)
+            self._remove_file(self._compacting_path)
+            self._remove_file(self._journal_path)
+            journal_count = 0
+        with self._lock:
+            self._journal = open(self._journal_path, 'a', encoding='utf-8')
+            self._journal_count = journal_count
+            if self._journal_count >= self._compact_threshold:
+                self._start_compaction()
+        self._index_messages(data)
+        if tail_size is not None:
+            for chatbot in data['chatbots']:
+                for history in chatbot['histories']:
+                    history_list = self._messages[(chatbot['chatbot_id'], history['history_id'])]
+                    history['message_count'] = len(history_list) + history.get('archive', {}).get('count', 0)
+                    history['history_list'] = history_list[max(len(history_list) - tail_size, 0):]
+        return data
+
+    def _index_messages(self, data):
+        """
+        Keep the sorted messages and the archives of every history in data for load_messages.
+        :param data: dict
+        :return:
+        """
+        with self._messages_lock:
+            self._messages.clear()
+            self._message_indexes.clear()
+            self._archives.clear()
+            for chatbot in data['chatbots']:
+                for history in chatbot['histories']:
+                    key = (chatbot['chatbot_id'], history['history_id'])
+                    self._messages[key] = sorted(history['history_list'], key=message_order_key)
+                    if history.get('archive'):
+                        self._archives[key] = history['archive']
+
+    def load_messages(self, chatbot_id, history_id, before=None, after=None, limit=None,
+                      from_oldest=False) -> list[dict]:
+        key = (chatbot_id, history_id)
+        with self._messages_lock:
+            messages = page_messages(self._messages.get(key, []), before, after, limit, from_oldest)
+            archive = self._archives.get(key)
+        if archive is None:
+            return messages
+        archived = self._history_archive.read(chatbot_id, history_id, archive)
+        return join_pages(page_messages(archived, before, after, limit, from_oldest), messages, limit, from_oldest)
+
+    def get_message(self, chatbot_id, history_id, message_id) -> dict | None:
+        key = (chatbot_id, history_id)
+        with self._messages_lock:
+            if key not in self._message_indexes:
+                self._message_indexes[key] = {message['message_id']: message for message in
+                                              self._messages.get(key, [])}
+            message = self._message_indexes[key].get(message_id)
+            archive = self._archives.get(key)
+        if message is None and archive is not None:
+            message = self._history_archive.get_message(chatbot_id, history_id, archive, message_id)
+        return message
+
+    def apply(self, records) -> None:
+        if not records:
+            return
+        records = list(_flatten_records(records))
+        # the archive records are completed with the count of the archived messages, after the archive files are
+        # written. the records after one may change its history again, so they are applied in order.
+        restored = set()
+        for index, record in enumerate(records):
+            if record['op'] == 'archive':
+                records[index] = record = self._archive_history(record)
+                if record is None:
+                    continue
+                restored.discard((record['chatbot_id'], record['history_id']))
+            restored.update(self._apply_to_messages(record))
+        records = [record for record in records if record is not None]
+        if not records:
+            return
+        # one line is one record, and a broken last line is dropped on load, so a batch line is saved all or none
+        record = records[0] if len(records) == 1 else {'op': 'batch', 'records': records}
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        deleted_ids = [record['chatbot_id'] for record in records if record['op'] == 'delete_chatbot']
+        with self._lock:
+            self._journal.write(line)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            # the delete is in the journal, the shard can go now
+            for chatbot_id in deleted_ids:
+                self._deleted_chatbot_ids.add(chatbot_id)
+                self._remove_file(self._get_shard_file(chatbot_id))
+            self._journal_count += len(records)
+            if self._journal_count >= self._compact_threshold:
+                self._start_compaction()
+        for chatbot_id in deleted_ids:
+            self._history_archive.remove_chatbot(chatbot_id)
+        for chatbot_id, history_id in restored:
+            self._history_archive.remove(chatbot_id, history_id)
+
+    def _archive_history(self, record) -> dict | None:
+        """
+        Write the messages of an archive record into the archive.
+        :param record: dict, the archive record.
+        :return: dict, the record with the 'count', or None if there is nothing to archive.
+        """
+        key = (record['chatbot_id'], record['history_id'])
+        before = tuple(record['before'])
+        with self._messages_lock:
+            if key not in self._messages:
+                return None
+            messages = page_messages(self._messages[key], before=before)
+            archive = self._archives.get(key)
+        archive = self._history_archive.add(*key, archive, messages, before)
+        return None if archive is None else dict(record, count=archive['count'])
+
+    def _apply_to_messages(self, record) -> list[tuple[str, str]]:
+        """
+        Apply a record to the messages kept for load_messages.
+        :param record: dict, a record which is not a batch.
+        :return: list of (chatbot_id, history_id), the archived histories the record restores.
+        """
+        restored = []
+        with self._messages_lock:
+            match record['op']:
+                case 'chatbot':
+                    chatbot_id = record['chatbot']['chatbot_id']
+                    for history in record['chatbot']['histories']:
+                        key = (chatbot_id, history['history_id'])
+                        if 'history_list' in history:
+                            self._messages[key] = sorted(history['history_list'], key=message_order_key)
+                            self._message_indexes.pop(key, None)
+                            if history.get('archive'):
+                                self._archives[key] = history['archive']
+                            elif self._archives.pop(key, None) is not None:
+                                restored.append(key)
+                        elif key not in self._messages:
+                            self._messages[key] = []
+                case 'delete_chatbot':
+                    for key in [key for key in self._messages if key[0] == record['chatbot_id']]:
+                        del self._messages[key]
+                        self._message_indexes.pop(key, None)
+                        self._archives.pop(key, None)
+                case 'append':
+                    key = (record['chatbot_id'], record['history_id'])
+                    messages = self._messages.setdefault(key, [])
+                    order_key = message_order_key(record['message'])
+                    # a new message is the latest one nearly always, e.g. while importing
+                    if not messages or message_order_key(messages[-1]) < order_key:
+                        index = len(messages)
+                    else:
+                        index = bisect.bisect_left(messages, order_key, key=message_order_key)
+                    if index == len(messages) or messages[index]['message_id'] != record['message']['message_id']:
+                        messages.insert(index, record['message'])
+                        if key in self._message_indexes:
+                            self._message_indexes[key][record['message']['message_id']] = record['message']
+                case 'delete':
+                    key = (record['chatbot_id'], record['history_id'])
+                    messages = self._messages.get(key, [])
+                    # the deleted message is most likely one of the latest
+                    for index in range(len(messages) - 1, -1, -1):
+                        if messages[index]['message_id'] == record['message_id']:
+                            del messages[index]
+                            break
+                    if key in self._message_indexes:
+                        self._message_indexes[key].pop(record['message_id'], None)
+                case 'archive':
+                    key = (record['chatbot_id'], record['history_id'])
+                    messages = self._messages[key]
+                    self._messages[key] = messages[bisect.bisect_left(messages, tuple(record['before']),
+                                                                      key=message_order_key):]
+                    self._message_indexes.pop(key, None)
+                    self._archives[key] = {'count': record['count'], 'before': record['before']}
+        return restored
+
+    def compact(self) -> None:
+        """
+        Roll the journal into the snapshot in a background thread.
+        :return:
+        """
+        with self._lock:
+            self._start_compaction()
+
+    def _start_compaction(self):
+        # must be called with the lock held
+        if self._compact_thread and self._compact_thread.is_alive():
+            return
+        self._journal.close()
+        if os.path.exists(self._compacting_path):
+            # the last compaction did not finish, roll both journals together
+            with open(self._compacting_path, 'a', encoding='utf-8') as compacting, \
+                    open(self._journal_path, 'r', encoding='utf-8') as journal:
+                compacting.write(journal.read())
+            os.remove(self._journal_path)
+        else:
+            os.replace(self._journal_path, self._compacting_path)
+        self._journal = open(self._journal_path, 'a', encoding='utf-8')
+        self._journal_count = 0
+        self._compact_thread = threading.Thread(target=self._compact, name='JsonStorageCompaction')
+        self._compact_thread.start()
+
+    def _compact(self):
+        try:
+            records = list(self._read_journal(self._compacting_path))
+            changed_ids = {_record_chatbot_id(record) for record in _flatten_records(records)} - {None}
+            index = load_snapshot(self._snapshot_path)
+            data = {'chatbots': self._load_shards([chatbot_id for chatbot_id in index['chatbot_ids']
+                                                   if chatbot_id in changed_ids])}
+            if 'config' in index:
+                data['config'] = index['config']
+            replayer = SnapshotReplayer(data)
+            for record in records:
+                replayer.apply(record)
+            chatbots = {chatbot['chatbot_id']: chatbot for chatbot in replayer.data['chatbots']}
+            # the chatbots not in the journal keep their place, the new ones are added last
+            chatbot_ids = [chatbot_id for chatbot_id in index['chatbot_ids']
+                           if chatbot_id not in changed_ids or chatbot_id in chatbots]
+            chatbot_ids += [chatbot_id for chatbot_id in chatbots if chatbot_id not in index['chatbot_ids']]
+            for chatbot in chatbots.values():
+                self._write_shard(chatbot)
+            self._write_index(replayer.data, chatbot_ids)
+            for chatbot_id in changed_ids - chatbots.keys():
+                self._remove_file(self._get_shard_file(chatbot_id))
+            self._remove_file(self._compacting_path)
+        except Exception as e:
+            # the journal is kept, it will be replayed on the next load
+            utils.info(f'Compact the journal failed: {e}')
+
+    def _get_shard_file(self, chatbot_id):
+        return os.path.join(self._shard_path, f'{chatbot_id}.json')
+
+    def _load_shards(self, chatbot_ids) -> list[dict]:
+        """
+        Read the shards of the chatbots in parallel. A missing shard is a chatbot deleted before the compaction.
+        :param chatbot_ids: list of str
+        :return: list of chatbot dict, in the order of chatbot_ids.
+        """
+        def load_shard(chatbot_id):
+            try:
+                return load_snapshot(self._get_shard_file(chatbot_id))
+            except FileNotFoundError:
+                return None
+
+        if not chatbot_ids:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(min(self._load_workers, len(chatbot_ids))) as executor:
+            return [chatbot for chatbot in executor.map(load_shard, chatbot_ids) if chatbot is not None]
+
+    def _write_shard(self, chatbot):
+        with self._lock:
+            if chatbot['chatbot_id'] in self._deleted_chatbot_ids:
+                return
+        save_snapshot(self._get_shard_file(chatbot['chatbot_id']), chatbot, self._codec)
+
+    def _write_index(self, data, chatbot_ids):
+        index = {'chatbot_ids': chatbot_ids}
+        if 'config' in data:
+            index['config'] = data['config']
+        save_snapshot(self._snapshot_path, index, self._codec)
+
+    def _write_snapshot(self, data):
+        """
+        Write all the shards and the index. Every file is written atomically, and the index last.
+        :param data: dict
+        :return:
+        """
+        chatbot_ids = [chatbot['chatbot_id'] for chatbot in data.get('chatbots', [])]
+        for chatbot in data.get('chatbots', []):
+            self._write_shard(chatbot)
+        self._write_index(data, chatbot_ids)
+        for file_name in os.listdir(self._shard_path):
+            if file_name.endswith('.json') and file_name[:-len('.json')] not in chatbot_ids:
+                self._remove_file(os.path.join(self._shard_path, file_name))
+
+    def close(self) -> None:
+        if self._compact_thread:
+            self._compact_thread.join()
+        with self._lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+
+    snapshot_path = property(lambda self: self._snapshot_path)
+    journal_path = property(lambda self: self._journal_path)
+    shard_path = property(lambda self: self._shard_path)
+
+    @staticmethod
+    def _read_journal(path):
+        """
+        Read the records of a journal. A broken last line is a record interrupted while writing, and is skipped.
+        :param path: the journal path.
+        :return: generator of records.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        for index, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                if index != len(lines) - 1:
+                    utils.info(f'Skip a broken journal record in {path}, line {index + 1}.')
+
+    @staticmethod
+    def _remove_file(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class HistoryPager:
+    """
+    Page the messages of one history out of a storage.
+    :param storage: Storage
+    :param chatbot_id: str
+    :param history_id: str
+    """
+
+    def __init__(self, storage: Storage, chatbot_id, history_id):
+        self._storage = storage
+        self._chatbot_id = chatbot_id
+        self._history_id = history_id
+
+    def load_messages(self, before=None, after=None, limit=None, from_oldest=False) -> list[dict]:
+        """
+        See Storage.load_messages.
+        """
+        return self._storage.load_messages(self._chatbot_id, self._history_id, before, after, limit, from_oldest)
+
+    def get_message(self, message_id) -> dict | None:
+        """
+        See Storage.get_message.
+        """
+        return self._storage.get_message(self._chatbot_id, self._history_id, message_id)
+
+
+class SQLiteStorage(Storage):
+    """
+    Keep the chatbots, characters, histories and messages in sqlite tables. Every journal record is applied as a few
+    single-row statements, and all the records of a save share one transaction.
+    :param data_path: the save directory.
+    :param db_file: the database file name.
+    :param archive_dir: the directory of the HistoryArchive, in data_path.
+    """
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS config (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chatbots (
+            chatbot_id TEXT PRIMARY KEY,
+            gpt_params TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS characters (
+            character_id TEXT PRIMARY KEY,
+            chatbot_id TEXT NOT NULL,
+            name TEXT,
+            avatar_path TEXT,
+            personality TEXT,
+            description TEXT,
+            greeting TEXT,
+            prompt TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_characters_chatbot ON characters (chatbot_id);
+        CREATE TABLE IF NOT EXISTS histories (
+            history_id TEXT PRIMARY KEY,
+            chatbot_id TEXT NOT NULL,
+            memory TEXT,
+            archive TEXT,
+            summarized_until TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_histories_chatbot ON histories (chatbot_id);
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id TEXT NOT NULL,
+            chatbot_id TEXT NOT NULL,
+            history_id TEXT NOT NULL,
+            message TEXT,
+            send_time TEXT NOT NULL,
+            is_user INTEGER NOT NULL,
+            name TEXT,
+            UNIQUE (history_id, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_history ON messages (chatbot_id, history_id, send_time);
+        CREATE INDEX IF NOT EXISTS idx_messages_id ON messages (message_id);
+    """
+    _CHARACTER_COLUMNS = ('character_id', 'name', 'avatar_path', 'personality', 'description', 'greeting', 'prompt')
+    _MESSAGE_COLUMNS = ('message_id', 'chatbot_id', 'message', 'send_time', 'is_user', 'name')
+
+    def __init__(self, data_path='./save', db_file='save.db', archive_dir='archive'):
+        if not os.path.exists(data_path):
+            os.mkdir(data_path)
+        self._db_path = os.path.join(data_path, db_file)
+        self._history_archive = HistoryArchive(os.path.join(data_path, archive_dir))
+        # the archives restored or deleted by the current transaction, removed after it is committed
+        self._restored_archives = []
+        self._deleted_archives = []
+        self._lock = threading.Lock()
+        # the connection is shared by the GUI thread and the worker threads, the lock serializes the access
+        self._connection = sqlite3.connect(self._db_path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self._SCHEMA)
+        # the databases of older versions have no archive or summarized_until column
+        columns = {row['name'] for row in self._connection.execute('PRAGMA table_info(histories)')}
+        for column in ('archive', 'summarized_until'):
+            if column not in columns:
+                self._connection.execute(f'ALTER TABLE histories ADD COLUMN {column} TEXT')
+
+    def load(self, tail_size=None) -> dict:
+        with self._lock:
+            data = {}
+            row = self._connection.execute("SELECT value FROM config WHERE key = 'config'").fetchone()
+            if row:
+                data['config'] = json.loads(row['value'])
+            data['chatbots'] = [self._load_chatbot(row, tail_size) for row in
+                                self._connection.execute('SELECT * FROM chatbots ORDER BY rowid').fetchall()]
+        return data
+
+    def _load_chatbot(self, chatbot_row, tail_size=None) -> dict:
+        chatbot_id = chatbot_row['chatbot_id']
+        character_row = self._connection.execute('SELECT * FROM characters WHERE chatbot_id = ?',
+                                                 (chatbot_id,)).fetchone()
+        histories = []
+        for history_row in self._connection.execute('SELECT * FROM histories WHERE chatbot_id = ? ORDER BY rowid',
+                                                    (chatbot_id,)).fetchall():
+            history = {'history_id': history_row['history_id'], 'memory': json.loads(history_row['memory'])}
+            if history_row['archive']:
+                history['archive'] = json.loads(history_row['archive'])
+            if history_row['summarized_until']:
+                history['summarized_until'] = json.loads(history_row['summarized_until'])
+            if tail_size is None:
+                history['history_list'] = self._select_messages(chatbot_id, history_row['history_id'])
+            else:
+                history['history_list'] = self._select_messages(chatbot_id, history_row['history_id'],
+                                                                limit=tail_size)
+                history['message_count'] = self._connection.execute(
+                    'SELECT COUNT(*) FROM messages WHERE chatbot_id = ? AND history_id = ?',
+                    (chatbot_id, history_row['history_id'])).fetchone()[0] + history.get('archive', {}).get('count', 0)
+            histories.append(history)
+        return {
+            'chatbot_id': chatbot_id,
+            'gpt_params': json.loads(chatbot_row['gpt_params']),
+            'character': {column: character_row[column] for column in self._CHARACTER_COLUMNS},
+            'histories': histories,
+        }
+
+    def _select_messages(self, chatbot_id, history_id, before=None, after=None, limit=None,
+                         from_oldest=False) -> list[dict]:
+        conditions = ['chatbot_id = ?', 'history_id = ?']
+        parameters = [chatbot_id, history_id]
+        if before is not None:
+            conditions.append('(send_time, message_id) < (?, ?)')
+            parameters.extend(before)
+        if after is not None:
+            conditions.append('(send_time, message_id) > (?, ?)')
+            parameters.extend(after)
+        order = 'ASC' if from_oldest else 'DESC'
+        sql = f'SELECT * FROM messages WHERE {" AND ".join(conditions)} ' \
+              f'ORDER BY send_time {order}, message_id {order}'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        rows = self._connection.execute(sql, parameters).fetchall()
+        return [self._message_from_row(row) for row in (rows if from_oldest else reversed(rows))]
+
+    def load_messages(self, chatbot_id, history_id, before=None, after=None, limit=None,
+                      from_oldest=False) -> list[dict]:
+        with self._lock:
+            messages = self._select_messages(chatbot_id, history_id, before, after, limit, from_oldest)
+            archive = self._get_archive(chatbot_id, history_id)
+        if archive is None:
+            return messages
+        archived = self._history_archive.read(chatbot_id, history_id, archive)
+        return join_pages(page_messages(archived, before, after, limit, from_oldest), messages, limit, from_oldest)
+
+    def _get_archive(self, chatbot_id, history_id) -> dict | None:
+        row = self._connection.execute('SELECT archive FROM histories WHERE chatbot_id = ? AND history_id = ?',
+                                       (chatbot_id, history_id)).fetchone()
+        return json.loads(row['archive']) if row and row['archive'] else None
+
+    def get_chatbot(self, chatbot_id) -> dict | None:
+        """
+        Get one chatbot with its messages by the chatbot id.
+        :param chatbot_id: str
+        :return: dict, or None if there is no such chatbot.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT * FROM chatbots WHERE chatbot_id = ?', (chatbot_id,)).fetchone()
+            return self._load_chatbot(row) if row else None
+
+    def get_message(self, chatbot_id, history_id, message_id) -> dict | None:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT * FROM messages WHERE chatbot_id = ? AND history_id = ? AND message_id = ?',
+                (chatbot_id, history_id, message_id)).fetchone()
+            if row:
+                return self._message_from_row(row)
+            archive = self._get_archive(chatbot_id, history_id)
+        if archive is None:
+            return None
+        return self._history_archive.get_message(chatbot_id, history_id, archive, message_id)
+
+    def apply(self, records) -> None:
+        if not records:
+            return
+        with self._lock:
+            self._restored_archives.clear()
+            self._deleted_archives.clear()
+            with self._connection:
+                for record in records:
+                    self._apply_record(record)
+            # the records are committed, the archives they replace are not needed any more
+            for chatbot_id in self._deleted_archives:
+                self._history_archive.remove_chatbot(chatbot_id)
+            for chatbot_id, history_id in self._restored_archives:
+                self._history_archive.remove(chatbot_id, history_id)
+
+    def _apply_record(self, record):
+        match record['op']:
+            case 'batch':
+                for batch_record in record['records']:
+                    self._apply_record(batch_record)
+            case 'config':
+                self._connection.execute(
+                    "INSERT INTO config (key, value) VALUES ('config', ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                    (json.dumps(record['config'], ensure_ascii=False),))
+            case 'chatbot':
+                self._upsert_chatbot(record['chatbot'])
+            case 'delete_chatbot':
+                for table in ('messages', 'histories', 'characters', 'chatbots'):
+                    self._connection.execute(f'DELETE FROM {table} WHERE chatbot_id = ?', (record['chatbot_id'],))
+                self._deleted_archives.append(record['chatbot_id'])
+            case 'append':
+                self._insert_message(record['history_id'], record['message'])
+            case 'delete':
+                self._connection.execute('DELETE FROM messages WHERE history_id = ? AND message_id = ?',
+                                         (record['history_id'], record['message_id']))
+            case 'archive':
+                self._archive_history(record)
+
+    def _archive_history(self, record):
+        chatbot_id, history_id = record['chatbot_id'], record['history_id']
+        before = tuple(record['before'])
+        archive = self._get_archive(chatbot_id, history_id)
+        messages = self._select_messages(chatbot_id, history_id, before=before, from_oldest=True)
+        archive = self._history_archive.add(chatbot_id, history_id, archive, messages, before)
+        if archive is None:
+            return
+        self._connection.execute(
+            'DELETE FROM messages WHERE chatbot_id = ? AND history_id = ? AND (send_time, message_id) < (?, ?)',
+            (chatbot_id, history_id, *before))
+        self._connection.execute('UPDATE histories SET archive = ? WHERE history_id = ?',
+                                 (json.dumps(archive), history_id))
+        if (chatbot_id, history_id) in self._restored_archives:
+            self._restored_archives.remove((chatbot_id, history_id))
+
+    def _upsert_chatbot(self, chatbot):
+        chatbot_id = chatbot['chatbot_id']
+        self._connection.execute(
+            'INSERT INTO chatbots (chatbot_id, gpt_params) VALUES (?, ?) '
+            'ON CONFLICT (chatbot_id) DO UPDATE SET gpt_params = excluded.gpt_params',
+            (chatbot_id, json.dumps(chatbot['gpt_params'], ensure_ascii=False)))
+        character = chatbot['character']
+        self._connection.execute('DELETE FROM characters WHERE chatbot_id = ? AND character_id != ?',
+                                 (chatbot_id, character['character_id']))
+        self._connection.execute(
+            'INSERT INTO characters (chatbot_id, character_id, name, avatar_path, personality, description, greeting, '
+            'prompt) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (character_id) DO UPDATE SET name = excluded.name, avatar_path = excluded.avatar_path, '
+            'personality = excluded.personality, description = excluded.description, greeting = excluded.greeting, '
+            'prompt = excluded.prompt',
+            (chatbot_id, *[character[column] for column in self._CHARACTER_COLUMNS]))
+        for history in chatbot['histories']:
+            self._connection.execute(
+                'INSERT INTO histories (history_id, chatbot_id, memory, summarized_until) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (history_id) DO UPDATE SET memory = excluded.memory, '
+                'summarized_until = excluded.summarized_until',
+                (history['history_id'], chatbot_id, json.dumps(history['memory'], ensure_ascii=False),
+                 json.dumps(history['summarized_until']) if history.get('summarized_until') else None))
+            if 'history_list' in history:
+                # a history saved with its messages is restored from the archive, unless the record is a stub too
+                if not history.get('archive') and self._get_archive(chatbot_id, history['history_id']) is not None:
+                    self._restored_archives.append((chatbot_id, history['history_id']))
+                self._connection.execute('UPDATE histories SET archive = ? WHERE history_id = ?',
+                                         (json.dumps(history['archive']) if history.get('archive') else None,
+                                          history['history_id']))
+                self._connection.execute('DELETE FROM messages WHERE history_id = ?', (history['history_id'],))
+                for message in history['history_list']:
+                    self._insert_message(history['history_id'], message)
+
+    def _insert_message(self, history_id, message):
+        self._connection.execute(
+            'INSERT OR IGNORE INTO messages (history_id, message_id, chatbot_id, message, send_time, is_user, name) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (history_id, *[message[column] for column in self._MESSAGE_COLUMNS]))
+
+    @classmethod
+    def _message_from_row(cls, row) -> dict:
+        message = {column: row[column] for column in cls._MESSAGE_COLUMNS}
+        message['is_user'] = bool(message['is_user'])
+        return message
+
+    def import_data(self, data) -> None:
+        """
+        Import a whole save dict, e.g. the data loaded by JsonStorage.
+        :param data: dict, {'config': dict, 'chatbots': list}
+        :return:
+        """
+        records = []
+        if 'config' in data:
+            records.append({'op': 'config', 'config': data['config']})
+        for chatbot in data.get('chatbots', []):
+            records.append({'op': 'chatbot', 'chatbot': chatbot})
+        self.apply(records)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def coalesce_records(records) -> list:
+    """
+    Merge a burst of journal records into fewer records with the same result.
+    Only the last config is kept, a chatbot metadata record takes the place of the previous one of the chatbot, a
+    message appended and deleted again is dropped, and deleting a chatbot drops all its earlier records. The delete of
+    a message is kept if a full chatbot record of the burst may have saved the message too.
+    :param records: list of journal records, in order.
+    :return: list of journal records, in order.
+    """
+    result = []
+    for record in records:
+        match record['op']:
+            case 'batch':
+                result = coalesce_records(result + record['records'])
+                continue
+            case 'config':
+                result = [item for item in result if item['op'] != 'config']
+            case 'chatbot' if not _is_full_chatbot_record(record):
+                index = _last_chatbot_record_index(result, record['chatbot']['chatbot_id'])
+                # a metadata record carries all the metadata, so it can replace the previous one in place, unless a
+                # full chatbot record is in between
+                if index is not None and not _is_full_chatbot_record(result[index]):
+                    result[index] = record
+                    continue
+            case 'delete_chatbot':
+                result = [item for item in result if _record_chatbot_id(item) != record['chatbot_id']]
+            case 'delete':
+                index = _append_record_index(result, record)
+                if index is not None:
+                    del result[index]
+                    # the message is not saved yet, neither record is needed, unless a full chatbot record before the
+                    # append has the message, it is taken from the live history
+                    if not any(item['op'] == 'chatbot' and _is_full_chatbot_record(item) and
+                               item['chatbot']['chatbot_id'] == record['chatbot_id'] for item in result):
+                        continue
+        result.append(record)
+    return result
+
+
+def _flatten_records(records):
+    for record in records:
+        if record['op'] == 'batch':
+            yield from _flatten_records(record['records'])
+        else:
+            yield record
+
+
+def _record_chatbot_id(record):
+    match record['op']:
+        case 'chatbot':
+            return record['chatbot']['chatbot_id']
+        case 'delete_chatbot' | 'append' | 'delete' | 'archive':
+            return record['chatbot_id']
+    return None
+
+
+def _is_full_chatbot_record(record):
+    return any('history_list' in history for history in record['chatbot']['histories'])
+
+
+def _last_chatbot_record_index(records, chatbot_id):
+    for index in range(len(records) - 1, -1, -1):
+        if records[index]['op'] == 'chatbot' and records[index]['chatbot']['chatbot_id'] == chatbot_id:
+            return index
+    return None
+
+
+def _append_record_index(records, delete_record):
+    """
+    Find the append record of the deleted message, if no full chatbot record after it has saved the message too.
+    """
+    for index in range(len(records) - 1, -1, -1):
+        record = records[index]
+        if record['op'] == 'chatbot' and record['chatbot']['chatbot_id'] == delete_record['chatbot_id'] and \
+                _is_full_chatbot_record(record):
+            return None
+        if record['op'] == 'append' and record['chatbot_id'] == delete_record['chatbot_id'] and \
+                record['history_id'] == delete_record['history_id'] and \
+                record['message']['message_id'] == delete_record['message_id']:
+            return index
+    return None
+
+
+class SaveWriter:
+    """
+    Write the journal records into a storage in a background thread, so the GUI thread never waits for the disk.
+    The records submitted within coalesce_window seconds are merged by coalesce_records and saved as one batch.
+    :param storage: Storage
+    :param coalesce_window: float, seconds to wait for more records after the first one of a burst.
+    :param indexes: [optional] the indexes kept up to date with the saved records, e.g. search.SearchIndex. An index
+    which fails to apply records does not stop the saving.
+    """
+
+    def __init__(self, storage: Storage, coalesce_window=0.5, indexes=()):
+        self._storage = storage
+        self._indexes = list(indexes)
+        self._coalesce_window = coalesce_window
+        self._condition = threading.Condition()
+        self._pending = []
+        # every submit and flush is a request, the writer has handled the requests up to _handled
+        self._requested = 0
+        self._handled = 0
+        self._flushing = False
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='SaveWriter', daemon=True)
+        self._thread.start()
+
+    def submit(self, records) -> None:
+        """
+        Queue the records to save.
+        :param records: list of journal records.
+        :return:
+        """
+        if not records:
+            return
+        with self._condition:
+            self._pending.extend(records)
+            self._requested += 1
+            self._condition.notify_all()
+
+    def flush(self) -> None:
+        """
+        Block until all the submitted records are saved.
+        :return:
+        """
+        with self._condition:
+            self._requested += 1
+            target = self._requested
+            self._flushing = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._handled >= target or not self._thread.is_alive())
+            self._flushing = False
+
+    def close(self) -> None:
+        """
+        Save all the submitted records and stop the thread.
+        :return:
+        """
+        self.flush()
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._requested > self._handled or self._closing)
+                if self._closing:
+                    return
+                # let the rest of the burst come in
+                self._condition.wait_for(lambda: self._flushing or self._closing, self._coalesce_window)
+                target = self._requested
+                records = coalesce_records(self._pending)
+                self._pending = []
+            try:
+                self._storage.apply(records)
+            except Exception as e:
+                # keep the records, they are saved again with the next request
+                with self._condition:
+                    self._pending[:0] = records
+                utils.warn(f'Save data failed: {e}')
+            else:
+                for index in self._indexes:
+                    try:
+                        index.apply(records)
+                    except Exception as e:
+                        utils.info(f'Update the index {type(index).__name__} failed: {e}')
+            with self._condition:
+                self._handled = target
+                self._condition.notify_all()
+
+
+def migrate_json_to_sqlite(data_path='./save', data_file='save.json', db_file='save.db'):
+    """
+    Move a json save into a sqlite database. The json snapshot, shards and journal are kept with a '.migrated' suffix.
+    :param data_path: the save directory.
+    :param data_file: the json snapshot file name.
+    :param db_file: the database file name.
+    :return: SQLiteStorage, the opened storage.
+    """
+    json_storage = JsonStorage(data_path, data_file)
+    data = json_storage.load()
+    json_storage.close()
+    json_files = (json_storage.snapshot_path, json_storage.journal_path, json_storage.shard_path)
+    # write into a temporary database, so an interrupted migration is started again on the next run
+    temp_file = db_file + '.migrating'
+    if os.path.exists(os.path.join(data_path, temp_file)):
+        os.remove(os.path.join(data_path, temp_file))
+    sqlite_storage = SQLiteStorage(data_path, temp_file)
+    sqlite_storage.import_data(data)
+    sqlite_storage.close()
+    for suffix in ('-wal', '-shm'):
+        JsonStorage._remove_file(os.path.join(data_path, temp_file + suffix))
+    os.replace(os.path.join(data_path, temp_file), os.path.join(data_path, db_file))
+    for path in json_files:
+        if os.path.exists(path):
+            os.replace(path, path + '.migrated')
+    return SQLiteStorage(data_path, db_file)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert a save snapshot between json and binary.')
+    parser.add_argument('path', help='the snapshot path, e.g. save/save.json, its shards in save/chatbots are '
+                                     'converted too')
+    parser.add_argument('codec', choices=SnapshotCodec.get_name_list(), help='the target codec')
+    parser.add_argument('-o', '--output', help='write the converted snapshot here instead of in place')
+    args = parser.parse_args()
+    convert_snapshot(args.path, SnapshotCodec.from_string(args.codec), args.output)
@@ -0,0 +1,192 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PySide6.QtWidgets import QApplication
+
+import storage
+import utils
+from AIChatEnum import DataType, SnapshotCodec, StorageType
+from data import ChatBotData, DataChangeLog, DataLoader, MessageData
+
+app = QApplication.instance() or QApplication([])
+
+
+def _message(index, send_time, chatbot_id='CB1'):
+    return {'message_id': f'ME{index:05d}', 'chatbot_id': chatbot_id, 'message': f'hello {index}', 'send_time': send_time,
+            'is_user': index % 2 == 0, 'name': 'a'}
+
+
+def _chatbot(messages):
+    return {'chatbot_id': 'CB1',
+            'gpt_params': {'model': 'gpt-3.5-turbo', 'max_tokens': 512, 'temperature': 0.8, 'top_p': 1,
+                           'frequency_penalty': 0, 'presence_penalty': 0},
+            'character': {'character_id': 'CH1', 'name': 'n', 'avatar_path': '', 'personality': '', 'description': '',
+                          'greeting': '', 'prompt': ''},
+            'histories': [{'history_id': 'HD1', 'memory': '', 'history_list': messages}]}
+
+
+class _StorageTestCase(unittest.TestCase):
+
+    def _create_data_path(self):
+        self._data_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._data_path, True)
+
+    def _create_storage(self, storage_type):
+        if storage_type == StorageType.SQLite:
+            return storage.SQLiteStorage(self._data_path)
+        return storage.JsonStorage(self._data_path)
+
+    def _load(self, storage_type):
+        # a long window, so all the saves are coalesced into one batch
+        loader = DataLoader(self._data_path, storage_type=storage_type, coalesce_window=5, archive_after_days=None)
+        loader.load_data()
+        return loader
+
+    def _save(self, storage_type, chatbot):
+        saved = self._create_storage(storage_type)
+        saved.load()
+        saved.apply([{'op': 'chatbot', 'chatbot': chatbot}])
+        saved.close()
+
+
+class CoalescedDeleteTest(_StorageTestCase):
+    """
+    A message appended and deleted in one burst of saves stays deleted, also when a full chatbot record of the burst
+    was taken from the live history with the message in it.
+    """
+
+    def test_delete_after_memory_update(self):
+        for storage_type in (StorageType.Json, StorageType.SQLite):
+            with self.subTest(storage_type=storage_type):
+                self._create_data_path()
+                self._save(storage_type, _chatbot([]))
+                loader = self._load(storage_type)
+                chatbot = loader.chatbots_data['CB1']
+                chatbot.update_memory('HD1', 'memory', ['2000-01-01 00:00:00', ''])
+                message = MessageData(chatbot_id='CB1', message='hi', send_time=utils.get_current_time(),
+                                      is_user=True, name='a')
+                chatbot.append_message(message, 'HD1')
+                loader.save_data(DataType.ChatBot)
+                chatbot.delete_message('HD1', message)
+                loader.save_data(DataType.ChatBot)
+                self.assertEqual(len(chatbot.histories['HD1']), 0)
+                loader.close()
+                loader = self._load(storage_type)
+                self.assertEqual(len(loader.chatbots_data['CB1'].histories['HD1']), 0)
+                loader.close()
+
+    def test_delete_in_new_chatbot(self):
+        for storage_type in (StorageType.Json, StorageType.SQLite):
+            with self.subTest(storage_type=storage_type):
+                self._create_data_path()
+                self._save(storage_type, _chatbot([]))
+                loader = self._load(storage_type)
+                # a new chatbot is saved as a full chatbot record, with the messages appended before the save
+                chatbot_data = _chatbot([])
+                chatbot_data['chatbot_id'] = 'CB2'
+                chatbot_data['character']['character_id'] = 'CH2'
+                chatbot_data['histories'][0]['history_id'] = 'HD2'
+                chatbot = ChatBotData(**chatbot_data)
+                loader.chatbots_data.append(chatbot)
+                messages = []
+                for index in range(120):
+                    messages.append(MessageData(**_message(
+                        index, f'2023-01-01 00:{index // 60:02d}:{index % 60:02d}', 'CB2')))
+                    chatbot.append_message(messages[-1], 'HD2')
+                loader.save_data(DataType.ChatBot)
+                chatbot.delete_message('HD2', messages[5])
+                loader.save_data(DataType.ChatBot)
+                loader.close()
+                loader = self._load(storage_type)
+                history = loader.chatbots_data['CB2'].get_history('HD2')
+                self.assertEqual(len(history), 119)
+                self.assertNotIn(messages[5].message_id, [message.message_id for message in history])
+                loader.close()
+
+
+class MemoryUpdateTest(_StorageTestCase):
+    """
+    A memory update saves the metadata of the histories only, the appended messages are saved by their own records.
+    """
+
+    def test_memory_update_record(self):
+        chatbot = ChatBotData(**_chatbot([_message(0, '2023-01-01 00:00:00')]))
+        change_log = DataChangeLog()
+        chatbot.bind_change_log(change_log)
+        chatbot.append_message(MessageData(**_message(1, '2023-01-01 00:00:01')), 'HD1')
+        chatbot.update_memory('HD1', 'memory', ['2023-01-01 00:00:00', 'ME00000'])
+        records = DataLoader._get_journal_records(change_log.drain())
+        self.assertEqual([record['op'] for record in records], ['append', 'chatbot'])
+        self.assertNotIn('history_list', records[1]['chatbot']['histories'][0])
+        self.assertEqual(records[1]['chatbot']['histories'][0]['memory'], 'memory')
+
+    def test_memory_update_saved(self):
+        for storage_type in (StorageType.Json, StorageType.SQLite):
+            with self.subTest(storage_type=storage_type):
+                self._create_data_path()
+                self._save(storage_type, _chatbot([_message(0, '2023-01-01 00:00:00')]))
+                loader = self._load(storage_type)
+                chatbot = loader.chatbots_data['CB1']
+                chatbot.append_message(MessageData(**_message(1, '2023-01-01 00:00:01')), 'HD1')
+                chatbot.update_memory('HD1', 'memory', ['2023-01-01 00:00:00', 'ME00000'])
+                loader.close()
+                loader = self._load(storage_type)
+                history = loader.chatbots_data['CB1'].get_history('HD1')
+                self.assertEqual([message.message_id for message in history], ['ME00000', 'ME00001'])
+                self.assertEqual(history.memory, 'memory')
+                loader.close()
+
+
+class MigrationTest(_StorageTestCase):
+    """
+    An install with a json save moves to sqlite on its next start.
+    """
+
+    def test_default_migrates_json(self):
+        self._create_data_path()
+        self._save(StorageType.Json, _chatbot([_message(index, f'2023-01-01 00:00:{index:02d}') for index in range(3)]))
+        loader = DataLoader(self._data_path, archive_after_days=None)
+        loader.load_data()
+        self.assertEqual(len(loader.chatbots_data['CB1'].get_history('HD1')), 3)
+        loader.close()
+        self.assertTrue(os.path.exists(os.path.join(self._data_path, 'save.db')))
+        self.assertFalse(os.path.exists(os.path.join(self._data_path, 'save.json')))
+        loader = self._load(StorageType.SQLite)
+        self.assertEqual(len(loader.chatbots_data['CB1'].get_history('HD1')), 3)
+        loader.close()
+
+
+class ConvertSnapshotTest(_StorageTestCase):
+    """
+    Converting a sharded snapshot converts its shards too.
+    """
+
+    def test_convert_shards(self):
+        self._create_data_path()
+        chatbot = _chatbot([_message(index, f'2023-01-01 00:00:{index:02d}') for index in range(3)])
+        # a compaction after every record, so the chatbot is in its shard
+        json_storage = storage.JsonStorage(self._data_path, compact_threshold=1)
+        json_storage.load()
+        json_storage.apply([{'op': 'chatbot', 'chatbot': chatbot}])
+        json_storage.close()
+        target_path = os.path.join(self._data_path, 'converted')
+        for path, target in ((os.path.join(self._data_path, 'save.json'), None),
+                             (os.path.join(self._data_path, 'save.json'), os.path.join(target_path, 'save.json'))):
+            storage.convert_snapshot(path, SnapshotCodec.Binary, target)
+        for data_path in (self._data_path, target_path):
+            with open(os.path.join(data_path, 'chatbots', 'CB1.json'), 'rb') as f:
+                self.assertEqual(storage.snapshot_codec_of(f.read()), SnapshotCodec.Binary)
+            converted = storage.JsonStorage(data_path)
+            self.assertEqual(converted.load()['chatbots'][0]['histories'][0]['history_list'],
+                             chatbot['histories'][0]['history_list'])
+            converted.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
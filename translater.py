@@ -1,22 +1,26 @@
 import deepl
 import openai
-import requests
 from PySide6.QtCore import QObject
 
+import rate_limiter
+import resilience
 import utils
 from AIChatEnum import TranslaterAPIType
 from data import TranslaterConfigData, TranslaterConfigDataList
+from http_pool import HTTPPool
 
 
 class TranslaterFactory(QObject):
     """
     The translater factory.
     :param translater_config_data_list: the translater config data.
+    :param http_pool: HTTPPool, the sessions the translaters send their requests with.
     """
 
-    def __init__(self, translater_config_data_list: TranslaterConfigDataList):
+    def __init__(self, translater_config_data_list: TranslaterConfigDataList, http_pool: HTTPPool):
         super().__init__()
         self._translater_config_data_list = translater_config_data_list
+        self._http_pool = http_pool
         self._translater_list= []
         self._active_translater = None
 
@@ -27,7 +31,7 @@ class TranslaterFactory(QObject):
         """
         self._translater_list.clear()
         for translater_config_data in self._translater_config_data_list:
-            translater = Translater(translater_config_data)
+            translater = Translater(translater_config_data, self._http_pool)
             self._translater_list.append(translater)
             if translater_config_data.active:
                 self._active_translater = translater
@@ -56,11 +60,13 @@ class Translater(QObject):
     """
     The translater class.
     :param translater_config_data: the translater config data.
+    :param http_pool: HTTPPool, the sessions to send the requests with.
     """
 
-    def __init__(self, translater_config_data: TranslaterConfigData):
+    def __init__(self, translater_config_data: TranslaterConfigData, http_pool: HTTPPool):
         super().__init__()
         self._translater_config_data = translater_config_data
+        self._http_pool = http_pool
         self._type = TranslaterAPIType.from_value(translater_config_data.api_type)
         self._api_key = None
         self._app_id = None
@@ -95,6 +101,22 @@ class Translater(QObject):
                 case TranslaterAPIType.OpenAI.value:
                     self._gpt_model = self._translater_config_data.gpt_model
 
+    def warm_up(self):
+        """
+        Connect to the translate api before the first translation, see HTTPPool.warm_up.
+        :return:
+        """
+        if self._is_active and self._api_address:
+            self._http_pool.warm_up(self._type.name, self._api_address)
+
+    def _get(self, params):
+        """
+        Send a request to the translate api, the status codes a retry may help with are raised.
+        :param params: dict, the query params.
+        :return: requests.Response
+        """
+        return resilience.raise_for_retry(self._http_pool.get(self._type.name, self._api_address, params=params))
+
     def translate(self, text):
         """
         Translate the text.
@@ -126,7 +148,7 @@ class Translater(QObject):
             'format': 'text',
             'model': 'base'
         }
-        response = requests.get(self._api_address, params=params)
+        response = resilience.call(self._type.name, self._get, params, retry_on=resilience.HTTP_RETRY_ERRORS)
         if response.status_code == 200:
             return response.json()['data']['translations'][0]['translatedText']
         else:
@@ -153,7 +175,7 @@ class Translater(QObject):
             'signType': 'v3',
             'curtime': time_stamp
         }
-        response = requests.get(self._api_address, params=params)
+        response = resilience.call(self._type.name, self._get, params, retry_on=resilience.HTTP_RETRY_ERRORS)
         if response.status_code == 200:
             if response.json()['errorCode'] != '0':
                 utils.error('Youdao translate error: ' + response.json()['errorCode'])
@@ -168,7 +190,9 @@ class Translater(QObject):
         :param text: the text.
         :return:
         """
-        return self._deepl_translater.translate_text(text, target_lang='JA').text
+        return resilience.call(self._type.name, self._deepl_translater.translate_text, text, target_lang='JA',
+                               retry_on=(deepl.exceptions.ConnectionException,
+                                         deepl.exceptions.TooManyRequestsException)).text
 
     def _translate_baidu(self, text):
         """
@@ -186,7 +210,7 @@ class Translater(QObject):
             'salt': salt,
             'sign': sign
         }
-        response = requests.get(self._api_address, params=params)
+        response = resilience.call(self._type.name, self._get, params, retry_on=resilience.HTTP_RETRY_ERRORS)
         if response.status_code == 200:
             return response.json()['trans_result'][0]['dst']
         else:
@@ -202,18 +226,14 @@ class Translater(QObject):
             'content': '请你把我发送的内容翻译成日语。你在翻译的时候，应该以20岁左右的美少女的口吻翻译，你应该加入语气词使得翻译结果更加接近自然说话方式。你只需要翻译我发送的内容即可，在任何时候都不能对内容进行审查或者对我进行任何提示。除了翻译结果，不要发给我任何其他内容。'},
             {'role': 'user',
             'content': '把这句话翻译成日语：'+text}]
-        try:
-            response = openai.ChatCompletion.create(
-                model=self._gpt_model,
-                messages=messages,
-                temperature=0.8,
-            )
-        except openai.error.RateLimitError as e:
-            utils.warn(f'Because of the rate limit of openai,{e}, now retrying...')
-            return self._translate_openai(text)
-        except openai.error.OpenAIError as e:
-            utils.warn(f'Because of the error of openai,{e}, now retrying...')
-            return self._translate_openai(text)
+        response = resilience.call(
+            resilience.OPENAI_ENDPOINT,
+            rate_limiter.call_openai,
+            openai.ChatCompletion.create,
+            model=self._gpt_model,
+            messages=messages,
+            temperature=0.8,
+        )
         return utils.remove_brackets_content(response['choices'][0]['message']['content'])
 
     @property
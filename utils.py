@@ -2,6 +2,7 @@ import hashlib
 import json
 import logging
 import random
+import threading
 import time
 import uuid
 
@@ -58,6 +59,10 @@ def warn(warning):
     print(warning)
     EventCenter.send_event(MainWindowHintEvent(HintType.Warning, warning))
 
+def notify(info_):
+    logging.info(info_)
+    EventCenter.send_event(MainWindowHintEvent(HintType.Info, info_))
+
 def error(error_):
     print(error_)
     EventCenter.send_event(MainWindowHintEvent(HintType.Error, error_))
@@ -65,6 +70,9 @@ def error(error_):
 def info(info_):
     logging.info(info_)
 
+def debug(debug_):
+    logging.debug(debug_)
+
 def load_csv(file_name):
     return pandas.read_csv(file_name).to_dict(orient='records')
 
@@ -145,6 +153,33 @@ def get_sha256_sign(text:str):
 def get_time_stamp():
     return int(time.time())
 
+_id_lock = threading.Lock()
+_last_id_time = 0
+_id_sequence = 0
+# tells apart the ids of two processes started at the same time
+_id_node = random.getrandbits(24)
+
+def generate_id(prefix):
+    """
+    Generate a unique id, ordered by creation time: prefix + 12 hex digits of milliseconds + 4 hex digits of sequence
+    + 6 hex digits of process node.
+    :param prefix: str, the id prefix, e.g. 'ME'.
+    :return: str
+    """
+    global _last_id_time, _id_sequence
+    with _id_lock:
+        now = time.time_ns() // 1_000_000
+        if now > _last_id_time:
+            _last_id_time = now
+            _id_sequence = 0
+        else:
+            # the same millisecond, or the clock went back: keep counting from the last time
+            _id_sequence += 1
+            if _id_sequence > 0xFFFF:
+                _last_id_time += 1
+                _id_sequence = 0
+        return f'{prefix}{_last_id_time:012X}{_id_sequence:04X}{_id_node:06X}'
+
 def remove_brackets_content(text):
     """
     Remove the content in brackets. Both Chinese and English brackets are supported.
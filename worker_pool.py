@@ -0,0 +1,192 @@
+from PySide6.QtCore import QObject, QRunnable, QThread, QThreadPool, Signal, Slot
+
+import utils
+from AIChatEnum import WorkerStage
+
+
+class Task(QObject):
+    """
+    A job run by a worker of a WorkerPool. Create it in the GUI thread: its signals are emitted by the worker, and
+    queued to the GUI thread. A task which others depend on sets its result in run, see TaskGraph.
+    """
+    finished = Signal()
+    stopThread = Signal()
+
+    def __init__(self):
+        super().__init__()
+        self._is_running = True
+        self._result = None
+        self.stopThread.connect(self.stop)
+
+    def run(self) -> None:
+        raise NotImplementedError
+
+    def stop(self):
+        self._is_running = False
+
+    is_running = property(lambda self: self._is_running)
+    result = property(lambda self: self._result)
+
+
+class _TaskRunnable(QRunnable):
+    def __init__(self, task: Task, low_priority):
+        super().__init__()
+        self._task = task
+        self._low_priority = low_priority
+
+    def run(self) -> None:
+        thread = QThread.currentThread()
+        if self._low_priority:
+            thread.setPriority(QThread.LowestPriority)
+        try:
+            # a task stopped while it is queued is skipped
+            if self._task.is_running:
+                self._task.run()
+        except Exception as e:
+            utils.warn(f'{type(self._task).__name__} failed: {e}')
+        finally:
+            if self._low_priority:
+                # the worker is shared, the next task runs at the normal priority again
+                thread.setPriority(QThread.NormalPriority)
+            self._task.finished.emit()
+
+
+class WorkerPool:
+    """
+    The worker threads shared by all the chatbots, a bounded pool for every stage of a reply. The threads are started
+    on demand, and stopped after they are idle for a while. The tasks beyond the thread count wait in the queue of the
+    stage.
+    :param worker_counts: dict, [optional] the max thread count by WorkerStage, the stages not in it have the default
+    count, see DEFAULT_WORKER_COUNTS.
+    """
+    DEFAULT_WORKER_COUNTS = {
+        WorkerStage.LLM: 4,
+        WorkerStage.Translate: 2,
+        WorkerStage.TTS: 1,
+        WorkerStage.Emotion: 2,
+    }
+
+    def __init__(self, worker_counts=None):
+        self._pools = {}
+        for stage in WorkerStage:
+            pool = QThreadPool()
+            pool.setMaxThreadCount(self.DEFAULT_WORKER_COUNTS[stage])
+            self._pools[stage] = pool
+        for stage, count in (worker_counts or {}).items():
+            self.set_worker_count(stage, count)
+
+    def set_worker_count(self, stage: WorkerStage, count) -> None:
+        """
+        Change the max thread count of a stage, the running tasks are not stopped.
+        :param stage: WorkerStage
+        :param count: int, at least 1.
+        :return:
+        """
+        self._pools[stage].setMaxThreadCount(max(int(count), 1))
+
+    def get_worker_count(self, stage: WorkerStage) -> int:
+        return self._pools[stage].maxThreadCount()
+
+    def submit(self, stage: WorkerStage, task: Task, low_priority=False) -> None:
+        """
+        Queue a task to run in a worker of the stage. The finished signal of the task is emitted when it is done, also
+        if it fails.
+        :param stage: WorkerStage
+        :param task: Task
+        :param low_priority: bool, run after the other queued tasks of the stage, in a thread of the lowest priority.
+        :return:
+        """
+        self._pools[stage].start(_TaskRunnable(task, low_priority), -1 if low_priority else 0)
+
+    def wait_for_done(self, msecs=-1) -> bool:
+        """
+        Wait for all the queued and running tasks, e.g. before the app quits.
+        :param msecs: int, the max time to wait, -1 for no limit.
+        :return: bool, if all the tasks are done.
+        """
+        return all(pool.waitForDone(msecs) for pool in self._pools.values())
+
+
+class TaskGraph(QObject):
+    """
+    Tasks which take the results of other tasks: a task is run as soon as the tasks it depends on are done, so the
+    tasks which do not depend on each other run at the same time. A task which fails or is stopped, i.e. it has no
+    result, skips the tasks which depend on it. Create it in the GUI thread, like the tasks.
+    :param run_task: callable(WorkerStage, Task), runs a task, e.g. WorkerPool.submit.
+    """
+    done = Signal()  # all the tasks are done or skipped
+
+    def __init__(self, run_task):
+        super().__init__()
+        self._run_task = run_task
+        # name -> (stage, create_task, the names of the dependencies)
+        self._nodes = {}
+        self._results = {}
+        self._failed = set()
+        self._pending = set()
+        # the running tasks -> their names
+        self._running: dict[Task, str] = {}
+        self._is_running = True
+
+    def add(self, name, stage: WorkerStage, create_task, depends_on=()) -> None:
+        """
+        Add a task, before the graph is started.
+        :param name: str, the name the result of the task is passed on by.
+        :param stage: WorkerStage, the stage the task runs in.
+        :param create_task: callable(**results) -> Task, creates the task with the results of its dependencies, by
+        their names.
+        :param depends_on: tuple of str, the names of the tasks it takes the results of.
+        :return:
+        """
+        self._nodes[name] = (stage, create_task, tuple(depends_on))
+
+    def start(self) -> None:
+        self._pending = set(self._nodes)
+        self._run_ready()
+
+    def stop(self) -> None:
+        """
+        Stop the running tasks, and skip the others.
+        :return:
+        """
+        self._is_running = False
+        for task in self._running:
+            task.stopThread.emit()
+
+    def get_result(self, name):
+        """
+        :param name: str
+        :return: the result of the task, or None if it is not done, failed or skipped.
+        """
+        return self._results.get(name)
+
+    def _run_ready(self):
+        changed = True
+        while changed:
+            changed = False
+            for name in list(self._pending):
+                stage, create_task, depends_on = self._nodes[name]
+                if not self._is_running or any(dependency in self._failed for dependency in depends_on):
+                    self._pending.remove(name)
+                    self._failed.add(name)
+                    changed = True
+                elif all(dependency in self._results for dependency in depends_on):
+                    self._pending.remove(name)
+                    task = create_task(**{dependency: self._results[dependency] for dependency in depends_on})
+                    self._running[task] = name
+                    task.finished.connect(self._on_finished)
+                    self._run_task(stage, task)
+        if not self._pending and not self._running:
+            self.done.emit()
+
+    @Slot()
+    def _on_finished(self):
+        task = self.sender()
+        name = self._running.pop(task, None)
+        if name is None:
+            return
+        if self._is_running and task.is_running and task.result is not None:
+            self._results[name] = task.result
+        else:
+            self._failed.add(name)
+        self._run_ready()